@@ -1,3 +1,93 @@
 from django.contrib import admin
+from django.urls import reverse
+from django.utils.html import format_html, format_html_join
 
-# Register your models here.
+from .models import ChatMessage, ChatTrace
+from .services import tracing
+
+
+@admin.register(ChatMessage)
+class ChatMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'session', 'short_message', 'created_at', 'trace_link')
+    list_select_related = ('user', 'session', 'trace')
+    search_fields = ('message',)
+    raw_id_fields = ('user', 'session')
+
+    @admin.display(description='Message')
+    def short_message(self, obj):
+        return obj.message[:80]
+
+    @admin.display(description='Trace')
+    def trace_link(self, obj):
+        # Only sampled or slow turns have one
+        trace = getattr(obj, 'trace', None)
+        if trace is None:
+            return '-'
+        url = reverse('admin:chatbot_chattrace_change', args=[trace.pk])
+        return format_html('<a href="{}">{} ms</a>', url, round(trace.duration_ms))
+
+
+@admin.register(ChatTrace)
+class ChatTraceAdmin(admin.ModelAdmin):
+    list_display = ('started_at', 'name', 'reason', 'duration_ms', 'span_count', 'chat_message')
+    list_filter = ('reason', 'name')
+    search_fields = ('=chat_message__id', '=trace_id')
+    date_hierarchy = 'started_at'
+    raw_id_fields = ('chat_message',)
+    exclude = ('spans',)
+    readonly_fields = (
+        'trace_id', 'chat_message', 'name', 'reason', 'started_at',
+        'duration_ms', 'span_count', 'dropped_spans', 'waterfall'
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description='Waterfall')
+    def waterfall(self, obj):
+        spans = tracing.decode_spans(obj.spans)
+        total = max(obj.duration_ms, 1)
+        rows = []
+        for depth, span in _span_tree(spans):
+            left = span[tracing.SPAN_START] / total * 100
+            width = max(span[tracing.SPAN_DURATION] / total * 100, 0.3)
+            attrs = ', '.join(f'{k}={v}' for k, v in span[tracing.SPAN_ATTRS].items())
+            rows.append((
+                depth * 16,
+                span[tracing.SPAN_NAME],
+                attrs,
+                span[tracing.SPAN_DURATION],
+                round(left, 2),
+                round(width, 2),
+                '#d9534f' if 'error' in span[tracing.SPAN_ATTRS] else '#417690',
+            ))
+        body = format_html_join(
+            '',
+            '<tr><td style="padding-left:{}px;white-space:nowrap">{}<div style="color:#888;font-size:11px">{}</div></td>'
+            '<td style="text-align:right;white-space:nowrap">{} ms</td>'
+            '<td style="width:60%"><div style="position:relative;height:12px;background:#f4f4f4">'
+            '<div style="position:absolute;left:{}%;width:{}%;height:12px;background:{}"></div></div></td></tr>',
+            rows
+        )
+        return format_html('<table style="width:100%">{}</table>', body)
+
+
+def _span_tree(spans):
+    """(depth, span) pairs in tree order, siblings by start time; spans whose parent was dropped go to the top level."""
+    ids = {span[tracing.SPAN_ID] for span in spans}
+    children = {}
+    roots = []
+    for span in sorted(spans, key=lambda s: s[tracing.SPAN_START]):
+        parent = span[tracing.SPAN_PARENT]
+        if parent is None:
+            roots.append(span)
+        else:
+            children.setdefault(parent if parent in ids else None, []).append(span)
+    roots.extend(children.pop(None, []))
+    ordered = []
+    stack = [(0, span) for span in reversed(roots)]
+    while stack:
+        depth, span = stack.pop()
+        ordered.append((depth, span))
+        stack.extend((depth + 1, child) for child in reversed(children.get(span[tracing.SPAN_ID], [])))
+    return ordered
@@ -0,0 +1,44 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services import replay
+
+
+class Command(BaseCommand):
+    help = (
+        "Run chat turns through analyze_query against the upstream fixtures: record them "
+        "(UPSTREAM_REPLAY=record, needs network) or replay and time them offline (UPSTREAM_REPLAY=replay)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='+', help="User queries, one turn each")
+        parser.add_argument('--cassette', default=None,
+                            help="Fixture file name (default UPSTREAM_REPLAY['CASSETTE'])")
+        parser.add_argument('--repeat', type=int, default=1, help="Times each query is run when replaying")
+        parser.add_argument('--budget', type=float, default=None, help="Turn budget in seconds (default none)")
+
+    def handle(self, *args, **options):
+        if not replay.enabled():
+            raise CommandError("Set UPSTREAM_REPLAY to 'record' or 'replay' (environment or UPSTREAM_REPLAY['MODE'])")
+        # After the mode check, the service builds its clients for it
+        from chatbot.services.chatgpt_service import ChatGPTService
+
+        service = ChatGPTService()
+        repeat = options['repeat'] if replay.mode() == replay.REPLAY else 1
+        with replay.use_cassette(options['cassette'] or replay._config("CASSETTE")) as cassette:
+            for query in options['queries']:
+                timings = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    answer = service.analyze_query(query, budget=options['budget'])
+                    timings.append(time.perf_counter() - started)
+                self.stdout.write(
+                    f"{query!r}: {len(answer)} chars, median {statistics.median(timings):.3f}s, "
+                    f"min {min(timings):.3f}s, max {max(timings):.3f}s over {len(timings)} runs"
+                )
+        if cassette.misses:
+            self.stderr.write(f"{len(cassette.misses)} requests had no recorded response:")
+            for key in dict.fromkeys(cassette.misses):
+                self.stderr.write(f"  {key}")
@@ -0,0 +1,56 @@
+import asyncio
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from chatbot.services import chat_jobs
+
+
+def _work(concurrency):
+    """Entry point of one worker process."""
+    # Imported here so each process builds its own OpenAI and upstream clients
+    from chatbot.services.chatgpt_service import ChatGPTService
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await chat_jobs.aserve(ChatGPTService(), stop, concurrency)
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Answer queued chat turns (submit_chat_job) with a pool of worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=chat_jobs._config("PROCESSES"),
+                            help="Worker processes (default CHAT_JOBS['PROCESSES'])")
+        parser.add_argument('--concurrency', type=int, default=chat_jobs._config("CONCURRENCY"),
+                            help="Jobs each process runs at once (default CHAT_JOBS['CONCURRENCY'])")
+
+    def handle(self, *args, **options):
+        # Children must not share the parent's database connections
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_work, args=(options['concurrency'],), name=f"chat-worker-{i}")
+            for i in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f"Started {len(processes)} chat workers, {options['concurrency']} jobs each")
+
+        def forward(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        # Ctrl+C reaches the whole process group; SIGTERM to this process is passed on
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for process in processes:
+            process.join()
+        self.stdout.write("Chat workers stopped")
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.9 on 2026-10-17 03:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='summary',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='summary_through',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
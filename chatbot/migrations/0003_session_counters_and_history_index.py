@@ -0,0 +1,40 @@
+# Generated by Django 4.2.9 on 2026-10-17 03:47
+
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_session_counters(apps, schema_editor):
+    ChatSession = apps.get_model('chatbot', 'ChatSession')
+    ChatMessage = apps.get_model('chatbot', 'ChatMessage')
+    per_session = ChatMessage.objects.filter(session=OuterRef('pk')).order_by().values('session')
+    ChatSession.objects.update(
+        message_count=Coalesce(Subquery(per_session.annotate(n=Count('pk')).values('n')), 0),
+        last_activity=Subquery(per_session.annotate(latest=Max('created_at')).values('latest')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_chatsession_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['session', 'created_at'], name='chatmessage_session_created'),
+        ),
+        migrations.RunPython(backfill_session_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.9 on 2026-10-17 03:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_session_counters_and_history_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['user', 'created_at'], name='chatsession_user_created'),
+        ),
+    ]
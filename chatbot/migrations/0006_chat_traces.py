@@ -0,0 +1,33 @@
+# Generated by Django 4.2.9 on 2026-10-17 04:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_chat_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatTrace',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trace_id', models.UUIDField(editable=False, unique=True)),
+                ('name', models.CharField(max_length=50)),
+                ('reason', models.CharField(choices=[('sampled', 'Sampled'), ('slow', 'Slow')], max_length=10)),
+                ('started_at', models.DateTimeField()),
+                ('duration_ms', models.FloatField()),
+                ('span_count', models.PositiveIntegerField()),
+                ('dropped_spans', models.PositiveIntegerField(default=0)),
+                ('spans', models.BinaryField()),
+                ('chat_message', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='trace', to='chatbot.chatmessage')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+                'indexes': [models.Index(fields=['started_at'], name='chattrace_started')],
+            },
+        ),
+    ]
@@ -1,26 +1,48 @@
 # chatbot/models.py
+from django.core.cache import cache
 from django.db import models
+from django.db.models import F
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 
+# Cache key of a user's first page of sessions (get_chat_sessions)
+SESSION_LIST_CACHE_KEY = "chat_sessions:first_page:{user_id}"
+
+def invalidate_session_list(user_id):
+    cache.delete(SESSION_LIST_CACHE_KEY.format(user_id=user_id))
+
 class ChatSession(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     title = models.CharField(max_length=255, blank=True)  # Auto-generated from first message
     created_at = models.DateTimeField(auto_now_add=True)
     session_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    # Rolling summary of the exchanges older than the ones sent to the model verbatim
+    summary = models.TextField(blank=True)
+    summary_through = models.DateTimeField(null=True, blank=True)  # created_at of the last exchange folded in
+    # Kept up to date by ChatMessage.save so a turn never has to count or scan the session's messages
+    message_count = models.PositiveIntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # The sidebar lists a user's sessions newest first, a page at a time
+            models.Index(fields=['user', 'created_at'], name='chatsession_user_created'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.title:
-            # Set default title based on first message or timestamp
-            first_message = self.messages.first()
-            if first_message:
-                self.title = first_message.message[:50] + "..." if len(first_message.message) > 50 else first_message.message
-            else:
-                self.title = f"Chat {self.created_at.strftime('%Y-%m-%d %H:%M')}"
+            # Default title from the timestamp; the first message renames the session when it arrives
+            self.title = f"Chat {(self.created_at or timezone.now()).strftime('%Y-%m-%d %H:%M')}"
         super().save(*args, **kwargs)
+        invalidate_session_list(self.user_id)
+
+    def delete(self, *args, **kwargs):
+        user_id = self.user_id
+        result = super().delete(*args, **kwargs)
+        invalidate_session_list(user_id)
+        return result
 
 class ChatMessage(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -30,4 +52,80 @@ class ChatMessage(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        ordering = ['created_at']
\ No newline at end of file
+        ordering = ['created_at']
+        indexes = [
+            # History windows read a session's latest messages newest first
+            models.Index(fields=['session', 'created_at'], name='chatmessage_session_created'),
+        ]
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            ChatSession.objects.filter(pk=self.session_id).update(
+                message_count=F('message_count') + 1,
+                last_activity=self.created_at
+            )
+
+class ChatJob(models.Model):
+    """A queued chat turn, answered by a run_chat_workers process and saved as a ChatMessage."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    job_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='jobs')
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    stage = models.CharField(max_length=20, blank=True)  # Latest pipeline stage of a running job
+    response = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    chat_message = models.OneToOneField(ChatMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='job')
+    # Claim held by a worker; running jobs whose lease ran out are requeued
+    worker = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            # Workers take the oldest queued job and sweep running ones for expired leases
+            models.Index(fields=['status', 'created_at'], name='chatjob_status_created'),
+        ]
+
+class ChatTrace(models.Model):
+    """Span tree of a sampled or slow chat turn (chatbot/services/tracing.py), shown as a waterfall in the admin."""
+    SAMPLED = 'sampled'
+    SLOW = 'slow'
+    REASON_CHOICES = [
+        (SAMPLED, 'Sampled'),
+        (SLOW, 'Slow'),
+    ]
+
+    trace_id = models.UUIDField(unique=True, editable=False)
+    chat_message = models.OneToOneField(ChatMessage, on_delete=models.CASCADE, null=True, blank=True, related_name='trace')
+    name = models.CharField(max_length=50)  # View or worker that ran the turn
+    reason = models.CharField(max_length=10, choices=REASON_CHOICES)
+    started_at = models.DateTimeField()
+    duration_ms = models.FloatField()
+    span_count = models.PositiveIntegerField()
+    dropped_spans = models.PositiveIntegerField(default=0)  # Over TRACING['MAX_SPANS']
+    # zlib-compressed JSON list of [id, parent id, name, start ms, duration ms, attributes]
+    spans = models.BinaryField()
+
+    class Meta:
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['started_at'], name='chattrace_started'),
+        ]
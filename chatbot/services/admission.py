@@ -0,0 +1,368 @@
+import asyncio
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from chatbot.services import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    "MAX_IN_FLIGHT": 16,
+    "MAX_PER_USER": 2,
+    "MAX_QUEUE": 32,
+    "MAX_WAIT": 10,
+    "TIERS": {"staff": 0, "user": 1},
+    "SLOT_TTL": 120,
+    "POLL_INTERVAL": 0.1,
+}
+
+# Seconds a queue entry outlives its waiter's last admission attempt
+WAITER_TTL = 2
+# Weight of the latest turn in the running average used for Retry-After
+TURN_SECONDS_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a chat turn can't be admitted; the view answers 429 with Retry-After."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Chat turn not admitted: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, path, max_in_flight=16, max_per_user=2, max_queue=32, max_wait=10, slot_ttl=120, poll_interval=0.1):
+        """
+        Caps on chat turns running at once, kept in SQLite so every worker process
+        on the host counts against the same limits.
+
+        A turn takes a slot when fewer than max_in_flight are taken and nobody is
+        waiting ahead of it; otherwise it joins a bounded queue ordered by
+        priority tier, then arrival. A user never holds or waits for more than
+        max_per_user slots. Rejections are immediate, except for queued turns
+        that waited max_wait seconds. Slots and queue entries carry an expiry so a
+        worker that dies doesn't hold them for long.
+        Args:
+            path: SQLite file location.
+            max_in_flight: Turns running at once on the host.
+            max_per_user: Turns a user may have running or queued.
+            max_queue: Turns waiting for a slot.
+            max_wait: Seconds a queued turn waits before it is rejected.
+            slot_ttl: Seconds after which an unreleased slot is taken back.
+            poll_interval: Seconds between a queued turn's admission attempts.
+        """
+        self.path = str(path)
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.slot_ttl = slot_ttl
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # AUTOINCREMENT: ids are never reused, so a late release can't free someone else's slot
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS slots ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, acquired_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS waiters ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, priority INTEGER NOT NULL, "
+                "enqueued_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _bump(conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def _retry_after(self, conn, queued=None):
+        # Roughly when the turns ahead will have drained (or, for a user at the
+        # limit, when one of their own turns ends), from the average turn length
+        row = conn.execute("SELECT value FROM counters WHERE name = 'turn_seconds_avg'").fetchone()
+        turn_seconds = row[0] if row else 10
+        if queued is not None:
+            turn_seconds = turn_seconds * (queued + 1) / self.max_in_flight
+        return max(1, min(60, round(turn_seconds)))
+
+    def _take_slot(self, conn, user_id, now):
+        cursor = conn.execute(
+            "INSERT INTO slots (user_id, acquired_at, expires_at) VALUES (?, ?, ?)",
+            (user_id, now, now + self.slot_ttl),
+        )
+        self._bump(conn, "admitted")
+        return cursor.lastrowid
+
+    def try_enter(self, user_id, priority):
+        """
+        Take a slot, or a place in the queue when none is free.
+        Returns:
+            Tuple ("slot" or "queued", row id).
+        Raises:
+            AdmissionRejected: The user is at max_per_user or the queue is full.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            conn.execute("DELETE FROM slots WHERE expires_at < ?", (now,))
+            conn.execute("DELETE FROM waiters WHERE expires_at < ?", (now,))
+            in_flight = conn.execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+            queued = conn.execute("SELECT COUNT(*) FROM waiters").fetchone()[0]
+            user_turns = conn.execute(
+                "SELECT (SELECT COUNT(*) FROM slots WHERE user_id = ?) + (SELECT COUNT(*) FROM waiters WHERE user_id = ?)",
+                (user_id, user_id),
+            ).fetchone()[0]
+            if user_turns >= self.max_per_user:
+                self._bump(conn, "rejected_user_limit")
+                error = AdmissionRejected("user_limit", self._retry_after(conn))
+            elif in_flight < self.max_in_flight and not queued:
+                result = ("slot", self._take_slot(conn, user_id, now))
+                error = None
+            elif queued >= self.max_queue:
+                self._bump(conn, "rejected_queue_full")
+                error = AdmissionRejected("queue_full", self._retry_after(conn, queued))
+            else:
+                cursor = conn.execute(
+                    "INSERT INTO waiters (user_id, priority, enqueued_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (user_id, priority, now, now + WAITER_TTL),
+                )
+                result = ("queued", cursor.lastrowid)
+                error = None
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if error:
+            raise error
+        return result
+
+    def try_promote(self, waiter_id):
+        """
+        Move a queued turn into a slot if one is free and it heads the queue.
+        Returns:
+            The slot id, or None to keep waiting.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            conn.execute("DELETE FROM slots WHERE expires_at < ?", (now,))
+            conn.execute("DELETE FROM waiters WHERE expires_at < ?", (now,))
+            # Each attempt renews the entry, those of waiters that went away expire quickly
+            conn.execute("UPDATE waiters SET expires_at = ? WHERE id = ?", (now + WAITER_TTL, waiter_id))
+            in_flight = conn.execute("SELECT COUNT(*) FROM slots").fetchone()[0]
+            head = conn.execute(
+                "SELECT id, user_id, enqueued_at FROM waiters ORDER BY priority, enqueued_at, id LIMIT 1"
+            ).fetchone()
+            slot_id = None
+            if in_flight < self.max_in_flight and head is not None and head[0] == waiter_id:
+                conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+                slot_id = self._take_slot(conn, head[1], now)
+                self._bump(conn, "queue_wait_seconds_total", now - head[2])
+                self._bump(conn, "queue_waits")
+            conn.execute("COMMIT")
+            return slot_id
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def leave_queue(self, waiter_id, timed_out=False):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+            if timed_out:
+                self._bump(conn, "rejected_timeout")
+            retry_after = self._retry_after(conn, conn.execute("SELECT COUNT(*) FROM waiters").fetchone()[0])
+            conn.execute("COMMIT")
+            return retry_after
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release(self, slot_id):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT acquired_at FROM slots WHERE id = ?", (slot_id,)).fetchone()
+            conn.execute("DELETE FROM slots WHERE id = ?", (slot_id,))
+            if row is not None:
+                seconds = time.time() - row[0]
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES ('turn_seconds_avg', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + ? * (excluded.value - value)",
+                    (seconds, TURN_SECONDS_SMOOTHING),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def renew(self, slot_id):
+        """
+        Push a held slot's expiry out by slot_ttl.
+        Returns:
+            False if the slot had already expired and been taken back.
+        """
+        conn = self._connect()
+        cursor = conn.execute("UPDATE slots SET expires_at = ? WHERE id = ?", (time.time() + self.slot_ttl, slot_id))
+        return cursor.rowcount > 0
+
+    async def aacquire(self, user_id, priority):
+        """
+        Wait for a slot for one of user_id's turns.
+        Returns:
+            The slot id, to pass to release once the turn is over.
+        Raises:
+            AdmissionRejected: No slot could be had, see try_enter; or max_wait ran out in the queue.
+        """
+        kind, row_id = await asyncio.to_thread(self.try_enter, user_id, priority)
+        if kind == "slot":
+            return row_id
+        give_up_at = time.monotonic() + self.max_wait
+        try:
+            while True:
+                slot_id = await asyncio.to_thread(self.try_promote, row_id)
+                if slot_id is not None:
+                    return slot_id
+                if time.monotonic() >= give_up_at:
+                    break
+                await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            # Client gone (cancelled) or state file trouble: don't leave a ghost in the queue
+            await asyncio.to_thread(self.leave_queue, row_id)
+            raise
+        raise AdmissionRejected("timeout", await asyncio.to_thread(self.leave_queue, row_id, True))
+
+    def stats(self):
+        """Queue depth per tier, turns in flight and the admission counters."""
+        conn = self._connect()
+        now = time.time()
+        in_flight = conn.execute("SELECT COUNT(*) FROM slots WHERE expires_at >= ?", (now,)).fetchone()[0]
+        queued = dict(conn.execute(
+            "SELECT priority, COUNT(*) FROM waiters WHERE expires_at >= ? GROUP BY priority", (now,)
+        ).fetchall())
+        oldest = conn.execute("SELECT MIN(enqueued_at) FROM waiters WHERE expires_at >= ?", (now,)).fetchone()[0]
+        counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        tiers = _config("TIERS")
+        return {
+            "in_flight": in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": {tier: queued.get(priority, 0) for tier, priority in tiers.items()},
+            "oldest_wait_seconds": round(now - oldest, 3) if oldest else 0,
+            "counters": counters,
+        }
+
+
+def _config(key):
+    return getattr(settings, "CHAT_ADMISSION", {}).get(key, DEFAULTS[key])
+
+
+_controller = None
+
+
+def get_controller():
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController(
+            getattr(settings, "CHAT_ADMISSION", {}).get("PATH", os.path.join(settings.BASE_DIR, "cache", "admission.sqlite3")),
+            max_in_flight=_config("MAX_IN_FLIGHT"),
+            max_per_user=_config("MAX_PER_USER"),
+            max_queue=_config("MAX_QUEUE"),
+            max_wait=_config("MAX_WAIT"),
+            slot_ttl=_config("SLOT_TTL"),
+            poll_interval=_config("POLL_INTERVAL"),
+        )
+    return _controller
+
+
+def priority_for(user):
+    """Queue priority of user's turns, lower goes first."""
+    tiers = _config("TIERS")
+    return tiers["staff"] if user.is_staff else tiers["user"]
+
+
+async def aacquire(user):
+    """
+    Admit one chat turn for user.
+    Returns:
+        A slot id for release, or None when admission control is off or unavailable.
+    Raises:
+        AdmissionRejected
+    """
+    if not _config("ENABLED"):
+        return None
+    started = time.monotonic()
+    try:
+        slot_id = await get_controller().aacquire(str(user.pk), priority_for(user))
+        metrics.observe("chat_admission_wait_seconds", time.monotonic() - started, outcome="admitted")
+        return slot_id
+    except AdmissionRejected as e:
+        metrics.inc("chat_admission_rejections_total", reason=e.reason)
+        if e.reason == "timeout":
+            metrics.observe("chat_admission_wait_seconds", time.monotonic() - started, outcome="timeout")
+        raise
+    except sqlite3.Error as e:
+        # Rather serve unthrottled than refuse every turn if the state file is unusable
+        logger.warning(f"Admission control unavailable: {str(e)}")
+        return None
+
+
+@contextlib.asynccontextmanager
+async def aheartbeat(slot_id):
+    """
+    Renew slot_id every third of SLOT_TTL while the block runs, for turns that can
+    outlast it, e.g. a streamed response the client reads slowly.
+    """
+    if slot_id is None:
+        yield
+        return
+
+    async def beat():
+        interval = _config("SLOT_TTL") / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await asyncio.to_thread(get_controller().renew, slot_id):
+                    logger.warning(f"Admission slot {slot_id} expired before it could be renewed")
+                    return
+            except sqlite3.Error as e:
+                logger.warning(f"Could not renew admission slot {slot_id}: {str(e)}")
+
+    task = asyncio.ensure_future(beat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+async def arelease(slot_id):
+    if slot_id is None:
+        return
+    try:
+        await asyncio.to_thread(get_controller().release, slot_id)
+    except sqlite3.Error as e:
+        # The slot expires after SLOT_TTL anyway
+        logger.warning(f"Could not release admission slot {slot_id}: {str(e)}")
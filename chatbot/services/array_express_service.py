@@ -1,13 +1,16 @@
+import httpx
 import requests
 from typing import List, Dict
 from urllib.parse import quote
+from chatbot.services import http_client
+from chatbot.services.source_cache import cached
 
 class ArrayExpressService:
     def __init__(self):
         self.base_url = "https://www.ebi.ac.uk/biostudies/api/v1"
         self.search_endpoint = "/search"
-        self.timeout = 10
 
+    @cached("array_express")
     def search_array_express(self, query: str, max_results: int = 3) -> List[Dict]:
         """
         Search BioStudies/ArrayExpress for studies relevant to the query.
@@ -18,28 +21,12 @@ class ArrayExpressService:
             List of dictionaries with study data (accession, title, description, assay_count).
         """
         try:
-            results = []
-            encoded_query = quote(query)
-            params = {
-                "organism": "Homo sapiens",
-                "study_type": "RNA-seq of coding RNA OR transcription profiling by array",
-                "experimental_factor_value": f"{encoded_query} OR Alzheimer’s Disease",
-                "size": max_results
-            }
+            params = self._search_params(query, max_results)
             url = f"{self.base_url}{self.search_endpoint}"
             print(f"Querying ArrayExpress: {url} with params: {params}")
-            response = requests.get(url, params=params, timeout=self.timeout)
+            response = http_client.get(url, params=params)
             response.raise_for_status()
-            data = response.json().get('hits', [])
-            print(f"ArrayExpress response: {data}")
-
-            for item in data[:max_results]:
-                parsed_data = self._parse_study_data(item)
-                if self._is_ad_relevant(parsed_data):
-                    results.append(parsed_data)
-
-            print(f"ArrayExpress parsed results: {results}")
-            return results[:max_results]
+            return self._parse_hits(response.json().get('hits', []), max_results)
 
         except requests.exceptions.HTTPError as e:
             print(f"HTTP error querying ArrayExpress API: {e} (Status: {e.response.status_code})")
@@ -51,6 +38,49 @@ class ArrayExpressService:
             print(f"Error parsing ArrayExpress response: {e}")
             return []
 
+    @cached("array_express")
+    async def asearch_array_express(self, query: str, max_results: int = 3) -> List[Dict]:
+        """
+        Async variant of search_array_express.
+        """
+        try:
+            params = self._search_params(query, max_results)
+            url = f"{self.base_url}{self.search_endpoint}"
+            print(f"Querying ArrayExpress: {url} with params: {params}")
+            response = await http_client.aget(url, params=params)
+            response.raise_for_status()
+            return self._parse_hits(response.json().get('hits', []), max_results)
+
+        except httpx.HTTPStatusError as e:
+            print(f"HTTP error querying ArrayExpress API: {e} (Status: {e.response.status_code})")
+            return []
+        except httpx.HTTPError as e:
+            print(f"Error querying ArrayExpress API: {e}")
+            return []
+        except ValueError as e:
+            print(f"Error parsing ArrayExpress response: {e}")
+            return []
+
+    def _search_params(self, query: str, max_results: int) -> Dict:
+        encoded_query = quote(query)
+        return {
+            "organism": "Homo sapiens",
+            "study_type": "RNA-seq of coding RNA OR transcription profiling by array",
+            "experimental_factor_value": f"{encoded_query} OR Alzheimer’s Disease",
+            "size": max_results
+        }
+
+    def _parse_hits(self, data: List[Dict], max_results: int) -> List[Dict]:
+        print(f"ArrayExpress response: {data}")
+        results = []
+        for item in data[:max_results]:
+            parsed_data = self._parse_study_data(item)
+            if self._is_ad_relevant(parsed_data):
+                results.append(parsed_data)
+
+        print(f"ArrayExpress parsed results: {results}")
+        return results[:max_results]
+
     def _parse_study_data(self, data: Dict) -> Dict:
         """
         Parse BioStudies API response to extract relevant study data.
@@ -0,0 +1,164 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from chatbot.models import ChatJob, ChatMessage
+from chatbot.services import conversation_summary, tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "PROCESSES": 2,
+    "CONCURRENCY": 4,
+    "POLL_INTERVAL": 0.5,
+    "LEASE_SECONDS": 120,
+    "MAX_ATTEMPTS": 2,
+}
+
+
+def _config(key):
+    return getattr(settings, "CHAT_JOBS", {}).get(key, DEFAULTS[key])
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def aclaim(worker):
+    """
+    Take the oldest queued job, or None when there is nothing to run. Jobs of a
+    session that already has a turn running wait, so every turn sees the answer
+    to the one before it. The claim is a conditional UPDATE: of two workers
+    racing for a job, only one matches the queued row and the other moves on.
+    """
+    busy = ChatJob.objects.filter(status=ChatJob.RUNNING).values('session_id')
+    while True:
+        candidate = await ChatJob.objects.filter(status=ChatJob.QUEUED).exclude(session_id__in=busy).order_by('created_at').only('pk').afirst()
+        if candidate is None:
+            return None
+        now = timezone.now()
+        claimed = await ChatJob.objects.filter(pk=candidate.pk, status=ChatJob.QUEUED).aupdate(
+            status=ChatJob.RUNNING,
+            worker=worker,
+            started_at=now,
+            lease_expires_at=now + timedelta(seconds=_config("LEASE_SECONDS")),
+            attempts=F('attempts') + 1
+        )
+        if claimed:
+            return await ChatJob.objects.select_related('user', 'session').aget(pk=candidate.pk)
+
+
+async def arequeue_expired():
+    """Put running jobs whose worker died back in the queue, or fail them after MAX_ATTEMPTS."""
+    expired = ChatJob.objects.filter(status=ChatJob.RUNNING, lease_expires_at__lt=timezone.now())
+    failed = await expired.filter(attempts__gte=_config("MAX_ATTEMPTS")).aupdate(
+        status=ChatJob.FAILED,
+        error="Worker stopped before the job finished",
+        finished_at=timezone.now()
+    )
+    requeued = await expired.aupdate(status=ChatJob.QUEUED, stage='', worker='', lease_expires_at=None)
+    if failed or requeued:
+        logger.warning(f"Expired chat job leases: {requeued} requeued, {failed} failed")
+
+
+def _finish(job, worker, response_text):
+    # The job only completes if this worker still holds it, and then always with its ChatMessage
+    with transaction.atomic():
+        owned = ChatJob.objects.filter(pk=job.pk, status=ChatJob.RUNNING, worker=worker).update(
+            status=ChatJob.DONE,
+            stage='',
+            response=response_text,
+            finished_at=timezone.now()
+        )
+        if not owned:
+            return None
+        message = ChatMessage.objects.create(
+            user=job.user,
+            session=job.session,
+            message=job.message,
+            response=response_text
+        )
+        ChatJob.objects.filter(pk=job.pk).update(chat_message=message)
+    return message
+
+
+async def arun_job(job, worker, chatgpt_service):
+    """Answer one claimed job and save the turn; errors mark the job failed."""
+    trace = tracing.start('chat_job')
+    try:
+        with tracing.span('load_history'):
+            chat_history = await conversation_summary.aload_history(job.session)
+        parts = []
+        # Closed here on error, not later by the event loop in another context
+        async with contextlib.aclosing(chatgpt_service.astream_query(job.message, chat_history, budget=settings.CHAT_TURN_BUDGET['TOTAL'])) as events:
+            async for event, payload in events:
+                if event == 'token':
+                    parts.append(payload['text'])
+                elif event == 'error':
+                    # Fail the job rather than save the error text as the answer
+                    raise Exception(payload['message'])
+                elif event == 'stage':
+                    await ChatJob.objects.filter(pk=job.pk, worker=worker).aupdate(stage=payload['stage'])
+        with tracing.span('save_message'):
+            chat_message = await sync_to_async(_finish)(job, worker, "".join(parts))
+        if chat_message is None:
+            logger.warning(f"Chat job {job.job_id} was taken over by another worker, dropping this answer")
+            return
+        await tracing.afinish(trace, chat_message)
+        logger.info(f"Chat job {job.job_id} done")
+        # The worker has no response to send first, so the summary is brought up to date inline
+        if conversation_summary.enabled():
+            await conversation_summary.aupdate(job.session_id, chatgpt_service)
+    except Exception as e:
+        logger.error(f"Chat job {job.job_id} failed: {str(e)}")
+        await ChatJob.objects.filter(pk=job.pk, worker=worker).aupdate(
+            status=ChatJob.FAILED,
+            error=str(e),
+            finished_at=timezone.now()
+        )
+
+
+async def aserve(chatgpt_service, stop, concurrency=None):
+    """
+    Worker loop of one run_chat_workers process: keep up to CONCURRENCY jobs
+    running (turns mostly wait on upstream APIs and OpenAI) until stop is set,
+    then let the running ones finish.
+    """
+    worker = worker_name()
+    concurrency = concurrency or _config("CONCURRENCY")
+    running = set()
+    sweep_at = 0.0
+    loop = asyncio.get_running_loop()
+    logger.info(f"Chat worker {worker} started, {concurrency} concurrent jobs")
+    while not stop.is_set():
+        try:
+            if loop.time() >= sweep_at:
+                await arequeue_expired()
+                sweep_at = loop.time() + _config("LEASE_SECONDS") / 4
+            job = await aclaim(worker) if len(running) < concurrency else None
+        except Exception as e:
+            # Database locked or gone away: wait a poll interval with fresh connections
+            logger.error(f"Chat worker {worker} could not claim a job: {str(e)}")
+            await sync_to_async(close_old_connections)()
+            job = None
+        if job is not None:
+            task = asyncio.ensure_future(arun_job(job, worker, chatgpt_service))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            continue
+        try:
+            await asyncio.wait_for(stop.wait(), _config("POLL_INTERVAL"))
+        except asyncio.TimeoutError:
+            pass
+    if running:
+        logger.info(f"Chat worker {worker} stopping, waiting for {len(running)} jobs")
+        await asyncio.gather(*running, return_exceptions=True)
@@ -1,15 +1,22 @@
+import asyncio
 import json
 import os
-from openai import OpenAI
+import time
+import weakref
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from openai import NOT_GIVEN, AsyncOpenAI
 from dotenv import load_dotenv
-from chatbot.services.pubmed_service import search_pubmed
-from chatbot.services.clinical_trials_service import search_clinical_trials
+from chatbot.services.pubmed_service import asearch_pubmed
+from chatbot.services.clinical_trials_service import asearch_clinical_trials
 from chatbot.services.ensembl_service import EnsemblService
 from chatbot.services.uniprot_service import UniProtService
 from chatbot.services.genbank_service import GenBankService
 from chatbot.services.protein_atlas_service import ProteinAtlasService
 from chatbot.services.array_express_service import ArrayExpressService
 from chatbot.services.geo_service import GeoService
+from chatbot.services import context_assembler, deadline, evidence_context as evidence, metrics, query_analyzer, replay, tracing
+from chatbot.services.source_scheduler import SourceScheduler
 import urllib.parse
 import logging
 import re
@@ -20,9 +27,25 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Names shown to the user while a scheduler task runs
+SOURCE_LABELS = {
+    "trials": "ClinicalTrials.gov",
+    "pubmed": "PubMed",
+    "ensembl_genes": "Ensembl genes",
+    "ensembl_variants": "Ensembl variants",
+    "ensembl_phenotypes": "Ensembl phenotypes",
+    "ensembl": "Ensembl",
+    "uniprot": "UniProt",
+    "protein_atlas": "Human Protein Atlas",
+    "array_express": "ArrayExpress",
+    "geo": "GEO",
+    "genbank": "GenBank",
+}
+
 class ChatGPTService:
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("CHATGPT_API_KEY"))
+        # One AsyncOpenAI client per event loop, its connection pool is tied to the loop it was first used on
+        self._async_clients = weakref.WeakKeyDictionary()
         self.ensembl_service = EnsemblService()
         self.uniprot_service = UniProtService()
         self.genbank_service = GenBankService()
@@ -138,39 +161,48 @@ class ChatGPTService:
             }
         ]
 
+    @property
+    def async_client(self):
+        """AsyncOpenAI client for the running event loop."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            if replay.enabled():
+                # Replaying needs no key, and a missing fixture should fail at once rather than be retried
+                client = AsyncOpenAI(
+                    api_key=os.getenv("CHATGPT_API_KEY") or "replay",
+                    http_client=replay.openai_http_client(),
+                    max_retries=0 if replay.mode() == replay.REPLAY else 2,
+                )
+            else:
+                client = AsyncOpenAI(api_key=os.getenv("CHATGPT_API_KEY"))
+            self._async_clients[loop] = client
+        return client
+
     def count_tokens(self, text):
-        """Rough token estimation: ~4 chars = 1 token"""
-        return len(text) // 4
-    
+        """Tokens text takes in the answer model's encoding."""
+        return context_assembler.count_tokens(text)
+
     def trim_chat_history(self, chat_history, max_tokens=2000):
-        """Keep chat history under token limit"""
-        if not chat_history:
-            return chat_history
-            
-        total_tokens = 0
-        trimmed_history = []
-        
-        # Process messages in reverse order to keep most recent ones
-        for message in reversed(chat_history):
-            msg_tokens = self.count_tokens(message.get('content', ''))
-            if total_tokens + msg_tokens > max_tokens:
-                break
-            trimmed_history.insert(0, message)
-            total_tokens += msg_tokens
-        
-        logger.info(f"Trimmed chat history from {len(chat_history)} to {len(trimmed_history)} messages, using {total_tokens} tokens")
-        return trimmed_history
-
-    def truncate_content(self, content, max_length=500):
-        """Truncate long content with ellipsis"""
-        if len(content) > max_length:
-            return content[:max_length] + "..."
-        return content
+        """Keep the most recent chat history that fits in max_tokens"""
+        return context_assembler.trim_history(chat_history, max_tokens)
+
+    def _evidence_budget(self):
+        """Seconds source lookups may use, keeping the generation reserve for the answer."""
+        left = deadline.remaining()
+        if left is None:
+            return None
+        return max(0.0, left - settings.CHAT_TURN_BUDGET.get("GENERATION_RESERVE", 0))
+
+    def _llm_timeout(self):
+        left = deadline.remaining()
+        # The model may run into the grace period, a turn without an answer is worse than a late one
+        return NOT_GIVEN if left is None else left + settings.CHAT_TURN_BUDGET.get("GENERATION_GRACE", 0)
 
     def normalize_query_terms(self, term):
         """Normalize query terms for API compatibility."""
         term = term.lower()
-        term = re.sub(r'’s', 's', term)  # Convert "Alzheimer’s" to "Alzheimers"
+        term = re.sub(r"['’]s\b", 's', term)  # Convert "Alzheimer’s" / "Alzheimer's" to "Alzheimers"
         term = re.sub(r'[^\w\s]', ' ', term)  # Remove special characters
         term = re.sub(r'\s+', ' ', term).strip()  # Normalize spaces
         # Map common terms to API-friendly versions
@@ -181,340 +213,618 @@ class ChatGPTService:
         }
         return term_map.get(term, term)
 
-    def analyze_query(self, user_query, chat_history=None):
+    def _search_terms(self, args):
+        condition_terms = " OR ".join([self.normalize_query_terms(k) for k in args["disease_keywords"]]) if args.get("disease_keywords") else ""
+        treatment_terms = " OR ".join(args["treatment_keywords"]) if args.get("treatment_keywords") else ""
+        return condition_terms, treatment_terms
+
+    def _leaf_calls(self, tool_name, args):
+        """
+        The service calls the first wave of source tasks makes for these routing
+        arguments (trials, PubMed, Ensembl lookups), exactly as those tasks make them.
+        Returns:
+            List of (fn, args, kwargs) tuples.
+        """
+        if not tool_name:
+            return []
+        condition_terms, treatment_terms = self._search_terms(args)
+        calls = []
+        if args.get("need_trials"):
+            calls.append((asearch_clinical_trials, (condition_terms, treatment_terms), {"max_results": 3}))
+        if tool_name != "get_research_and_trials":
+            return calls
+
+        if args.get("need_pubmed"):
+            search_query = f"{treatment_terms} {condition_terms}".strip()
+            calls.append((asearch_pubmed, (search_query,), {"api_key": os.getenv("PUBMED_API_KEY", ""), "max_results": 2}))
+        if args.get("need_ensembl") and (args.get("gene_symbols") or args.get("variant_ids") or args.get("phenotype_terms")):
+            species = args.get("species", "homo_sapiens")
+            gene_symbols = args.get("gene_symbols") or []
+            variant_ids = args.get("variant_ids") or []
+            if len(gene_symbols) > 1:
+                calls.append((self.ensembl_service.asearch_genes_by_symbols, (species, gene_symbols), {}))
+            elif gene_symbols:
+                calls.append((self.ensembl_service.asearch_gene_by_symbol, (species, gene_symbols[0]), {}))
+            if len(variant_ids) > 1:
+                calls.append((self.ensembl_service.asearch_variants_consequences, (species, variant_ids), {}))
+            elif variant_ids:
+                calls.append((self.ensembl_service.asearch_variant_consequences, (species, variant_ids[0]), {}))
+            for gene_symbol in gene_symbols:
+                calls.append((self.ensembl_service.asearch_phenotype_by_gene, (species, gene_symbol), {}))
+        return calls
+
+    async def _trials_section(self, condition_terms, treatment_terms):
+        section = context_assembler.Section("trials", "## Clinical Trials\n\n")
         try:
-            apis_called = []
-            combined_info = ""
-            references = []
-
-            logger.info(f"Processing query: {user_query}")
-            logger.info(f"Chat history: {chat_history}")
+            trials_results = await evidence.call(asearch_clinical_trials, condition_terms, treatment_terms, max_results=3)
+            if trials_results:
+                for trial in trials_results:
+                    section.add(
+                        f"**Title:** {trial['title']}\n"
+                        f"**Status:** {trial['status']}\n"
+                        f"**Phase:** {trial.get('phase', 'Not specified')}\n"
+                        f"**Interventions:** {', '.join(trial.get('interventions', ['Not specified']))}\n"
+                        f"**NCT ID:** {trial['nct_id']}\n"
+                        f"**Description:** {trial.get('description', 'No description available')}\n\n",
+                        reference=f"Clinical Trial: {trial['title']} (NCT{trial['nct_id']}), [https://clinicaltrials.gov/study/{trial['nct_id']}](https://clinicaltrials.gov/study/{trial['nct_id']})"
+                    )
+            else:
+                section.note("No results found from ClinicalTrials.gov.\n\n")
+            logger.info(f"Clinical Trials results: {trials_results}")
+        except Exception as e:
+            logger.error(f"Clinical Trials API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [ClinicalTrials.gov](https://clinicaltrials.gov).\n\n",
+                reference=f"ClinicalTrials.gov Search: {condition_terms} {treatment_terms}, [https://clinicaltrials.gov/search?term={urllib.parse.quote(condition_terms + ' ' + treatment_terms)}](https://clinicaltrials.gov/search?term={urllib.parse.quote(condition_terms + ' ' + treatment_terms)})"
+            )
+        return section
 
-            messages = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an expert medical query analyzer. Extract comprehensive keywords and set appropriate API flags:\n"
-                        "**Extract Keywords**: disease_keywords (conditions, syndromes), treatment_keywords (therapies, drugs, interventions), "
-                        "gene_symbols (APOE, BRCA1), variant_ids (rs numbers), phenotype_terms (symptoms, outcomes), "
-                        "protein_keywords (enzymes, biomarkers), sequence_keywords (DNA/RNA sequences), species (default: homo_sapiens)\n"
-                        "**Set API Flags**: need_trials (clinical studies), need_pubmed (research literature), need_ensembl (genomics), "
-                        "need_uniprot (proteins), need_genbank (sequences), need_protein_atlas, need_array_express, need_geo\n"
-                        "**Tools**: Use 'get_clinical_trials' for trial-only queries, 'get_research_and_trials' for comprehensive searches\n"
-                        "**Context**: Analyze chat history for follow-up questions - inherit relevant keywords from previous exchanges"
+    async def _pubmed_section(self, condition_terms, treatment_terms):
+        section = context_assembler.Section("pubmed", "## Research Papers\n\n")
+        search_query = f"{treatment_terms} {condition_terms}".strip()
+        try:
+            pubmed_results = await evidence.call(asearch_pubmed, search_query, api_key=os.getenv("PUBMED_API_KEY", ""), max_results=2)
+            if pubmed_results:
+                for paper in pubmed_results:
+                    section.add(
+                        f"**Title:** {paper['title']}\n"
+                        f"**PMID:** {paper['pmid']}\n"
+                        f"**Abstract:** {paper['abstract']}\n\n",
+                        reference=f"PubMed: {paper['title']} (PMID: {paper['pmid']}), [https://pubmed.ncbi.nlm.nih.gov/{paper['pmid']}](https://pubmed.ncbi.nlm.nih.gov/{paper['pmid']})"
                     )
-                }
-            ]
+            else:
+                section.note("No results found from PubMed.\n\n")
+            logger.info(f"PubMed results: {pubmed_results}")
+        except Exception as e:
+            logger.error(f"PubMed API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [PubMed](https://pubmed.ncbi.nlm.nih.gov).\n\n",
+                reference=f"PubMed Search: {condition_terms} {treatment_terms}, [https://pubmed.ncbi.nlm.nih.gov/?term={urllib.parse.quote(search_query)}](https://pubmed.ncbi.nlm.nih.gov/?term={urllib.parse.quote(search_query)})"
+            )
+        return section
+
+    async def _lookup_genes(self, species, gene_symbols):
+        gene_results = []
+        if len(gene_symbols) > 1:
+            # One POST for all symbols instead of a GET per symbol
+            gene_results = await evidence.call(self.ensembl_service.asearch_genes_by_symbols, species, gene_symbols)
+        elif gene_symbols:
+            gene_results = await evidence.call(self.ensembl_service.asearch_gene_by_symbol, species, gene_symbols[0])
+        logger.info(f"Ensembl gene results: {gene_results}")
+        return gene_results
+
+    async def _lookup_variants(self, species, variant_ids):
+        variant_results = []
+        if len(variant_ids) > 1:
+            variant_results = await evidence.call(self.ensembl_service.asearch_variants_consequences, species, variant_ids)
+        elif variant_ids:
+            variant_results = await evidence.call(self.ensembl_service.asearch_variant_consequences, species, variant_ids[0])
+        logger.info(f"Ensembl variant results: {variant_results}")
+        return variant_results
+
+    async def _lookup_phenotypes(self, species, gene_symbols):
+        phenotype_results = []
+        for results in await asyncio.gather(*(evidence.call(self.ensembl_service.asearch_phenotype_by_gene, species, gene_symbol) for gene_symbol in gene_symbols)):
+            phenotype_results.extend(results)
+        logger.info(f"Ensembl phenotype results: {phenotype_results}")
+        return phenotype_results
+
+    async def _ensembl_section(self, deps, gene_symbols, condition_terms):
+        section = context_assembler.Section("ensembl", "## Genomic Information\n\n")
+        try:
+            failed = [name for name in ("ensembl_genes", "ensembl_variants", "ensembl_phenotypes") if name not in deps]
+            if failed:
+                raise Exception(f"lookups failed: {', '.join(failed)}")
+
+            for gene in deps["ensembl_genes"] or []:
+                section.add(
+                    f"**Gene:** {gene['symbol']} ({gene['id']})\n"
+                    f"**Description:** {gene['description']}\n"
+                    f"**Biotype:** {gene['biotype']}\n"
+                    f"**Location:** {gene['chromosome']}:{gene['start']}-{gene['end']} ({gene['strand']})\n\n",
+                    reference=f"Ensembl: {gene['symbol']} ({gene['id']}), [https://ensembl.org/Homo_sapiens/Gene/Summary?g={gene['id']}](https://ensembl.org/Homo_sapiens/Gene/Summary?g={gene['id']})"
+                )
+
+            for variant in deps["ensembl_variants"] or []:
+                section.add(
+                    f"**Variant:** {variant['variant_id']}\n"
+                    f"**Gene:** {variant['gene_symbol']}\n"
+                    f"**Transcript:** {variant['transcript_id']}\n"
+                    f"**Consequences:** {', '.join(variant['consequence_terms'])}\n"
+                    f"**Impact:** {variant['impact']}\n\n",
+                    reference=f"Ensembl Variant: {variant['variant_id']}, [https://ensembl.org/Homo_sapiens/Variation/Explore?v={variant['variant_id']}]https://ensembl.org/Homo_sapiens/Variation/Explore?v={variant['variant_id']})",
+                    heading="## Variant Consequences\n\n"
+                )
+
+            for p in deps["ensembl_phenotypes"] or []:
+                section.add(
+                    f"**Gene:** {p['gene_symbol']}\n"
+                    f"**Phenotype:** {p['phenotype_description']}\n"
+                    f"**Source:** {p['source']}\n"
+                    f"**Study:** {p['study']}\n\n",
+                    reference=f"Ensembl Phenotype: {p['gene_symbol']} - {p['phenotype_description']}, [{p['source']}]({p['source']})",
+                    heading="## Phenotype Annotations\n\n"
+                )
+        except Exception as e:
+            logger.error(f"Ensembl API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [Ensembl](https://ensembl.org).\n\n",
+                reference=f"Ensembl Search: {gene_symbols[0] if gene_symbols else condition_terms}, [https://ensembl.org](https://ensembl.org)"
+            )
+        return section
+
+    async def _uniprot_section(self, protein_terms, species):
+        section = context_assembler.Section("uniprot", "## Protein Information (UniProt)\n\n")
+        try:
+            uniprot_query = f"{protein_terms} {species}".strip()
+            uniprot_results = await evidence.call(self.uniprot_service.asearch_uniprot, uniprot_query, max_results=3)
+            for protein in uniprot_results or []:
+                section.add(
+                    f"**Accession:** {protein['accession']}\n"
+                    f"**Protein Name:** {protein['protein_name']}\n"
+                    f"**Organism:** {protein['organism']}\n"
+                    f"**Function:** {protein.get('function', 'Not specified')}\n\n",
+                    reference=f"UniProt: {protein['protein_name']} ({protein['accession']}), [https://uniprot.org/uniprot/{protein['accession']}](https://uniprot.org/uniprot/{protein['accession']})"
+                )
+            logger.info(f"UniProt results: {uniprot_results}")
+        except Exception as e:
+            logger.error(f"UniProt API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [UniProt](https://uniprot.org).\n\n",
+                reference=f"UniProt Search: {protein_terms}, [https://uniprot.org](https://uniprot.org)"
+            )
+        return section
 
-            if chat_history:
-                chat_history = self.trim_chat_history(chat_history, max_tokens=1500)  # Conservative limit for analyze_query
-                messages.extend(chat_history)
-            messages.append({"role": "user", "content": user_query})
+    async def _protein_atlas_section(self, deps, args, protein_terms, species, condition_terms):
+        section = context_assembler.Section("protein_atlas", "## Protein Information (HPA)\n\n")
+        try:
+            protein_atlas_results = []
+            # Reuse the Ensembl gene lookup instead of resolving the symbols again
+            genes = deps.get("ensembl_genes", [])
+            for results in await asyncio.gather(*(evidence.call(self.protein_atlas_service.asearch_protein_atlas, "", max_results=1, ensembl_id=gene.get('id')) for gene in genes)):
+                protein_atlas_results.extend(results)
+            if args.get("protein_keywords") and not protein_atlas_results:
+                protein_query = f"{protein_terms} {species}".strip()
+                results = await evidence.call(self.protein_atlas_service.asearch_protein_atlas, protein_query, max_results=3)
+                protein_atlas_results.extend(results)
+            for protein in protein_atlas_results:
+                section.add(
+                    f"**Gene:** {protein['gene']}\n"
+                    f"**Ensembl ID:** {protein['ensembl_id']}\n"
+                    f"**Tissue Expression:** {protein['tissue_expression']}\n"
+                    f"**Pathology:** {protein['pathology']}\n"
+                    f"**Subcellular Location:** {protein['subcellular_location']}\n\n",
+                    reference=f"Protein Atlas: {protein['gene']} ({protein['ensembl_id']}), [https://proteinatlas.org/{protein['ensembl_id']}](https://proteinatlas.org/{protein['ensembl_id']})"
+                )
+            logger.info(f"Protein Atlas results: {protein_atlas_results}")
+        except Exception as e:
+            logger.error(f"Protein Atlas API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [Protein Atlas](https://proteinatlas.org).\n\n",
+                reference=f"Protein Atlas Search: {protein_terms or args['gene_symbols'][0] if args.get('gene_symbols') else condition_terms}, [https://proteinatlas.org](https://proteinatlas.org)"
+            )
+        return section
 
-            logger.debug(f"Messages sent to OpenAI: {messages}")
+    async def _array_express_section(self, args, condition_terms):
+        section = context_assembler.Section("array_express", "## Study Information (ArrayExpress)\n\n")
+        try:
+            array_express_results = []
+            terms = (args.get("protein_keywords") or []) + (args.get("gene_symbols") or [])
+            for results in await asyncio.gather(*(evidence.call(self.array_express_service.asearch_array_express, term, max_results=2) for term in terms)):
+                array_express_results.extend(results)
+            if not array_express_results:
+                results = await evidence.call(self.array_express_service.asearch_array_express, condition_terms, max_results=3)
+                array_express_results.extend(results)
+            for study in array_express_results:
+                section.add(
+                    f"**Accession:** {study['accession']}\n"
+                    f"**Title:** {study['title']}\n"
+                    f"**Assay Count:** {study['assay_count']}\n"
+                    f"**Study Type:** {study['study_type']}\n"
+                    f"**Description:** {study['description']}\n\n",
+                    reference=f"ArrayExpress: {study['title']} ({study['accession']}), [https://ebi.ac.uk/arrayexpress/experiments/{study['accession']}](https://ebi.ac.uk/arrayexpress/experiments/{study['accession']})"
+                )
+            logger.info(f"ArrayExpress results: {array_express_results}")
+        except Exception as e:
+            logger.error(f"ArrayExpress API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [ArrayExpress](https://ebi.ac.uk/arrayexpress).\n\n",
+                reference=f"ArrayExpress Search: {condition_terms}, [https://ebi.ac.uk/arrayexpress](https://ebi.ac.uk/arrayexpress)"
+            )
+        return section
 
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=messages,
-                tools=self.analyze_tools,
-                temperature=0.7
+    async def _geo_section(self, args, condition_terms):
+        section = context_assembler.Section("geo", "## Study Information (GEO)\n\n")
+        try:
+            geo_results = []
+            terms = (args.get("protein_keywords") or []) + (args.get("gene_symbols") or [])
+            for results in await asyncio.gather(*(evidence.call(self.geo_service.asearch_geo, term, max_results=2) for term in terms)):
+                geo_results.extend(results)
+            if not geo_results:
+                results = await evidence.call(self.geo_service.asearch_geo, condition_terms, max_results=3)
+                geo_results.extend(results)
+            for study in geo_results:
+                section.add(
+                    f"**Accession:** {study['accession']}\n"
+                    f"**Title:** {study['title']}\n"
+                    f"**Sample Count:** {study['sample_count']}\n"
+                    f"**Study Type:** {study['study_type']}\n"
+                    f"**Summary:** {study['summary']}\n\n",
+                    reference=f"GEO: {study['title']} ({study['accession']}), [https://ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={study['accession']}](https://ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={study['accession']})"
+                )
+            logger.info(f"GEO results: {geo_results}")
+        except Exception as e:
+            logger.error(f"GEO API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [GEO](https://ncbi.nlm.nih.gov/geo).\n\n",
+                reference=f"GEO Search: {condition_terms}, [https://ncbi.nlm.nih.gov/geo](https://ncbi.nlm.nih.gov/geo)"
             )
+        return section
 
-            if response.choices[0].message.tool_calls:
-                tool_call = response.choices[0].message.tool_calls[0]
-                tool_name = tool_call.function.name
-                args = json.loads(tool_call.function.arguments)
-                logger.info(f"Tool call: {tool_name}, Arguments: {args}")
-
-                # Initialize common terms
-                condition_terms = " OR ".join([self.normalize_query_terms(k) for k in args["disease_keywords"]]) if args["disease_keywords"] else ""
-                treatment_terms = " OR ".join(args["treatment_keywords"]) if args["treatment_keywords"] else ""
-
-                # Initialize tool-specific terms
-                protein_terms = ""
-                sequence_terms = ""
-                species = "homo_sapiens"  # Default species
-                if tool_name == "get_research_and_trials":
-                    protein_terms = " OR ".join(args["protein_keywords"]) if args.get("protein_keywords") else ""
-                    sequence_terms = " OR ".join(args["sequence_keywords"]) if args.get("sequence_keywords") else ""
-                    species = args.get("species", "homo_sapiens")
-
-                if tool_name == "get_clinical_trials" and args.get("need_trials"):
-                    try:
+    async def _genbank_section(self, sequence_terms, species):
+        section = context_assembler.Section("genbank", "## Sequence Information\n\n")
+        try:
+            genbank_query = f"{sequence_terms} {species}".strip()
+            genbank_results = await evidence.call(self.genbank_service.asearch_genbank, genbank_query, max_results=3)
+            for sequence in genbank_results or []:
+                section.add(
+                    f"**Accession:** {sequence['accession']}\n"
+                    f"**Definition:** {sequence['definition']}\n"
+                    f"**Organism:** {sequence['organism']}\n\n",
+                    reference=f"GenBank: {sequence['definition']} ({sequence['accession']}), [https://ncbi.nlm.nih.gov/nuccore/{sequence['accession']}](https://ncbi.nlm.nih.gov/nuccore/{sequence['accession']})"
+                )
+            logger.info(f"GenBank results: {genbank_results}")
+        except Exception as e:
+            logger.error(f"GenBank API failed: {str(e)}")
+            section.note(
+                "No results found. Try searching [GenBank](https://ncbi.nlm.nih.gov/genbank).\n\n",
+                reference=f"GenBank Search: {sequence_terms}, [https://ncbi.nlm.nih.gov/genbank](https://ncbi.nlm.nih.gov/genbank)"
+            )
+        return section
+
+    def analyze_query(self, user_query, chat_history=None, budget=None):
+        """Blocking wrapper around aanalyze_query for sync callers."""
+        return async_to_sync(self.aanalyze_query)(user_query, chat_history, budget)
+
+    async def aanalyze_query(self, user_query, chat_history=None, budget=None):
+        """
+        Args:
+            budget: Seconds the whole turn may take, None for no limit. Source lookups
+                get what is left after routing, minus CHAT_TURN_BUDGET['GENERATION_RESERVE'];
+                sources still running then are cancelled and the answer uses what arrived.
+        Returns:
+            The complete answer, references included.
+        """
+        parts = []
+        async for event, data in self.astream_query(user_query, chat_history, budget):
+            if event == "token":
+                parts.append(data["text"])
+            elif event == "error":
+                parts.append(data["message"])
+        return "".join(parts)
+
+    async def astream_query(self, user_query, chat_history=None, budget=None):
+        """
+        Run a chat turn, yielding (event, data) pairs as it progresses:
+            ("stage", {"stage"}): "analyzing", "searching" (with "sources") or "writing"
+            ("source", {"source", "label", "status"}): a lookup "started", "finished", "failed" or "timed_out"
+            ("token", {"text"}): the next chunk of the answer
+            ("error", {"message"}): the turn failed, nothing follows
+        Joining the token texts gives what aanalyze_query returns, which ends with
+        the error message instead when the turn failed.
+        """
+        with deadline.Deadline(budget), metrics.timer("chat_stage_seconds", stage="turn"):
+            async for event in self._turn_events(user_query, chat_history):
+                yield event
+
+    async def _turn_events(self, user_query, chat_history=None):
+        try:
+            yield "stage", {"stage": "analyzing"}
+            apis_called = []
+
+            logger.info(f"Processing query: {user_query}")
+            logger.info(f"Chat history: {chat_history}")
+
+            # Memoize service calls for the whole turn so no (source, args) pair hits the network twice,
+            # and so lookups prefetched during routing are picked up by the source tasks
+            with evidence.EvidenceContext() as turn_evidence:
+                routing_started = time.perf_counter()
+                # Timed without becoming the parent: prefetches started here outlive it
+                routing_span = tracing.span("routing")
+                # Clear-cut queries are routed locally, the model only sees ambiguous ones and follow-ups
+                tool_name, args = query_analyzer.analyze(user_query, chat_history)
+                routing_span.set(path="local" if tool_name else "llm")
+                if tool_name:
+                    query_analyzer.record_path("local")
+                    logger.info(f"Local analyzer: {tool_name}, Arguments: {args}")
+                else:
+                    query_analyzer.record_path("llm")
+                    # The obvious entities are known before the model answers, start their lookups now
+                    for fn, fn_args, fn_kwargs in self._leaf_calls(*query_analyzer.speculate(user_query)):
+                        turn_evidence.prefetch(fn, *fn_args, **fn_kwargs)
+
+                    messages = [
+                        {
+                            "role": "system",
+                            "content": (
+                                "You are an expert medical query analyzer. Extract comprehensive keywords and set appropriate API flags:\n"
+                                "**Extract Keywords**: disease_keywords (conditions, syndromes), treatment_keywords (therapies, drugs, interventions), "
+                                "gene_symbols (APOE, BRCA1), variant_ids (rs numbers), phenotype_terms (symptoms, outcomes), "
+                                "protein_keywords (enzymes, biomarkers), sequence_keywords (DNA/RNA sequences), species (default: homo_sapiens)\n"
+                                "**Set API Flags**: need_trials (clinical studies), need_pubmed (research literature), need_ensembl (genomics), "
+                                "need_uniprot (proteins), need_genbank (sequences), need_protein_atlas, need_array_express, need_geo\n"
+                                "**Tools**: Use 'get_clinical_trials' for trial-only queries, 'get_research_and_trials' for comprehensive searches\n"
+                                "**Context**: Analyze chat history for follow-up questions - inherit relevant keywords from previous exchanges"
+                            )
+                        }
+                    ]
+
+                    if chat_history:
+                        chat_history = self.trim_chat_history(chat_history, max_tokens=settings.CHAT_CONTEXT['ROUTING_HISTORY_TOKENS'])
+                        messages.extend(chat_history)
+                    messages.append({"role": "user", "content": user_query})
+
+                    logger.debug(f"Messages sent to OpenAI: {messages}")
+
+                    with tracing.span("openai routing", model="gpt-4") as span:
+                        response = await self.async_client.chat.completions.create(
+                            model="gpt-4",
+                            messages=messages,
+                            tools=self.analyze_tools,
+                            temperature=0.7,
+                            timeout=self._llm_timeout()
+                        )
+                        if response.usage:
+                            span.set(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+                    metrics.record_openai_usage("gpt-4", "routing", response.usage)
+
+                    if response.choices[0].message.tool_calls:
+                        tool_call = response.choices[0].message.tool_calls[0]
+                        tool_name = tool_call.function.name
+                        args = json.loads(tool_call.function.arguments)
+                        logger.info(f"Tool call: {tool_name}, Arguments: {args}")
+
+                turn_evidence.drop_prefetches(keep=self._leaf_calls(tool_name, args))
+                metrics.observe("chat_stage_seconds", time.perf_counter() - routing_started, stage="routing")
+                routing_span.set(tool=tool_name)
+                routing_span.end()
+
+                if tool_name:
+                    # Initialize common terms
+                    condition_terms, treatment_terms = self._search_terms(args)
+
+                    # Initialize tool-specific terms
+                    protein_terms = ""
+                    sequence_terms = ""
+                    species = "homo_sapiens"  # Default species
+                    if tool_name == "get_research_and_trials":
+                        protein_terms = " OR ".join(args["protein_keywords"]) if args.get("protein_keywords") else ""
+                        sequence_terms = " OR ".join(args["sequence_keywords"]) if args.get("sequence_keywords") else ""
+                        species = args.get("species", "homo_sapiens")
+
+                    # Every source runs as its own task; sections are assembled in registration order
+                    scheduler = SourceScheduler()
+                    sections = []
+
+                    if tool_name == "get_clinical_trials" and args.get("need_trials"):
                         apis_called.append("Clinical Trials")
-                        trials_results = search_clinical_trials(condition_terms, treatment_terms, max_results=3)
-                        if trials_results:
-                            combined_info += "## Clinical Trials\n\n"
-                            for trial in trials_results:
-                                combined_info += f"**Title:** {trial['title']}\n"
-                                combined_info += f"**Status:** {trial['status']}\n"
-                                combined_info += f"**Phase:** {trial.get('phase', 'Not specified')}\n"
-                                combined_info += f"**Interventions:** {', '.join(trial.get('interventions', ['Not specified']))}\n"
-                                combined_info += f"**Description:** {self.truncate_content(trial.get('description', 'No description available'), 300)}\n"
-                                combined_info += f"**NCT ID:** {trial['nct_id']}\n\n"
-                                references.append(f"Clinical Trial: {trial['title']} (NCT{trial['nct_id']}), [https://clinicaltrials.gov/study/{trial['nct_id']}](https://clinicaltrials.gov/study/{trial['nct_id']})")
-                        else:
-                            combined_info += "## Clinical Trials\n\nNo results found from ClinicalTrials.gov.\n\n"
-                        logger.info(f"Clinical Trials results: {trials_results}")
-                    except Exception as e:
-                        logger.error(f"Clinical Trials API failed: {str(e)}")
-                        combined_info += "## Clinical Trials\n\nNo results found. Try searching [ClinicalTrials.gov](https://clinicaltrials.gov).\n\n"
-                        references.append(f"ClinicalTrials.gov Search: {condition_terms} {treatment_terms}, [https://clinicaltrials.gov/search?term={urllib.parse.quote(condition_terms + ' ' + treatment_terms)}](https://clinicaltrials.gov/search?term={urllib.parse.quote(condition_terms + ' ' + treatment_terms)})")
-
-                elif tool_name == "get_research_and_trials":
-                    if args.get("need_pubmed"):
-                        try:
+                        scheduler.add("trials", lambda deps: self._trials_section(condition_terms, treatment_terms))
+                        sections.append("trials")
+
+                    elif tool_name == "get_research_and_trials":
+                        gene_symbols = args.get("gene_symbols") or []
+
+                        if args.get("need_pubmed"):
                             apis_called.append("PubMed")
-                            search_query = f"{treatment_terms} {condition_terms}".strip()
-                            pubmed_results = search_pubmed(search_query, api_key=os.getenv("PUBMED_API_KEY", ""), max_results=2)
-                            if pubmed_results:
-                                combined_info += "## Research Papers\n\n"
-                                for paper in pubmed_results:
-                                    combined_info += f"**Title:** {paper['title']}\n"
-                                    combined_info += f"**Abstract:** {self.truncate_content(paper['abstract'], 400)}\n"
-                                    combined_info += f"**PMID:** {paper['pmid']}\n\n"
-                                    references.append(f"PubMed: {paper['title']} (PMID: {paper['pmid']}), [https://pubmed.ncbi.nlm.nih.gov/{paper['pmid']}](https://pubmed.ncbi.nlm.nih.gov/{paper['pmid']})")
-                            else:
-                                combined_info += "## Research Papers\n\nNo results found from PubMed.\n\n"
-                            logger.info(f"PubMed results: {pubmed_results}")
-                        except Exception as e:
-                            logger.error(f"PubMed API failed: {str(e)}")
-                            combined_info += "## Research Papers\n\nNo results found. Try searching [PubMed](https://pubmed.ncbi.nlm.nih.gov).\n\n"
-                            references.append(f"PubMed Search: {condition_terms} {treatment_terms}, [https://pubmed.ncbi.nlm.nih.gov/?term={urllib.parse.quote(search_query)}](https://pubmed.ncbi.nlm.nih.gov/?term={urllib.parse.quote(search_query)})")
-
-                    if args.get("need_trials"):
-                        try:
+                            scheduler.add("pubmed", lambda deps: self._pubmed_section(condition_terms, treatment_terms))
+                            sections.append("pubmed")
+
+                        if args.get("need_trials"):
                             apis_called.append("Clinical Trials")
-                            trials_results = search_clinical_trials(condition_terms, treatment_terms, max_results=3)
-                            if trials_results:
-                                combined_info += "## Clinical Trials\n\n"
-                                for trial in trials_results:
-                                    combined_info += f"**Title:** {trial['title']}\n"
-                                    combined_info += f"**Status:** {trial['status']}\n"
-                                    combined_info += f"**Phase:** {trial.get('phase', 'Not specified')}\n"
-                                    combined_info += f"**Interventions:** {', '.join(trial.get('interventions', ['Not specified']))}\n"
-                                    combined_info += f"**Description:** {self.truncate_content(trial.get('description', 'No description available'), 300)}\n"
-                                    combined_info += f"**NCT ID:** {trial['nct_id']}\n\n"
-                                    references.append(f"Clinical Trial: {trial['title']} (NCT{trial['nct_id']}), [https://clinicaltrials.gov/study/{trial['nct_id']}](https://clinicaltrials.gov/study/{trial['nct_id']})")
-                            else:
-                                combined_info += "## Clinical Trials\n\nNo results found from ClinicalTrials.gov.\n\n"
-                            logger.info(f"Clinical Trials results: {trials_results}")
-                        except Exception as e:
-                            logger.error(f"Clinical Trials API failed: {str(e)}")
-                            combined_info += "## Clinical Trials\n\nNo results found. Try searching [ClinicalTrials.gov](https://clinicaltrials.gov).\n\n"
-                            references.append(f"ClinicalTrials.gov Search: {condition_terms} {treatment_terms}, [https://clinicaltrials.gov/search?term={urllib.parse.quote(condition_terms + ' ' + treatment_terms)}](https://clinicaltrials.gov/search?term={urllib.parse.quote(condition_terms + ' ' + treatment_terms)})")
-
-                    if args.get("need_ensembl") and (args.get("gene_symbols") or args.get("variant_ids") or args.get("phenotype_terms")):
-                        try:
+                            scheduler.add("trials", lambda deps: self._trials_section(condition_terms, treatment_terms))
+                            sections.append("trials")
+
+                        if args.get("need_ensembl") and (args.get("gene_symbols") or args.get("variant_ids") or args.get("phenotype_terms")):
                             apis_called.append("Ensembl")
-                            gene_results = []
-                            for symbol in args["gene_symbols"]:
-                                gene_results.extend(self.ensembl_service.search_gene_by_symbol(species, symbol))
-                            if gene_results:
-                                combined_info += "## Genomic Information\n\n"
-                                for gene in gene_results:
-                                    combined_info += f"**Gene:** {gene['symbol']} ({gene['id']})\n"
-                                    combined_info += f"**Description:** {gene['description']}\n"
-                                    combined_info += f"**Biotype:** {gene['biotype']}\n"
-                                    combined_info += f"**Location:** {gene['chromosome']}:{gene['start']}-{gene['end']} ({gene['strand']})\n\n"
-                                    references.append(f"Ensembl: {gene['symbol']} ({gene['id']}), [https://ensembl.org/Homo_sapiens/Gene/Summary?g={gene['id']}](https://ensembl.org/Homo_sapiens/Gene/Summary?g={gene['id']})")
-                            logger.info(f"Ensembl gene results: {gene_results}")
-
-                            variant_results = []
-                            for variant_id in args["variant_ids"]:
-                                variant_results.extend(self.ensembl_service.search_variant_consequences(species, variant_id))
-                            if variant_results:
-                                combined_info += "## Variant Consequences\n\n"
-                                for variant in variant_results:
-                                    combined_info += f"**Variant:** {variant['variant_id']}\n"
-                                    combined_info += f"**Gene:** {variant['gene_symbol']}\n"
-                                    combined_info += f"**Transcript:** {variant['transcript_id']}\n"
-                                    combined_info += f"**Consequences:** {', '.join(variant['consequence_terms'])}\n"
-                                    combined_info += f"**Impact:** {variant['impact']}\n\n"
-                                    references.append(f"Ensembl Variant: {variant['variant_id']}, [https://ensembl.org/Homo_sapiens/Variation/Explore?v={variant['variant_id']}]https://ensembl.org/Homo_sapiens/Variation/Explore?v={variant['variant_id']})")
-                            logger.info(f"Ensembl variant results: {variant_results}")
-
-                            phenotype_results = []
-                            for gene_symbol in args["gene_symbols"]:
-                                phenotype_results.extend(self.ensembl_service.search_phenotype_by_gene(species, gene_symbol))
-                            if phenotype_results:
-                                combined_info += "## Phenotype Annotations\n\n"
-                                for p in phenotype_results:
-                                    combined_info += f"**Gene:** {p['gene_symbol']}\n"
-                                    combined_info += f"**Phenotype:** {p['phenotype_description']}\n"
-                                    combined_info += f"**Source:** {p['source']}\n"
-                                    combined_info += f"**Study:** {p['study']}\n\n"
-                                    references.append(f"Ensembl Phenotype: {p['gene_symbol']} - {p['phenotype_description']}, [{p['source']}]({p['source']})")
-                            logger.info(f"Ensembl phenotype results: {phenotype_results}")
-                        except Exception as e:
-                            logger.error(f"Ensembl API failed: {str(e)}")
-                            combined_info += "## Genomic Information\n\nNo results found. Try searching [Ensembl](https://ensembl.org).\n\n"
-                            references.append(f"Ensembl Search: {args['gene_symbols'][0] if args.get('gene_symbols') else condition_terms}, [https://ensembl.org](https://ensembl.org)")
-
-                    if args.get("need_uniprot") and args.get("protein_keywords"):
-                        try:
+                            scheduler.add("ensembl_genes", lambda deps: self._lookup_genes(species, gene_symbols))
+                            scheduler.add("ensembl_variants", lambda deps: self._lookup_variants(species, args.get("variant_ids") or []))
+                            scheduler.add("ensembl_phenotypes", lambda deps: self._lookup_phenotypes(species, gene_symbols))
+                            scheduler.add(
+                                "ensembl",
+                                lambda deps: self._ensembl_section(deps, gene_symbols, condition_terms),
+                                depends_on=("ensembl_genes", "ensembl_variants", "ensembl_phenotypes")
+                            )
+                            sections.append("ensembl")
+
+                        if args.get("need_uniprot") and args.get("protein_keywords"):
                             apis_called.append("UniProt")
-                            uniprot_query = f"{protein_terms} {species}".strip()
-                            uniprot_results = self.uniprot_service.search_uniprot(uniprot_query, max_results=3)
-                            if uniprot_results:
-                                combined_info += "## Protein Information (UniProt)\n\n"
-                                for protein in uniprot_results:
-                                    combined_info += f"**Accession:** {protein['accession']}\n"
-                                    combined_info += f"**Protein Name:** {protein['protein_name']}\n"
-                                    combined_info += f"**Organism:** {protein['organism']}\n"
-                                    combined_info += f"**Function:** {protein.get('function', 'Not specified')}\n\n"
-                                    references.append(f"UniProt: {protein['protein_name']} ({protein['accession']}), [https://uniprot.org/uniprot/{protein['accession']}](https://uniprot.org/uniprot/{protein['accession']})")
-                            logger.info(f"UniProt results: {uniprot_results}")
-                        except Exception as e:
-                            logger.error(f"UniProt API failed: {str(e)}")
-                            combined_info += "## Protein Information (UniProt)\n\nNo results found. Try searching [UniProt](https://uniprot.org).\n\n"
-                            references.append(f"UniProt Search: {protein_terms}, [https://uniprot.org](https://uniprot.org)")
-
-                    if args.get("need_protein_atlas") and (args.get("protein_keywords") or args.get("gene_symbols")):
-                        try:
+                            scheduler.add("uniprot", lambda deps: self._uniprot_section(protein_terms, species))
+                            sections.append("uniprot")
+
+                        if args.get("need_protein_atlas") and (args.get("protein_keywords") or args.get("gene_symbols")):
                             apis_called.append("Protein Atlas")
-                            protein_atlas_results = []
-                            if args.get("gene_symbols"):
-                                for symbol in args["gene_symbols"]:
-                                    ensembl_results = self.ensembl_service.search_gene_by_symbol(species, symbol)
-                                    for gene in ensembl_results:
-                                        ensembl_id = gene.get('id')
-                                        results = self.protein_atlas_service.search_protein_atlas("", max_results=1, ensembl_id=ensembl_id)
-                                        protein_atlas_results.extend(results)
-                            if args.get("protein_keywords") and not protein_atlas_results:
-                                protein_query = f"{protein_terms} {species}".strip()
-                                results = self.protein_atlas_service.search_protein_atlas(protein_query, max_results=3)
-                                protein_atlas_results.extend(results)
-                            if protein_atlas_results:
-                                combined_info += "## Protein Information (HPA)\n\n"
-                                for protein in protein_atlas_results:
-                                    combined_info += f"**Gene:** {protein['gene']}\n"
-                                    combined_info += f"**Ensembl ID:** {protein['ensembl_id']}\n"
-                                    combined_info += f"**Tissue Expression:** {protein['tissue_expression']}\n"
-                                    combined_info += f"**Pathology:** {protein['pathology']}\n"
-                                    combined_info += f"**Subcellular Location:** {protein['subcellular_location']}\n\n"
-                                    references.append(f"Protein Atlas: {protein['gene']} ({protein['ensembl_id']}), [https://proteinatlas.org/{protein['ensembl_id']}](https://proteinatlas.org/{protein['ensembl_id']})")
-                            logger.info(f"Protein Atlas results: {protein_atlas_results}")
-                        except Exception as e:
-                            logger.error(f"Protein Atlas API failed: {str(e)}")
-                            combined_info += "## Protein Information (HPA)\n\nNo results found. Try searching [Protein Atlas](https://proteinatlas.org).\n\n"
-                            references.append(f"Protein Atlas Search: {protein_terms or args['gene_symbols'][0] if args.get('gene_symbols') else condition_terms}, [https://proteinatlas.org](https://proteinatlas.org)")
-
-                    if args.get("need_array_express") and (args.get("protein_keywords") or args.get("gene_symbols") or "biomarkers" in user_query.lower() or "studies" in user_query.lower()):
-                        try:
+                            # Protein Atlas is keyed by Ensembl gene IDs, so it waits on the gene lookup
+                            depends_on = ()
+                            if gene_symbols:
+                                if "ensembl_genes" not in scheduler.tasks:
+                                    scheduler.add("ensembl_genes", lambda deps: self._lookup_genes(species, gene_symbols))
+                                depends_on = ("ensembl_genes",)
+                            scheduler.add(
+                                "protein_atlas",
+                                lambda deps: self._protein_atlas_section(deps, args, protein_terms, species, condition_terms),
+                                depends_on=depends_on
+                            )
+                            sections.append("protein_atlas")
+
+                        if args.get("need_array_express") and (args.get("protein_keywords") or args.get("gene_symbols") or "biomarkers" in user_query.lower() or "studies" in user_query.lower()):
                             apis_called.append("ArrayExpress")
-                            array_express_results = []
-                            if args.get("protein_keywords"):
-                                for protein in args["protein_keywords"]:
-                                    results = self.array_express_service.search_array_express(protein, max_results=2)
-                                    array_express_results.extend(results)
-                            if args.get("gene_symbols"):
-                                for symbol in args["gene_symbols"]:
-                                    results = self.array_express_service.search_array_express(symbol, max_results=2)
-                                    array_express_results.extend(results)
-                            if not array_express_results:
-                                results = self.array_express_service.search_array_express(condition_terms, max_results=3)
-                                array_express_results.extend(results)
-                            if array_express_results:
-                                combined_info += "## Study Information (ArrayExpress)\n\n"
-                                for study in array_express_results:
-                                    combined_info += f"**Accession:** {study['accession']}\n"
-                                    combined_info += f"**Title:** {study['title']}\n"
-                                    combined_info += f"**Description:** {study['description']}\n"
-                                    combined_info += f"**Assay Count:** {study['assay_count']}\n"
-                                    combined_info += f"**Study Type:** {study['study_type']}\n\n"
-                                    references.append(f"ArrayExpress: {study['title']} ({study['accession']}), [https://ebi.ac.uk/arrayexpress/experiments/{study['accession']}](https://ebi.ac.uk/arrayexpress/experiments/{study['accession']})")
-                            logger.info(f"ArrayExpress results: {array_express_results}")
-                        except Exception as e:
-                            logger.error(f"ArrayExpress API failed: {str(e)}")
-                            combined_info += "## Study Information (ArrayExpress)\n\nNo results found. Try searching [ArrayExpress](https://ebi.ac.uk/arrayexpress).\n\n"
-                            references.append(f"ArrayExpress Search: {condition_terms}, [https://ebi.ac.uk/arrayexpress](https://ebi.ac.uk/arrayexpress)")
-
-                    if args.get("need_geo") and (args.get("protein_keywords") or args.get("gene_symbols") or "biomarkers" in user_query.lower() or "studies" in user_query.lower()):
-                        try:
+                            scheduler.add("array_express", lambda deps: self._array_express_section(args, condition_terms))
+                            sections.append("array_express")
+
+                        if args.get("need_geo") and (args.get("protein_keywords") or args.get("gene_symbols") or "biomarkers" in user_query.lower() or "studies" in user_query.lower()):
                             apis_called.append("GEO")
-                            geo_results = []
-                            if args.get("protein_keywords"):
-                                for protein in args["protein_keywords"]:
-                                    results = self.geo_service.search_geo(protein, max_results=2)
-                                    geo_results.extend(results)
-                            if args.get("gene_symbols"):
-                                for symbol in args["gene_symbols"]:
-                                    results = self.geo_service.search_geo(symbol, max_results=2)
-                                    geo_results.extend(results)
-                            if not geo_results:
-                                results = self.geo_service.search_geo(condition_terms, max_results=3)
-                                geo_results.extend(results)
-                            if geo_results:
-                                combined_info += "## Study Information (GEO)\n\n"
-                                for study in geo_results:
-                                    combined_info += f"**Accession:** {study['accession']}\n"
-                                    combined_info += f"**Title:** {study['title']}\n"
-                                    combined_info += f"**Summary:** {study['summary']}\n"
-                                    combined_info += f"**Sample Count:** {study['sample_count']}\n"
-                                    combined_info += f"**Study Type:** {study['study_type']}\n\n"
-                                    references.append(f"GEO: {study['title']} ({study['accession']}), [https://ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={study['accession']}](https://ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={study['accession']})")
-                            logger.info(f"GEO results: {geo_results}")
-                        except Exception as e:
-                            logger.error(f"GEO API failed: {str(e)}")
-                            combined_info += "## Study Information (GEO)\n\nNo results found. Try searching [GEO](https://ncbi.nlm.nih.gov/geo).\n\n"
-                            references.append(f"GEO Search: {condition_terms}, [https://ncbi.nlm.nih.gov/geo](https://ncbi.nlm.nih.gov/geo)")
-
-                    if args.get("need_genbank") and args.get("sequence_keywords"):
-                        try:
-                            apis_called.append("GenBank")
-                            genbank_query = f"{sequence_terms} {species}".strip()
-                            genbank_results = self.genbank_service.search_genbank(genbank_query, max_results=3)
-                            if genbank_results:
-                                combined_info += "## Sequence Information\n\n"
-                                for sequence in genbank_results:
-                                    combined_info += f"**Accession:** {sequence['accession']}\n"
-                                    combined_info += f"**Definition:** {sequence['definition']}\n"
-                                    combined_info += f"**Organism:** {sequence['organism']}\n\n"
-                                    references.append(f"GenBank: {sequence['definition']} ({sequence['accession']}), [https://ncbi.nlm.nih.gov/nuccore/{sequence['accession']}](https://ncbi.nlm.nih.gov/nuccore/{sequence['accession']})")
-                            logger.info(f"GenBank results: {genbank_results}")
-                        except Exception as e:
-                            logger.error(f"GenBank API failed: {str(e)}")
-                            combined_info += "## Sequence Information\n\nNo results found. Try searching [GenBank](https://ncbi.nlm.nih.gov/genbank).\n\n"
-                            references.append(f"GenBank Search: {sequence_terms}, [https://ncbi.nlm.nih.gov/genbank](https://ncbi.nlm.nih.gov/genbank)")
+                            scheduler.add("geo", lambda deps: self._geo_section(args, condition_terms))
+                            sections.append("geo")
 
+                        if args.get("need_genbank") and args.get("sequence_keywords"):
+                            apis_called.append("GenBank")
+                            scheduler.add("genbank", lambda deps: self._genbank_section(sequence_terms, species))
+                            sections.append("genbank")
+
+                    yield "stage", {"stage": "searching", "sources": apis_called}
+                    with deadline.Deadline(self._evidence_budget()), metrics.timer("chat_stage_seconds", stage="sources"), tracing.span("sources", sources=sections):
+                        progress = asyncio.Queue()
+                        run = asyncio.ensure_future(scheduler.run(
+                            timeout=deadline.remaining(),
+                            on_progress=lambda name, status: progress.put_nowait((name, status))
+                        ))
+                        run.add_done_callback(lambda _: progress.put_nowait(None))
+                        try:
+                            while (item := await progress.get()) is not None:
+                                name, status = item
+                                yield "source", {"source": name, "label": SOURCE_LABELS.get(name, name), "status": status}
+                            results, errors = run.result()
+                        finally:
+                            run.cancel()
+
+            if tool_name:
+                evidence_sections = [results[name] for name in sections if name in results]
                 logger.info(f"APIs Called: {', '.join(apis_called)}")
-                logger.info(f"Combined Info:\n{combined_info}")
 
-                if not combined_info.strip() or combined_info.strip() == "No relevant information found.":
+                yield "stage", {"stage": "writing"}
+                if not any(section.entries or section.notes for section in evidence_sections):
                     logger.info("No API data found, falling back to model knowledge.")
-                    response_text = self.generate_response(user_query, use_model_knowledge=True, chat_history=chat_history)
+                    chunks = self.astream_response(user_query, use_model_knowledge=True, chat_history=chat_history)
                 else:
-                    response_text = self.generate_response(user_query, combined_info, references, chat_history=chat_history)
+                    chunks = self.astream_response(user_query, evidence_sections, chat_history=chat_history)
+            else:
+                logger.info("No tool calls, using model knowledge.")
+                yield "stage", {"stage": "writing"}
+                chunks = self.astream_response(user_query, use_model_knowledge=True, chat_history=chat_history)
 
-                if chat_history is None:
-                    chat_history = []
-                chat_history.append({"role": "user", "content": user_query})
-                chat_history.append({"role": "assistant", "content": response_text})
+            async for chunk in chunks:
+                yield "token", {"text": chunk}
 
-                return response_text
+        except Exception as e:
+            logger.error(f"Query analysis failed: {str(e)}")
+            yield "error", {"message": f"An error occurred while processing the query: {str(e)}"}
+
+    def generate_response(self, user_query, sections=None, use_model_knowledge=False, chat_history=None):
+        """Blocking wrapper around agenerate_response for sync callers."""
+        return async_to_sync(self.agenerate_response)(user_query, sections, use_model_knowledge, chat_history)
+
+    async def agenerate_response(self, user_query, sections=None, use_model_knowledge=False, chat_history=None):
+        """
+        Args:
+            sections: context_assembler.Section objects with the evidence, fitted to the
+                prompt's token budget; only references of entries that fit are listed.
+        """
+        try:
+            messages, references = self._response_messages(user_query, sections, use_model_knowledge, chat_history)
 
-            logger.info("No tool calls, using model knowledge.")
-            response_text = self.generate_response(user_query, use_model_knowledge=True, chat_history=chat_history)
-            if chat_history is None:
-                chat_history = []
-            chat_history.append({"role": "user", "content": user_query})
-            chat_history.append({"role": "assistant", "content": response_text})
+            response = await self.async_client.chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                temperature=0.7,
+                max_tokens=settings.CHAT_CONTEXT['RESPONSE_TOKENS'],
+                timeout=self._llm_timeout()
+            )
 
-            return response_text
+            metrics.record_openai_usage("gpt-4", "answer", response.usage)
+            response_text = response.choices[0].message.content
+            return response_text + self._references_markdown(user_query, references, use_model_knowledge)
 
         except Exception as e:
-            logger.error(f"Query analysis failed: {str(e)}")
-            return f"An error occurred while processing the query: {str(e)}"
-    def generate_response(self, user_query, research_info=None, references=None, use_model_knowledge=False, chat_history=None):
+            logger.error(f"Response generation failed: {str(e)}")
+            raise Exception(f"Response generation failed: {str(e)}")
+
+    async def astream_response(self, user_query, sections=None, use_model_knowledge=False, chat_history=None):
+        """
+        Streaming variant of agenerate_response: yields the answer in chunks as the
+        model writes it, then the references section.
+        """
         try:
-            logger.info(f"Generating response for query: {user_query}")
-            logger.info(f"Research info: {research_info}")
-            logger.info(f"References: {references}")
-            logger.info(f"Use model knowledge: {use_model_knowledge} - {user_query}")
-            logger.info(f"Chat history length: {len(chat_history) if chat_history else 0}")
+            messages, references = self._response_messages(user_query, sections, use_model_knowledge, chat_history)
+
+            started = time.perf_counter()
+            first_token = True
+            with tracing.span("openai answer", model="gpt-4") as span:
+                stream = await self.async_client.chat.completions.create(
+                    model="gpt-4",
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=settings.CHAT_CONTEXT['RESPONSE_TOKENS'],
+                    timeout=self._llm_timeout(),
+                    stream=True,
+                    # The last chunk then carries the token usage, with no choices
+                    stream_options={"include_usage": True}
+                )
+                # The httpx timeout bounds each read, not the whole answer; the turn's deadline
+                # (plus the grace period) bounds the answer, whatever is written by then is kept
+                left = deadline.remaining()
+                stop_at = None if left is None else time.monotonic() + left + settings.CHAT_TURN_BUDGET.get("GENERATION_GRACE", 0)
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        if stop_at is None:
+                            chunk = await chunks.__anext__()
+                        else:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, stop_at - time.monotonic()))
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        await stream.close()
+                        logger.warning("Answer cut short at the turn deadline")
+                        span.set(cut_short=True)
+                        yield "\n\n*The answer was cut short to stay within the response time limit.*"
+                        break
+                    if chunk.usage:
+                        metrics.record_openai_usage("gpt-4", "answer", chunk.usage)
+                        span.set(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token:
+                            metrics.observe("chat_stage_seconds", time.perf_counter() - started, stage="first_token")
+                            span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                            first_token = False
+                        yield chunk.choices[0].delta.content
+            metrics.observe("chat_stage_seconds", time.perf_counter() - started, stage="generation")
+
+            yield self._references_markdown(user_query, references, use_model_knowledge)
 
-            messages = [
+        except Exception as e:
+            logger.error(f"Response generation failed: {str(e)}")
+            raise Exception(f"Response generation failed: {str(e)}")
+
+    def _response_messages(self, user_query, sections, use_model_knowledge, chat_history):
+        """
+        Returns:
+            Tuple (messages, references of the evidence that made it into the prompt).
+        """
+        logger.info(f"Generating response for query: {user_query}")
+        logger.info(f"Use model knowledge: {use_model_knowledge} - {user_query}")
+        logger.info(f"Chat history length: {len(chat_history) if chat_history else 0}")
+
+        messages = [
     {
         "role": "system",
         "content": (
@@ -571,44 +881,80 @@ class ChatGPTService:
     #         "Always conclude with properly formatted references and suggest additional resources when appropriate."
     #     )
     # }
-]
-
-            # Add chat history for context
-            if chat_history:
-                chat_history = self.trim_chat_history(chat_history, max_tokens=2000)  # More generous for response generation
-                messages.extend(chat_history)
-            
-            messages.append({"role": "user", "content": user_query})
-
-            if research_info and research_info.strip() != "No relevant information found." and not use_model_knowledge:
-                messages.append({"role": "user", "content": f"Information retrieved from APIs:\n\n{research_info}"})
-            elif use_model_knowledge:
-                messages.append({"role": "user", "content": "No API data available. Use your internal knowledge to provide a comprehensive response."})
-
-            response = self.client.chat.completions.create(
-                model="gpt-4",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1500
-            )
-
-            response_text = response.choices[0].message.content
-
-            # Append references in Markdown if provided
-            if references and not use_model_knowledge:
-                response_text += "\n\n## References\n\n"
-                for ref in references:
-                    response_text += f"- {ref}\n"
-            elif use_model_knowledge:
-                # Add fallback references for search
-                search_terms = urllib.parse.quote(user_query)
-                response_text += "\n\n## References\n\n"
-                response_text += f"- Based on general medical knowledge.\n"
-                response_text += f"- [PubMed Search: {user_query}](https://pubmed.ncbi.nlm.nih.gov/?term={search_terms})\n"
-                response_text += f"- [ClinicalTrials.gov Search: {user_query}](https://clinicaltrials.gov/search?term={search_terms})\n"
-
-            return response_text
-
-        except Exception as e:
-            logger.error(f"Response generation failed: {str(e)}")
-            raise Exception(f"Response generation failed: {str(e)}")
\ No newline at end of file
+    ]
+
+        # Add chat history for context
+        if chat_history:
+            chat_history = self.trim_chat_history(chat_history, max_tokens=settings.CHAT_CONTEXT['HISTORY_TOKENS'])
+            messages.extend(chat_history)
+
+        messages.append({"role": "user", "content": user_query})
+
+        references = []
+        if sections and not use_model_knowledge:
+            # Evidence gets whatever the prompt so far and the answer leave of the context window
+            preamble = "Information retrieved from APIs:\n\n"
+            budget = context_assembler.evidence_budget(messages) - context_assembler.message_tokens({"content": preamble})
+            with metrics.timer("chat_stage_seconds", stage="assembly"), tracing.span("assemble", budget=budget) as span:
+                research_info, references, used = context_assembler.assemble(sections, budget)
+                span.set(tokens=used, references=len(references))
+            logger.info(f"Research info ({used} of {budget} tokens): {research_info}")
+            messages.append({"role": "user", "content": preamble + research_info})
+        elif use_model_knowledge:
+            messages.append({"role": "user", "content": "No API data available. Use your internal knowledge to provide a comprehensive response."})
+
+        logger.info(f"References: {references}")
+        return messages, references
+
+    async def asummarize_history(self, summary, chat_history, model, max_tokens):
+        """
+        Fold older exchanges into a session's running summary.
+        Args:
+            summary: The summary so far, "" for none.
+            chat_history: Messages not yet in the summary, oldest first.
+            model: Chat model to summarize with.
+            max_tokens: Length cap for the new summary.
+        Returns:
+            The updated summary.
+        """
+        # Answers carry long evidence write-ups and reference lists, their gist is enough
+        exchanges = "\n\n".join(
+            f"{message['role'].capitalize()}: {context_assembler.truncate(message['content'], max_tokens)}"
+            for message in chat_history
+        )
+        response = await self.async_client.chat.completions.create(
+            model=model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "You maintain the running summary of a medical research conversation. Merge the new exchanges into the summary. "
+                        "Keep the diseases, genes, variants, proteins, treatments and trials discussed, what the user asked about them, "
+                        "key findings and the user's apparent expertise, so later follow-up questions can be resolved. "
+                        "Reply with the updated summary only."
+                    )
+                },
+                {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew exchanges:\n{exchanges}"}
+            ],
+            temperature=0.3,
+            max_tokens=max_tokens
+        )
+        metrics.record_openai_usage(model, "summary", response.usage)
+        return response.choices[0].message.content.strip()
+
+    def _references_markdown(self, user_query, references, use_model_knowledge):
+        markdown = ""
+        # Append references in Markdown if provided
+        if references and not use_model_knowledge:
+            markdown += "\n\n## References\n\n"
+            for ref in references:
+                markdown += f"- {ref}\n"
+        elif use_model_knowledge:
+            # Add fallback references for search
+            search_terms = urllib.parse.quote(user_query)
+            markdown += "\n\n## References\n\n"
+            markdown += f"- Based on general medical knowledge.\n"
+            markdown += f"- [PubMed Search: {user_query}](https://pubmed.ncbi.nlm.nih.gov/?term={search_terms})\n"
+            markdown += f"- [ClinicalTrials.gov Search: {user_query}](https://clinicaltrials.gov/search?term={search_terms})\n"
+
+        return markdown
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULTS = {
+    "FAILURE_THRESHOLD": 5,
+    "SLOW_SECONDS": 8,
+    "OPEN_SECONDS": 30,
+}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+
+class CircuitBreakers:
+    def __init__(self, path, failure_threshold=5, slow_seconds=8, open_seconds=30):
+        """
+        One breaker per upstream host, kept in SQLite so every worker on the host
+        sees the same state.
+
+        Consecutive failures (errors, 5xx or responses slower than slow_seconds)
+        open the breaker. After open_seconds a single probe request is let through:
+        success closes the breaker, failure re-opens it.
+        Args:
+            path: SQLite file location.
+            failure_threshold: Consecutive failures that open a breaker.
+            slow_seconds: Responses slower than this count as failures.
+            open_seconds: How long a breaker stays open before probing.
+        """
+        self.path = str(path)
+        self.failure_threshold = failure_threshold
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS breakers ("
+                "host TEXT PRIMARY KEY, state TEXT NOT NULL, failures INTEGER NOT NULL, "
+                "opened_at REAL, probe_at REAL, last_error TEXT, rejected INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def check(self, host):
+        """
+        Raise CircuitOpenError unless a request to host may go out now.
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT state, opened_at FROM breakers WHERE host = ?", (host,)).fetchone()
+        if row is None or row[0] == CLOSED:
+            return
+        now = time.time()
+        if row[0] == OPEN and now - row[1] < self.open_seconds:
+            self._reject(conn, host)
+
+        # Cool-down over: claim the probe, unless another worker holds an unexpired one
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            state, opened_at, probe_at = conn.execute(
+                "SELECT state, opened_at, probe_at FROM breakers WHERE host = ?", (host,)
+            ).fetchone()
+            claimed = state == CLOSED or (
+                now - opened_at >= self.open_seconds and (probe_at is None or now - probe_at >= self.open_seconds)
+            )
+            if state != CLOSED and claimed:
+                conn.execute("UPDATE breakers SET state = ?, probe_at = ? WHERE host = ?", (HALF_OPEN, now, host))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not claimed:
+            self._reject(conn, host)
+        if state != CLOSED:
+            logger.info(f"Circuit for {host} half-open, probing")
+
+    def _reject(self, conn, host):
+        conn.execute("UPDATE breakers SET rejected = rejected + 1 WHERE host = ?", (host,))
+        raise CircuitOpenError(f"Circuit open for {host}")
+
+    def record(self, host, ok, elapsed=None, error=None):
+        """
+        Record the outcome of a request to host.
+        Args:
+            ok: False for transport errors and 5xx responses.
+            elapsed: Response time in seconds; slow responses count as failures.
+            error: Description kept for the status page.
+        """
+        if ok and elapsed is not None and elapsed > self.slow_seconds:
+            ok, error = False, f"slow response ({elapsed:.1f}s)"
+        conn = self._connect()
+        if ok:
+            cursor = conn.execute(
+                "UPDATE breakers SET state = ?, failures = 0, probe_at = NULL "
+                "WHERE host = ? AND (state != ? OR failures > 0) RETURNING opened_at",
+                (CLOSED, host, CLOSED),
+            )
+            if any(opened_at is not None for opened_at, in cursor.fetchall()):
+                logger.warning(f"Circuit for {host} closed")
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state, failures FROM breakers WHERE host = ?", (host,)).fetchone()
+            state, failures = row if row else (CLOSED, 0)
+            failures += 1
+            opened = state == HALF_OPEN or (state == CLOSED and failures >= self.failure_threshold)
+            conn.execute(
+                "INSERT INTO breakers (host, state, failures, opened_at, probe_at, last_error) "
+                "VALUES (?, ?, ?, ?, NULL, ?) ON CONFLICT(host) DO UPDATE SET "
+                "state = excluded.state, failures = excluded.failures, "
+                "opened_at = COALESCE(excluded.opened_at, opened_at), probe_at = excluded.probe_at, "
+                "last_error = excluded.last_error",
+                (host, OPEN if opened or state == OPEN else state, failures, time.time() if opened else None, str(error)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if opened:
+            logger.warning(f"Circuit for {host} opened after {failures} failures: {error}")
+
+    def states(self):
+        """
+        Returns:
+            Dict of {host: {"state", "failures", "opened_at", "last_error", "rejected"}}.
+        """
+        conn = self._connect()
+        rows = conn.execute("SELECT host, state, failures, opened_at, last_error, rejected FROM breakers")
+        return {
+            host: {"state": state, "failures": failures, "opened_at": opened_at, "last_error": last_error, "rejected": rejected}
+            for host, state, failures, opened_at, last_error, rejected in rows
+        }
+
+    def reset(self, host=None):
+        conn = self._connect()
+        if host is None:
+            conn.execute("DELETE FROM breakers")
+        else:
+            conn.execute("DELETE FROM breakers WHERE host = ?", (host,))
+
+
+def _config():
+    return getattr(settings, "CIRCUIT_BREAKER", {})
+
+
+_breakers = None
+
+
+def get_breakers():
+    global _breakers
+    if _breakers is None:
+        config = _config()
+        _breakers = CircuitBreakers(
+            config.get("PATH", os.path.join(settings.BASE_DIR, "cache", "circuit_breakers.sqlite3")),
+            failure_threshold=config.get("FAILURE_THRESHOLD", DEFAULTS["FAILURE_THRESHOLD"]),
+            slow_seconds=config.get("SLOW_SECONDS", DEFAULTS["SLOW_SECONDS"]),
+            open_seconds=config.get("OPEN_SECONDS", DEFAULTS["OPEN_SECONDS"]),
+        )
+    return _breakers
+
+
+def check(host):
+    if not _config().get("ENABLED", True):
+        return
+    try:
+        get_breakers().check(host)
+    except sqlite3.Error as e:
+        # An unreadable state file shouldn't take every upstream down with it
+        logger.warning(f"Circuit breaker unavailable for {host}: {str(e)}")
+
+
+def record(host, ok, elapsed=None, error=None):
+    if not _config().get("ENABLED", True):
+        return
+    try:
+        get_breakers().record(host, ok, elapsed, error)
+    except sqlite3.Error as e:
+        logger.warning(f"Circuit breaker unavailable for {host}: {str(e)}")
+
+
+async def acheck(host):
+    # SQLite calls block, keep them off the event loop
+    await asyncio.to_thread(check, host)
+
+
+async def arecord(host, ok, elapsed=None, error=None):
+    await asyncio.to_thread(record, host, ok, elapsed, error)
@@ -1,10 +1,33 @@
+import asyncio
+import httpx
 import requests
+from contextlib import aclosing
+from itertools import islice
 from time import sleep
 from urllib.parse import quote
+from chatbot.services import http_client
+from chatbot.services.circuit_breaker import CircuitOpenError
+from chatbot.services.source_cache import cached
 
-def search_clinical_trials(condition_terms, treatment_terms=None, max_results=200, retries=2):
+BASE_URL = "https://clinicaltrials.gov/api/v2/studies"
+MAX_PAGE_SIZE = 1000
+
+# Ongoing trials are moved ahead of the rest within the one page requested, see _ongoing_first
+ONGOING_STATUSES = ["RECRUITING", "ENROLLING_BY_INVITATION"]
+OTHER_STATUSES = ["ACTIVE_NOT_RECRUITING", "COMPLETED"]
+
+# Only what _format_study reads; DetailedDescription alone is often several KB per study
+FIELDS = [
+    "NCTId", "BriefTitle", "OverallStatus", "BriefSummary", "Condition",
+    "Phase", "InterventionName", "StudyType", "EnrollmentCount",
+]
+
+@cached("clinical_trials", ignore=("retries",))
+def search_clinical_trials(condition_terms, treatment_terms=None, max_results=10, retries=2):
     """
     Search ClinicalTrials.gov API using Essie syntax for any disease and optional treatment.
+    One request for every shown status, at most max_results studies, with the ongoing
+    trials of that page moved first.
     Args:
         condition_terms: e.g., "diabetes" or "(diabetes OR prediabetes) AND obesity"
         treatment_terms: e.g., "metformin" or "(metformin OR glucophage)", optional
@@ -14,130 +37,203 @@ def search_clinical_trials(condition_terms, treatment_terms=None, max_results=20
         List of formatted trial dictionaries or None if no results or error
     """
     try:
-        base_url = "https://clinicaltrials.gov/api/v2/studies"
-        
-        # Synonym mapping for conditions and treatments
-        condition_synonyms = {
-            "diabetes": "diabetes OR type 2 diabetes OR type 1 diabetes OR diabetic",
-            "breast cancer": "breast cancer OR mammary carcinoma OR breast neoplasm OR triple-negative breast cancer",
-            "alzheimer’s disease": "Alzheimer’s Disease OR AD OR dementia OR cognitive impairment",
-            "hypertension": "hypertension OR high blood pressure OR hypertensive"
-        }
-        treatment_synonyms = {
-            "metformin": "metformin OR glucophage OR biguanide",
-            "chemotherapy": "chemotherapy OR paclitaxel OR doxorubicin OR cyclophosphamide OR carboplatin OR docetaxel",
-            "anti-amyloid": "anti-amyloid OR aducanumab OR lecanemab OR donanemab"
-        }
-        
-        # Apply synonyms
-        query_cond = condition_synonyms.get(condition_terms.lower(), condition_terms)
-        query_intr = treatment_synonyms.get(treatment_terms.lower(), treatment_terms) if treatment_terms else None
-        
-        # Encode Essie syntax queries
-        encoded_condition = quote(query_cond, safe='()')
-        encoded_treatment = quote(query_intr, safe='()') if query_intr else ""
-        
-        query_params = {
-            "format": "json",
-            "pageSize": max_results,
-            "query.cond": encoded_condition,
-            "fields": (
-                "NCTId,BriefTitle,OverallStatus,BriefSummary,DetailedDescription,"
-                "Condition,Phase,InterventionName,StudyType,EnrollmentCount"
-            ),
-            "filter.overallStatus": "RECRUITING,ACTIVE_NOT_RECRUITING,ENROLLING_BY_INVITATION,COMPLETED"
-        }
-        
-        if query_intr:
-            query_params["query.intr"] = encoded_treatment
-
-        print(f"API Request Parameters: {query_params}")
-        print(f"Full URL: {requests.Request('GET', base_url, params=query_params).prepare().url}")
-
-        # Retry logic
-        for attempt in range(retries):
-            try:
-                response = requests.get(base_url, params=query_params, timeout=15)
-                print(f"Response Status Code: {response.status_code}")
-                print(f"Full API Response: {response.text}")
-
-                if response.status_code != 200:
-                    print(f"API request failed: {response.status_code}, {response.text}")
-                    if attempt < retries - 1:
-                        sleep(2 ** attempt)
-                        continue
-                    return None
-
-                data = response.json()
-                studies = data.get('studies', [])
-                print(f"Number of studies found: {len(studies)}")
-
-                if not studies and attempt < retries - 1:
-                    # Broaden query: try free-text search across all fields
-                    query_params.pop("query.intr", None)  # Remove intervention
-                    query_params.pop("query.cond", None)
-                    query_params["query.term"] = encoded_condition + (f" {encoded_treatment}" if encoded_treatment else "")
-                    print(f"Retrying with broader terms: {query_params}")
-                    continue
-
-                if not studies:
-                    print("No trials found for query")
-                    return None
-
-                formatted_trials = []
-                for study in studies:
-                    try:
-                        protocol = study.get('protocolSection', {})
-                        identification = protocol.get('identificationModule', {})
-                        description = protocol.get('descriptionModule', {})
-                        status = protocol.get('statusModule', {})
-                        phase = protocol.get('phaseModule', {})
-                        interventions = protocol.get('armsInterventionsModule', {}).get('interventions', [])
-                        design = protocol.get('designModule', {})
-                        conditions = protocol.get('conditionsModule', {})
-
-                        trial_description = (
-                            description.get('briefSummary', '') or 
-                            description.get('detailedDescription', 'No description available')
-                        )
-
-                        formatted_trial = {
-                            'nct_id': identification.get('nctId', 'N/A'),
-                            'title': identification.get('briefTitle', 'Untitled'),
-                            'status': status.get('overallStatus', 'Unknown'),
-                            'description': trial_description,
-                            'phase': phase.get('phases', ['Not specified'])[0] if phase.get('phases') else 'Not specified',
-                            'interventions': [i.get('name', 'Not specified') for i in interventions],
-                            'study_type': design.get('studyType', 'Not specified'),
-                            'conditions': conditions.get('conditions', ['Not specified']),
-                            'enrollment': design.get('enrollmentInfo', {}).get('count', 'Not specified')
-                        }
-
-                        # Prioritize ongoing trials
-                        if formatted_trial['status'] in ['RECRUITING', 'ENROLLING_BY_INVITATION']:
-                            formatted_trials.insert(0, formatted_trial)
-                        else:
-                            formatted_trials.append(formatted_trial)
-
-                    except Exception as e:
-                        print(f"Error processing trial: {str(e)}")
-                        continue
-
-                return formatted_trials[:max_results] if formatted_trials else None
-
-            except requests.Timeout:
-                print(f"Attempt {attempt + 1}: ClinicalTrials API request timed out")
-                if attempt < retries - 1:
-                    sleep(2 ** attempt)
-                    continue
-                return None
+        for broaden in (False, True):
+            pages = iter_clinical_trials(condition_terms, treatment_terms, None, max_results, retries, broaden)
+            trials = _ongoing_first(islice(pages, max_results))
+            print(f"Number of studies found: {len(trials)}")
+            if trials:
+                return trials
+            if retries < 2:
+                break
+
+        print("No trials found for query")
+        return None
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Unexpected error in clinical trials search: {str(e)}")
+        return None
+
+@cached("clinical_trials", ignore=("retries",))
+async def asearch_clinical_trials(condition_terms, treatment_terms=None, max_results=10, retries=2):
+    """
+    Async variant of search_clinical_trials.
+    """
+    try:
+        for broaden in (False, True):
+            trials = []
+            pages = aiter_clinical_trials(condition_terms, treatment_terms, None, max_results, retries, broaden)
+            async with aclosing(pages):
+                async for trial in pages:
+                    trials.append(trial)
+                    if len(trials) >= max_results:
+                        break
+            trials = _ongoing_first(trials)
+            print(f"Number of studies found: {len(trials)}")
+            if trials:
+                return trials
+            if retries < 2:
+                break
 
+        print("No trials found for query")
         return None
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
         print(f"Unexpected error in clinical trials search: {str(e)}")
         return None
 
+def iter_clinical_trials(condition_terms, treatment_terms=None, statuses=None, page_size=10, retries=2, broaden=False):
+    """
+    Yield formatted trials, fetching the next page (nextPageToken) only once the
+    current one has been consumed.
+    Args:
+        statuses: OverallStatus values to filter on server-side, defaults to all shown statuses
+        page_size: Studies per request; match it to how many the caller will take
+        broaden: Search the terms across all fields instead of condition/intervention
+    """
+    query_params, encoded_condition, encoded_treatment = _build_query_params(condition_terms, treatment_terms, page_size, statuses)
+    if broaden:
+        _broaden_query(query_params, encoded_condition, encoded_treatment)
+    print(f"API Request Parameters: {query_params}")
+
+    while True:
+        data = _fetch_page(query_params, retries)
+        if data is None:
+            return
+        for study in data.get('studies', []):
+            trial = _format_study(study)
+            if trial:
+                yield trial
+        token = data.get('nextPageToken')
+        if not token:
+            return
+        query_params["pageToken"] = token
+
+async def aiter_clinical_trials(condition_terms, treatment_terms=None, statuses=None, page_size=10, retries=2, broaden=False):
+    """
+    Async variant of iter_clinical_trials.
+    """
+    query_params, encoded_condition, encoded_treatment = _build_query_params(condition_terms, treatment_terms, page_size, statuses)
+    if broaden:
+        _broaden_query(query_params, encoded_condition, encoded_treatment)
+    print(f"API Request Parameters: {query_params}")
+
+    while True:
+        data = await _afetch_page(query_params, retries)
+        if data is None:
+            return
+        for study in data.get('studies', []):
+            trial = _format_study(study)
+            if trial:
+                yield trial
+        token = data.get('nextPageToken')
+        if not token:
+            return
+        query_params["pageToken"] = token
+
+def _ongoing_first(trials):
+    # Stable, so each group keeps the API's relevance order
+    return sorted(trials, key=lambda trial: trial['status'] not in ONGOING_STATUSES)
+
+def _fetch_page(query_params, retries):
+    for attempt in range(retries):
+        try:
+            response = http_client.get(BASE_URL, params=query_params)
+            print(f"Response Status Code: {response.status_code}")
+            if response.status_code == 200:
+                return response.json()
+            print(f"API request failed: {response.status_code}, {response.text}")
+        except requests.Timeout:
+            print(f"Attempt {attempt + 1}: ClinicalTrials API request timed out")
+        if attempt < retries - 1:
+            sleep(2 ** attempt)
+    return None
+
+async def _afetch_page(query_params, retries):
+    for attempt in range(retries):
+        try:
+            response = await http_client.aget(BASE_URL, params=query_params)
+            print(f"Response Status Code: {response.status_code}")
+            if response.status_code == 200:
+                return response.json()
+            print(f"API request failed: {response.status_code}, {response.text}")
+        except httpx.TimeoutException:
+            print(f"Attempt {attempt + 1}: ClinicalTrials API request timed out")
+        if attempt < retries - 1:
+            await asyncio.sleep(2 ** attempt)
+    return None
+
+def _build_query_params(condition_terms, treatment_terms, page_size, statuses=None):
+    # Synonym mapping for conditions and treatments
+    condition_synonyms = {
+        "diabetes": "diabetes OR type 2 diabetes OR type 1 diabetes OR diabetic",
+        "breast cancer": "breast cancer OR mammary carcinoma OR breast neoplasm OR triple-negative breast cancer",
+        "alzheimer’s disease": "Alzheimer’s Disease OR AD OR dementia OR cognitive impairment",
+        "hypertension": "hypertension OR high blood pressure OR hypertensive"
+    }
+    treatment_synonyms = {
+        "metformin": "metformin OR glucophage OR biguanide",
+        "chemotherapy": "chemotherapy OR paclitaxel OR doxorubicin OR cyclophosphamide OR carboplatin OR docetaxel",
+        "anti-amyloid": "anti-amyloid OR aducanumab OR lecanemab OR donanemab"
+    }
+    
+    # Apply synonyms
+    query_cond = condition_synonyms.get(condition_terms.lower(), condition_terms)
+    query_intr = treatment_synonyms.get(treatment_terms.lower(), treatment_terms) if treatment_terms else None
+    
+    # Encode Essie syntax queries
+    encoded_condition = quote(query_cond, safe='()')
+    encoded_treatment = quote(query_intr, safe='()') if query_intr else ""
+    
+    query_params = {
+        "format": "json",
+        "pageSize": min(page_size, MAX_PAGE_SIZE),
+        "query.cond": encoded_condition,
+        "fields": ",".join(FIELDS),
+        "filter.overallStatus": ",".join(statuses or ONGOING_STATUSES + OTHER_STATUSES)
+    }
+    
+    if query_intr:
+        query_params["query.intr"] = encoded_treatment
+    return query_params, encoded_condition, encoded_treatment
+
+def _broaden_query(query_params, encoded_condition, encoded_treatment):
+    # Broaden query: try free-text search across all fields
+    query_params.pop("query.intr", None)  # Remove intervention
+    query_params.pop("query.cond", None)
+    query_params["query.term"] = encoded_condition + (f" {encoded_treatment}" if encoded_treatment else "")
+    print(f"Retrying with broader terms: {query_params}")
+
+def _format_study(study):
+    try:
+        protocol = study.get('protocolSection', {})
+        identification = protocol.get('identificationModule', {})
+        description = protocol.get('descriptionModule', {})
+        status = protocol.get('statusModule', {})
+        phase = protocol.get('phaseModule', {})
+        interventions = protocol.get('armsInterventionsModule', {}).get('interventions', [])
+        design = protocol.get('designModule', {})
+        conditions = protocol.get('conditionsModule', {})
+
+        return {
+            'nct_id': identification.get('nctId', 'N/A'),
+            'title': identification.get('briefTitle', 'Untitled'),
+            'status': status.get('overallStatus', 'Unknown'),
+            'description': description.get('briefSummary', '') or 'No description available',
+            'phase': phase.get('phases', ['Not specified'])[0] if phase.get('phases') else 'Not specified',
+            'interventions': [i.get('name', 'Not specified') for i in interventions],
+            'study_type': design.get('studyType', 'Not specified'),
+            'conditions': conditions.get('conditions', ['Not specified']),
+            'enrollment': design.get('enrollmentInfo', {}).get('count', 'Not specified')
+        }
+
+    except Exception as e:
+        print(f"Error processing trial: {str(e)}")
+        return None
+
 def test_clinical_trials_queries():
     """
     Test function with dynamic Essie syntax queries
@@ -0,0 +1,229 @@
+import logging
+import math
+import os
+import re
+import threading
+
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENCODING": "cl100k_base",
+    "VOCAB_DIR": None,
+    "CONTEXT_WINDOW": 8192,
+    "RESPONSE_TOKENS": 1500,
+    "ROUTING_HISTORY_TOKENS": 1500,
+    "HISTORY_TOKENS": 2000,
+    "ENTRY_TOKENS": 250,
+    "SECTIONS": {},
+}
+
+# Chat format overhead per message (role and separators), as counted by OpenAI
+MESSAGE_OVERHEAD = 4
+# Below this an entry is dropped rather than cut to a stub
+MIN_ENTRY_TOKENS = 24
+ELLIPSIS = "..."
+
+# cl100k pre-tokenization, used to estimate when the BPE vocabulary isn't available
+_PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+", re.IGNORECASE)
+
+_lock = threading.Lock()
+_encoding = None
+_loaded = False
+
+
+def _config(key):
+    return getattr(settings, "CHAT_CONTEXT", {}).get(key, DEFAULTS[key])
+
+
+def get_encoding():
+    """
+    The answer model's BPE encoding, or None when tiktoken or its vocabulary file
+    can't be loaded (tiktoken fetches it once into VOCAB_DIR, ship that directory
+    to run offline). Without it counts fall back to a pre-tokenizer estimate.
+    """
+    global _encoding, _loaded
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                if tiktoken is None:
+                    logger.warning("tiktoken is not installed, token counts are estimated")
+                else:
+                    if _config("VOCAB_DIR"):
+                        os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(_config("VOCAB_DIR")))
+                    try:
+                        _encoding = tiktoken.get_encoding(_config("ENCODING"))
+                    except Exception as e:
+                        logger.warning(f"Could not load the {_config('ENCODING')} vocabulary, token counts are estimated: {str(e)}")
+                _loaded = True
+    return _encoding
+
+
+def _estimate(piece):
+    # Short pieces are a single token in practice, long words split every ~4 characters
+    return max(1, math.ceil(len(piece.strip() or piece) / 4))
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return sum(_estimate(piece) for piece in _PIECES.findall(text))
+
+
+def truncate(text, max_tokens):
+    """Cut text to at most max_tokens, ending in an ellipsis when anything was dropped."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    keep = max(0, max_tokens - 1)
+    encoding = get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:keep]).rstrip() + ELLIPSIS
+    end = 0
+    for match in _PIECES.finditer(text):
+        keep -= _estimate(match.group())
+        if keep < 0:
+            break
+        end = match.end()
+    return text[:end].rstrip() + ELLIPSIS
+
+
+def message_tokens(message):
+    return MESSAGE_OVERHEAD + count_tokens(message.get("content") or "")
+
+
+def trim_history(chat_history, max_tokens):
+    """
+    Most recent messages of chat_history that fit in max_tokens, oldest first.
+    Leading system messages (the conversation summary) are always kept and their
+    tokens come out of the budget first, they stand in for everything trimmed.
+    """
+    if not chat_history:
+        return chat_history
+    pinned = 0
+    while pinned < len(chat_history) and chat_history[pinned].get("role") == "system":
+        pinned += 1
+    total = sum(message_tokens(m) for m in chat_history[:pinned])
+    start = len(chat_history)
+    while start > pinned:
+        tokens = message_tokens(chat_history[start - 1])
+        if total + tokens > max_tokens:
+            break
+        total += tokens
+        start -= 1
+    logger.info(f"Trimmed chat history from {len(chat_history)} to {pinned + len(chat_history) - start} messages, using {total} tokens")
+    return chat_history[:pinned] + chat_history[start:]
+
+
+def evidence_budget(messages):
+    """Tokens left for evidence once messages and the answer's own tokens are accounted for."""
+    used = sum(message_tokens(m) for m in messages)
+    return max(0, _config("CONTEXT_WINDOW") - _config("RESPONSE_TOKENS") - used)
+
+
+class Section:
+    def __init__(self, name, heading):
+        """
+        Evidence from one source, kept as separate entries so the assembler can
+        stop at any entry boundary.
+        Args:
+            name: Scheduler task name, also the key into CHAT_CONTEXT['SECTIONS'].
+            heading: Markdown heading written above the section's first entry.
+        """
+        self.name = name
+        self.heading = heading
+        self.entries = []
+        self.notes = []
+        self.references = []
+
+    def add(self, text, reference=None, heading=None):
+        """One result (a trial, a paper...); its reference is only listed if the entry makes it into the prompt."""
+        self.entries.append((heading or self.heading, text, reference))
+
+    def note(self, text, reference=None, heading=None):
+        """A short message kept regardless of budget, e.g. that the source found nothing."""
+        self.notes.append((heading or self.heading, text))
+        if reference:
+            self.references.append(reference)
+
+
+def assemble(sections, budget):
+    """
+    Lay out evidence sections within a token budget, in one pass.
+
+    Sections are filled in CHAT_CONTEXT['SECTIONS'] order, each up to its own
+    budget plus whatever the sections before it left unused; entries are cut to
+    ENTRY_TOKENS and dropped once they no longer fit. The text keeps the order
+    of the sections argument.
+    Args:
+        sections: Section objects.
+        budget: Total tokens the evidence may take.
+    Returns:
+        Tuple (text, references, tokens used).
+    """
+    section_budgets = _config("SECTIONS")
+    entry_cap = _config("ENTRY_TOKENS")
+    priority = {name: i for i, name in enumerate(section_budgets)}
+    ranked = sorted(sections, key=lambda s: priority.get(s.name, len(priority)))
+    # Sections without a budget of their own share what is left equally
+    unbudgeted = [s for s in sections if s.name not in section_budgets] or [None]
+    fair_share = budget // len(unbudgeted)
+
+    # Notes are short and always kept, so they come off the top
+    chosen = {}
+    headings = {}
+    left = budget
+    for section in sections:
+        blocks = []
+        heading = None
+        for block_heading, text in section.notes:
+            if block_heading != heading:
+                blocks.append((block_heading, None))
+                left -= count_tokens(block_heading)
+                heading = block_heading
+            blocks.append((text, None))
+            left -= count_tokens(text)
+        chosen[section.name] = blocks
+        headings[section.name] = heading
+
+    spare = 0
+    for section in ranked:
+        allowance = max(0, min(left, section_budgets.get(section.name, fair_share) + spare))
+        blocks = chosen[section.name]
+        heading = headings[section.name]
+        used = 0
+        included = 0
+        for block_heading, text, reference in section.entries:
+            heading_tokens = count_tokens(block_heading) if block_heading != heading else 0
+            # One token of the room goes to the blank line closing the entry
+            room = min(entry_cap, allowance - used - heading_tokens - 1)
+            if room < MIN_ENTRY_TOKENS:
+                break
+            block = truncate(text.rstrip(), room) + "\n\n"
+            if heading_tokens:
+                blocks.append((block_heading, None))
+                heading = block_heading
+            blocks.append((block, reference))
+            used += heading_tokens + count_tokens(block)
+            included += 1
+        spare = max(0, allowance - used)
+        left -= used
+        logger.info(f"Context section {section.name}: {used}/{allowance} tokens, {included} of {len(section.entries)} entries")
+
+    text = []
+    references = []
+    for section in sections:
+        for block, reference in chosen[section.name]:
+            text.append(block)
+            if reference:
+                references.append(reference)
+        references.extend(section.references)
+    return "".join(text), references, budget - left
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+from chatbot.models import ChatSession
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    "MODEL": "gpt-3.5-turbo",
+    "VERBATIM_TURNS": 3,
+    "MAX_UNSUMMARIZED_TURNS": 4,
+    "SUMMARY_TOKENS": 400,
+    "BATCH_TURNS": 8,
+}
+
+# Running updates, referenced so the event loop doesn't drop them half way
+_pending = set()
+
+
+def _config(key):
+    return getattr(settings, "CONVERSATION_SUMMARY", {}).get(key, DEFAULTS[key])
+
+
+def enabled():
+    return _config("ENABLED")
+
+
+def _as_messages(exchanges):
+    history = []
+    for msg in exchanges:
+        history.append({"role": "user", "content": msg.message})
+        history.append({"role": "assistant", "content": msg.response})
+    return history
+
+
+async def aload_history(session):
+    """
+    History the model sees for the session's next turn: the rolling summary as a
+    system message, then the exchanges it doesn't cover yet, word for word.
+    Only those exchanges are read, so the cost doesn't grow with the session.
+    """
+    recent = session.messages.order_by("-created_at").only("message", "response", "created_at")
+    if session.summary_through is not None:
+        recent = recent.filter(created_at__gt=session.summary_through)
+    exchanges = [msg async for msg in recent[:_config("MAX_UNSUMMARIZED_TURNS")]]
+    exchanges.reverse()
+
+    history = _as_messages(exchanges)
+    if session.summary:
+        history.insert(0, {"role": "system", "content": f"Summary of the earlier conversation:\n{session.summary}"})
+    return history
+
+
+def schedule_update(session, chatgpt_service):
+    """Fold exchanges that dropped out of the verbatim window into the summary, after the response is sent."""
+    if not enabled():
+        return
+    task = asyncio.ensure_future(aupdate(session.pk, chatgpt_service))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def aupdate(session_pk, chatgpt_service):
+    """
+    Summarize the exchanges older than the last VERBATIM_TURNS that the summary
+    doesn't cover yet, oldest first and at most BATCH_TURNS per summarizer call,
+    so a long session catches up batch by batch instead of in one oversized prompt.
+    Concurrent updates of one session are resolved by keeping whichever saves
+    first; the other one stops and its exchanges get folded in next turn.
+    """
+    try:
+        session = await ChatSession.objects.aget(pk=session_pk)
+        pending = session.messages.order_by("created_at").only("message", "response", "created_at")
+        verbatim = _config("VERBATIM_TURNS")
+        if verbatim:
+            # created_at of the oldest exchange kept word for word, everything before it is summarized
+            newest = session.messages.order_by("-created_at").values_list("created_at", flat=True)
+            cutoff = await newest[verbatim - 1:verbatim].afirst()
+            if cutoff is None:
+                return
+            pending = pending.filter(created_at__lt=cutoff)
+
+        while True:
+            batch = pending
+            if session.summary_through is not None:
+                batch = batch.filter(created_at__gt=session.summary_through)
+            exchanges = [msg async for msg in batch[:_config("BATCH_TURNS")]]
+            if not exchanges:
+                return
+
+            summary = await chatgpt_service.asummarize_history(session.summary, _as_messages(exchanges), _config("MODEL"), _config("SUMMARY_TOKENS"))
+            updated = await ChatSession.objects.filter(pk=session.pk, summary_through=session.summary_through).aupdate(
+                summary=summary,
+                summary_through=exchanges[-1].created_at
+            )
+            if not updated:
+                return
+            session.summary, session.summary_through = summary, exchanges[-1].created_at
+            logger.info(f"Summarized {len(exchanges)} more exchanges of session {session.session_id}")
+    except Exception as e:
+        logger.error(f"Conversation summary update failed: {str(e)}")
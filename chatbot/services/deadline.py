@@ -0,0 +1,44 @@
+import contextvars
+import time
+
+_expires_at = contextvars.ContextVar("deadline", default=None)
+
+
+class Deadline:
+    def __init__(self, seconds):
+        """
+        Time budget for the enclosed work. Tasks and asyncio.to_thread workers started
+        inside inherit it, so every upstream call sees how much of the turn is left.
+        A nested Deadline can only shorten the one it runs under.
+        Args:
+            seconds: Budget from now, or None for no limit of its own.
+        """
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def __enter__(self):
+        outer = _expires_at.get()
+        if outer is not None and (self.expires_at is None or outer < self.expires_at):
+            self.expires_at = outer
+        self._token = _expires_at.set(self.expires_at)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _expires_at.reset(self._token)
+
+
+def remaining():
+    """Seconds left in the active budget, None when there is none."""
+    expires_at = _expires_at.get()
+    if expires_at is None:
+        return None
+    return max(0.0, expires_at - time.monotonic())
+
+
+def timeout(default=None):
+    """The smaller of default and the remaining budget, None when neither is set."""
+    left = remaining()
+    if left is None:
+        return default
+    if default is None:
+        return left
+    return min(default, left)
@@ -1,11 +1,19 @@
+import httpx
 import requests
 from django.conf import settings
+from chatbot.services import http_client
+from chatbot.services.source_cache import Partial, cached
 
 class EnsemblService:
+    # Server-side limits for the POST endpoints
+    LOOKUP_BATCH_SIZE = 1000
+    VEP_BATCH_SIZE = 200
+
     def __init__(self):
         self.base_url = "https://rest.ensembl.org"
         self.headers = {"Content-Type": "application/json"}
 
+    @cached("ensembl")
     def search_gene_by_symbol(self, species, symbol, max_results=3):
         """
         Search for gene information by symbol (e.g., BRCA1) in a given species.
@@ -13,20 +21,9 @@ class EnsemblService:
         try:
             endpoint = f"{self.base_url}/lookup/symbol/{species}/{symbol}"
             params = {"expand": 1}
-            response = requests.get(endpoint, headers=self.headers, params=params)
+            response = http_client.get(endpoint, headers=self.headers, params=params)
             response.raise_for_status()
-            data = response.json()
-
-            gene_info = {
-                "id": data.get("id", ""),
-                "symbol": data.get("display_name", symbol),
-                "description": data.get("description", "No description available"),
-                "biotype": data.get("biotype", ""),
-                "chromosome": data.get("seq_region_name", ""),
-                "start": data.get("start", ""),
-                "end": data.get("end", ""),
-                "strand": "Forward" if data.get("strand", 1) == 1 else "Reverse"
-            }
+            gene_info = self._parse_gene(response.json(), symbol)
             print(f"[ENSEMBL] Gene info found for {symbol}: {gene_info}")
             return [gene_info]
 
@@ -34,28 +31,34 @@ class EnsemblService:
             print(f"[ENSEMBL] Error in gene lookup for {symbol}: {str(e)}")
             return []
 
+    @cached("ensembl")
+    async def asearch_gene_by_symbol(self, species, symbol, max_results=3):
+        """
+        Async variant of search_gene_by_symbol.
+        """
+        try:
+            endpoint = f"{self.base_url}/lookup/symbol/{species}/{symbol}"
+            params = {"expand": 1}
+            response = await http_client.aget(endpoint, headers=self.headers, params=params)
+            response.raise_for_status()
+            gene_info = self._parse_gene(response.json(), symbol)
+            print(f"[ENSEMBL] Gene info found for {symbol}: {gene_info}")
+            return [gene_info]
+
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"[ENSEMBL] Error in gene lookup for {symbol}: {str(e)}")
+            return []
+
+    @cached("ensembl")
     def search_variant_consequences(self, species, variant_id, max_results=3):
         """
         Fetch variant consequences by variant ID (e.g., rs12345) in a given species.
         """
         try:
             endpoint = f"{self.base_url}/vep/{species}/id/{variant_id}"
-            response = requests.get(endpoint, headers=self.headers)
+            response = http_client.get(endpoint, headers=self.headers)
             response.raise_for_status()
-            data = response.json()
-
-            consequences = []
-            for item in data[:max_results]:
-                for tc in item.get("transcript_consequences", [])[:max_results]:
-                    consequence = {
-                        "variant_id": variant_id,
-                        "gene_symbol": tc.get("gene_symbol", ""),
-                        "transcript_id": tc.get("transcript_id", ""),
-                        "consequence_terms": tc.get("consequence_terms", []),
-                        "impact": tc.get("variant_allele", "")
-                    }
-                    consequences.append(consequence)
-
+            consequences = self._parse_variant_consequences(response.json(), variant_id, max_results)
             print(f"[ENSEMBL] Found {len(consequences)} consequences for variant {variant_id}")
             return consequences
 
@@ -63,29 +66,195 @@ class EnsemblService:
             print(f"[ENSEMBL] Error in variant consequences for {variant_id}: {str(e)}")
             return []
 
+    @cached("ensembl")
+    async def asearch_variant_consequences(self, species, variant_id, max_results=3):
+        """
+        Async variant of search_variant_consequences.
+        """
+        try:
+            endpoint = f"{self.base_url}/vep/{species}/id/{variant_id}"
+            response = await http_client.aget(endpoint, headers=self.headers)
+            response.raise_for_status()
+            consequences = self._parse_variant_consequences(response.json(), variant_id, max_results)
+            print(f"[ENSEMBL] Found {len(consequences)} consequences for variant {variant_id}")
+            return consequences
+
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"[ENSEMBL] Error in variant consequences for {variant_id}: {str(e)}")
+            return []
+
+    @cached("ensembl")
     def search_phenotype_by_gene(self, species, gene_symbol, max_results=3):
         """
         Fetch phenotype annotations for a given gene in a species.
         """
         try:
             endpoint = f"{self.base_url}/phenotype/gene/{species}/{gene_symbol}"
-            response = requests.get(endpoint, headers=self.headers)
+            response = http_client.get(endpoint, headers=self.headers)
             response.raise_for_status()
-            data = response.json()
-
-            phenotypes = []
-            for item in data[:max_results]:
-                phenotype = {
-                    "gene_symbol": gene_symbol,
-                    "phenotype_description": item.get("description", "No description available"),
-                    "source": item.get("source", ""),
-                    "study": item.get("study", "")
-                }
-                phenotypes.append(phenotype)
-
+            phenotypes = self._parse_phenotypes(response.json(), gene_symbol, max_results)
             print(f"[ENSEMBL] Phenotypes found for gene {gene_symbol}: {len(phenotypes)}")
             return phenotypes
 
         except requests.exceptions.RequestException as e:
             print(f"[ENSEMBL] Error in phenotype annotations for {gene_symbol}: {str(e)}")
             return []
+
+    @cached("ensembl")
+    async def asearch_phenotype_by_gene(self, species, gene_symbol, max_results=3):
+        """
+        Async variant of search_phenotype_by_gene.
+        """
+        try:
+            endpoint = f"{self.base_url}/phenotype/gene/{species}/{gene_symbol}"
+            response = await http_client.aget(endpoint, headers=self.headers)
+            response.raise_for_status()
+            phenotypes = self._parse_phenotypes(response.json(), gene_symbol, max_results)
+            print(f"[ENSEMBL] Phenotypes found for gene {gene_symbol}: {len(phenotypes)}")
+            return phenotypes
+
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"[ENSEMBL] Error in phenotype annotations for {gene_symbol}: {str(e)}")
+            return []
+
+    @cached("ensembl")
+    def search_genes_by_symbols(self, species, symbols):
+        """
+        Batch variant of search_gene_by_symbol using POST /lookup/symbol.
+        Returns gene dicts in the order of the given symbols, unknown symbols are skipped.
+        """
+        symbols = list(dict.fromkeys(symbols))
+        found = {}
+        failed = False
+        for chunk in self._chunks(symbols, self.LOOKUP_BATCH_SIZE):
+            try:
+                endpoint = f"{self.base_url}/lookup/symbol/{species}"
+                response = http_client.post(endpoint, headers=self.headers, json={"symbols": chunk})
+                response.raise_for_status()
+                found.update(response.json() or {})
+            except requests.exceptions.RequestException as e:
+                print(f"[ENSEMBL] Error in batch gene lookup for {chunk}: {str(e)}")
+                failed = True
+        genes = self._parse_gene_batch(found, symbols)
+        return Partial(genes) if failed else genes
+
+    @cached("ensembl")
+    async def asearch_genes_by_symbols(self, species, symbols):
+        """
+        Async variant of search_genes_by_symbols.
+        """
+        symbols = list(dict.fromkeys(symbols))
+        found = {}
+        failed = False
+        for chunk in self._chunks(symbols, self.LOOKUP_BATCH_SIZE):
+            try:
+                endpoint = f"{self.base_url}/lookup/symbol/{species}"
+                response = await http_client.apost(endpoint, headers=self.headers, json={"symbols": chunk})
+                response.raise_for_status()
+                found.update(response.json() or {})
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"[ENSEMBL] Error in batch gene lookup for {chunk}: {str(e)}")
+                failed = True
+        genes = self._parse_gene_batch(found, symbols)
+        return Partial(genes) if failed else genes
+
+    @cached("ensembl")
+    def search_variants_consequences(self, species, variant_ids, max_results=3):
+        """
+        Batch variant of search_variant_consequences using POST /vep/{species}/id.
+        """
+        variant_ids = list(dict.fromkeys(variant_ids))
+        items = []
+        failed = False
+        for chunk in self._chunks(variant_ids, self.VEP_BATCH_SIZE):
+            try:
+                endpoint = f"{self.base_url}/vep/{species}/id"
+                response = http_client.post(endpoint, headers=self.headers, json={"ids": chunk})
+                response.raise_for_status()
+                items.extend(response.json())
+            except requests.exceptions.RequestException as e:
+                print(f"[ENSEMBL] Error in batch variant consequences for {chunk}: {str(e)}")
+                failed = True
+        consequences = self._parse_variant_batch(items, variant_ids, max_results)
+        return Partial(consequences) if failed else consequences
+
+    @cached("ensembl")
+    async def asearch_variants_consequences(self, species, variant_ids, max_results=3):
+        """
+        Async variant of search_variants_consequences.
+        """
+        variant_ids = list(dict.fromkeys(variant_ids))
+        items = []
+        failed = False
+        for chunk in self._chunks(variant_ids, self.VEP_BATCH_SIZE):
+            try:
+                endpoint = f"{self.base_url}/vep/{species}/id"
+                response = await http_client.apost(endpoint, headers=self.headers, json={"ids": chunk})
+                response.raise_for_status()
+                items.extend(response.json())
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"[ENSEMBL] Error in batch variant consequences for {chunk}: {str(e)}")
+                failed = True
+        consequences = self._parse_variant_batch(items, variant_ids, max_results)
+        return Partial(consequences) if failed else consequences
+
+    def _chunks(self, values, size):
+        return [values[i:i + size] for i in range(0, len(values), size)]
+
+    def _parse_gene_batch(self, found, symbols):
+        genes = []
+        for symbol in symbols:
+            data = found.get(symbol)
+            if data:
+                genes.append(self._parse_gene(data, symbol))
+        print(f"[ENSEMBL] Batch gene lookup found {len(genes)} of {len(symbols)} symbols")
+        return genes
+
+    def _parse_variant_batch(self, items, variant_ids, max_results):
+        # VEP echoes each requested ID back as "input"
+        by_variant = {}
+        for item in items:
+            by_variant.setdefault(item.get("input") or item.get("id"), []).append(item)
+        consequences = []
+        for variant_id in variant_ids:
+            consequences.extend(self._parse_variant_consequences(by_variant.get(variant_id, []), variant_id, max_results))
+        print(f"[ENSEMBL] Batch found {len(consequences)} consequences for {len(variant_ids)} variants")
+        return consequences
+
+    def _parse_gene(self, data, symbol):
+        return {
+            "id": data.get("id", ""),
+            "symbol": data.get("display_name", symbol),
+            "description": data.get("description", "No description available"),
+            "biotype": data.get("biotype", ""),
+            "chromosome": data.get("seq_region_name", ""),
+            "start": data.get("start", ""),
+            "end": data.get("end", ""),
+            "strand": "Forward" if data.get("strand", 1) == 1 else "Reverse"
+        }
+
+    def _parse_variant_consequences(self, data, variant_id, max_results):
+        consequences = []
+        for item in data[:max_results]:
+            for tc in item.get("transcript_consequences", [])[:max_results]:
+                consequence = {
+                    "variant_id": variant_id,
+                    "gene_symbol": tc.get("gene_symbol", ""),
+                    "transcript_id": tc.get("transcript_id", ""),
+                    "consequence_terms": tc.get("consequence_terms", []),
+                    "impact": tc.get("variant_allele", "")
+                }
+                consequences.append(consequence)
+        return consequences
+
+    def _parse_phenotypes(self, data, gene_symbol, max_results):
+        phenotypes = []
+        for item in data[:max_results]:
+            phenotype = {
+                "gene_symbol": gene_symbol,
+                "phenotype_description": item.get("description", "No description available"),
+                "source": item.get("source", ""),
+                "study": item.get("study", "")
+            }
+            phenotypes.append(phenotype)
+        return phenotypes
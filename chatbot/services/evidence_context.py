@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import inspect
+import logging
+
+from chatbot.services import tracing
+from chatbot.services.source_cache import make_key
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("evidence_context", default=None)
+
+
+class EvidenceContext:
+    def __init__(self):
+        """
+        Per-turn memo of service calls. Every (function, arguments) pair runs at
+        most once while the context is active; repeated calls, including ones made
+        while the first is still in flight, get the same parsed result back.
+        """
+        self._calls = {}
+        self._speculative = set()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.prefetch_hits = 0
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        # Calls are shielded from their callers, so anything still running past the turn is stopped here
+        for task in self._calls.values():
+            if not task.done():
+                task.cancel()
+        logger.info(
+            f"Evidence context: {self.misses} upstream calls, {self.hits} served from the turn memo, "
+            f"{self.prefetch_hits} of {self.prefetched} prefetches used"
+        )
+
+    async def call(self, fn, *args, **kwargs):
+        key = _key(fn, args, kwargs)
+        task = self._calls.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(_invoke(fn, *args, **kwargs))
+            self._calls[key] = task
+        else:
+            self.hits += 1
+            if key in self._speculative:
+                self._speculative.discard(key)
+                self.prefetch_hits += 1
+        # Shielded so one caller giving up doesn't cancel the lookup for the others
+        return await asyncio.shield(task)
+
+    def prefetch(self, fn, *args, **kwargs):
+        """
+        Start a call nobody has asked for yet. A later call() with the same
+        arguments picks up the running task instead of starting its own.
+        """
+        key = _key(fn, args, kwargs)
+        if key not in self._calls:
+            self.prefetched += 1
+            task = asyncio.ensure_future(_invoke(fn, *args, **kwargs))
+            # Nobody may ever await it, so a failure is logged here rather than at garbage collection
+            task.add_done_callback(_log_prefetch_failure)
+            self._calls[key] = task
+            self._speculative.add(key)
+
+    def drop_prefetches(self, keep=()):
+        """
+        Cancel the prefetches that turned out not to be needed.
+        Args:
+            keep: (fn, args, kwargs) tuples of the calls the turn is about to make.
+        """
+        wanted = {_key(fn, args, kwargs) for fn, args, kwargs in keep}
+        for key in self._speculative - wanted:
+            # A finished one already sits in the source cache, only running ones cost anything
+            task = self._calls.pop(key)
+            if not task.done():
+                task.cancel()
+        self._speculative &= wanted
+
+
+def _log_prefetch_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Prefetch failed: {str(task.exception())}")
+
+
+def _key(fn, args, kwargs):
+    return make_key("evidence", fn.__qualname__, [args, kwargs])
+
+
+async def _invoke(fn, *args, **kwargs):
+    # One span per service method call, its HTTP requests nest under it
+    with tracing.span(fn.__qualname__):
+        result = fn(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+
+def current_context():
+    return _current.get()
+
+
+async def call(fn, *args, **kwargs):
+    """Call fn through the active EvidenceContext, or directly when there is none."""
+    context = _current.get()
+    if context is None:
+        return await _invoke(fn, *args, **kwargs)
+    return await context.call(fn, *args, **kwargs)
@@ -1,7 +1,11 @@
-from Bio import Entrez
+import asyncio
+from xml.etree import ElementTree
+from Bio import Entrez, SeqIO
 import os
 from dotenv import load_dotenv
 import warnings
+from chatbot.services import circuit_breaker, deadline, rate_limiter
+from chatbot.services.source_cache import cached
 
 load_dotenv()
 
@@ -16,7 +20,17 @@ class GenBankService:
             )
             email = None
         Entrez.email = email
+        # Shares the NCBI key with PubMed so all E-utilities traffic gets the keyed rate limit
+        Entrez.api_key = os.getenv("PUBMED_API_KEY") or None
 
+    def _throttle(self):
+        circuit_breaker.check(rate_limiter.NCBI_HOST)
+        # Entrez only spaces calls within this process; take a slot from the shared NCBI bucket too
+        # Entrez has no per-call timeout, so at least don't start a call once the turn is out of time
+        if deadline.remaining() == 0 or not rate_limiter.acquire(rate_limiter.NCBI_HOST, deadline.timeout(rate_limiter.max_wait())):
+            raise TimeoutError("Timed out waiting for an NCBI rate limit slot")
+
+    @cached("genbank")
     def search_genbank(self, query, max_results=10):
         """
         Search GenBank using Biopython's Entrez module and return sequence metadata.
@@ -30,6 +44,7 @@ class GenBankService:
         """
         try:
             # Search GenBank for sequence IDs
+            self._throttle()
             handle = Entrez.esearch(db="nucleotide", term=query, retmax=max_results)
             search_results = Entrez.read(handle)
             handle.close()
@@ -37,26 +52,60 @@ class GenBankService:
             if not sequence_ids:
                 return []
 
-            # Fetch sequence records
-            sequences = []
-            for seq_id in sequence_ids:
-                try:
-                    # Retrieve the sequence record in GenBank format
-                    handle = Entrez.efetch(db="nucleotide", id=seq_id, rettype="gb", retmode="text")
-                    from Bio import SeqIO
-                    record = SeqIO.read(handle, "genbank")
-                    handle.close()
-                    sequences.append({
-                        "accession": record.id if record.id else "N/A",
-                        "definition": record.description if record.description else "No definition available",
-                        "organism": record.annotations.get("organism", "N/A")
-                    })
-                except Exception as e:
-                    print(f"Error fetching record {seq_id}: {str(e)}")
-                    continue
+            # One esummary call for all IDs; summaries carry the metadata without the sequence
+            self._throttle()
+            handle = Entrez.esummary(db="nucleotide", id=",".join(sequence_ids), version="2.0")
+            try:
+                sequences = list(self._iter_summaries(handle))
+            finally:
+                handle.close()
 
             return sequences
 
+        except circuit_breaker.CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Error searching GenBank: {str(e)}")
-            return []
\ No newline at end of file
+            return []
+
+    def fetch_full_record(self, accession):
+        """
+        Fetch and parse the complete GenBank record, sequence included.
+        Only use this when the record itself is needed, chromosome-sized entries run to megabytes.
+
+        Parameters:
+            accession (str): Accession or GI (e.g., "NM_000041.4").
+
+        Returns:
+            Bio.SeqRecord.SeqRecord: The parsed record.
+        """
+        self._throttle()
+        handle = Entrez.efetch(db="nucleotide", id=accession, rettype="gb", retmode="text")
+        try:
+            return SeqIO.read(handle, "genbank")
+        finally:
+            handle.close()
+
+    def _iter_summaries(self, handle):
+        """
+        Stream DocumentSummary elements out of an esummary response, freeing each once read.
+        """
+        for _, elem in ElementTree.iterparse(handle, events=("end",)):
+            if elem.tag != "DocumentSummary":
+                continue
+            if elem.find("error") is not None:
+                print(f"Error fetching record {elem.get('uid')}: {elem.findtext('error')}")
+            else:
+                yield {
+                    "accession": elem.findtext("AccessionVersion") or elem.findtext("Caption") or "N/A",
+                    "definition": elem.findtext("Title") or "No definition available",
+                    "organism": elem.findtext("Organism") or "N/A"
+                }
+            elem.clear()
+
+    async def asearch_genbank(self, query, max_results=10):
+        """
+        Async variant of search_genbank. Entrez only offers a blocking API, so the
+        lookup runs in a worker thread to keep the event loop free.
+        """
+        return await asyncio.to_thread(self.search_genbank, query, max_results)
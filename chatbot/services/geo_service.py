@@ -1,14 +1,23 @@
+import os
+import httpx
 import requests
 from typing import List, Dict
 from urllib.parse import quote
+from chatbot.services import http_client
+from chatbot.services.source_cache import cached
 
 class GeoService:
     def __init__(self):
         self.base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
         self.search_endpoint = "/esearch.fcgi"
         self.summary_endpoint = "/esummary.fcgi"
-        self.timeout = 10
 
+    def _with_key(self, params):
+        # Send the NCBI key when there is one, it raises our share of the E-utilities rate limit
+        api_key = os.getenv("PUBMED_API_KEY")
+        return {**params, "api_key": api_key} if api_key else params
+
+    @cached("geo")
     def search_geo(self, query: str, max_results: int = 3) -> List[Dict]:
         """
         Search NCBI GEO for studies relevant to the query.
@@ -29,7 +38,7 @@ class GeoService:
                 "retmode": "json"
             }
             print(f"Querying GEO search: {search_url} with params: {search_params}")
-            search_response = requests.get(search_url, params=search_params, timeout=self.timeout)
+            search_response = http_client.get(search_url, params=self._with_key(search_params))
             search_response.raise_for_status()
             search_data = search_response.json().get('esearchresult', {})
             id_list = search_data.get('idlist', [])
@@ -45,7 +54,7 @@ class GeoService:
                 "retmode": "json"
             }
             print(f"Querying GEO summary: {summary_url} with params: {summary_params}")
-            summary_response = requests.get(summary_url, params=summary_params, timeout=self.timeout)
+            summary_response = http_client.get(summary_url, params=self._with_key(summary_params))
             summary_response.raise_for_status()
             summary_data = summary_response.json().get('result', {})
             print(f"GEO summary response: {summary_data}")
@@ -69,6 +78,59 @@ class GeoService:
             print(f"Error parsing GEO response: {e}")
             return []
 
+    @cached("geo")
+    async def asearch_geo(self, query: str, max_results: int = 3) -> List[Dict]:
+        """
+        Async variant of search_geo.
+        """
+        try:
+            results = []
+            encoded_query = quote(f"{query} AND Homo sapiens[Organism] AND gse[EntryType]")
+            search_url = f"{self.base_url}{self.search_endpoint}"
+            search_params = {
+                "db": "gds",
+                "term": encoded_query,
+                "retmax": max_results,
+                "retmode": "json"
+            }
+            print(f"Querying GEO search: {search_url} with params: {search_params}")
+            search_response = await http_client.aget(search_url, params=self._with_key(search_params))
+            search_response.raise_for_status()
+            id_list = search_response.json().get('esearchresult', {}).get('idlist', [])
+            print(f"GEO search response IDs: {id_list}")
+
+            if not id_list:
+                return []
+
+            summary_url = f"{self.base_url}{self.summary_endpoint}"
+            summary_params = {
+                "db": "gds",
+                "id": ",".join(id_list),
+                "retmode": "json"
+            }
+            print(f"Querying GEO summary: {summary_url} with params: {summary_params}")
+            summary_response = await http_client.aget(summary_url, params=self._with_key(summary_params))
+            summary_response.raise_for_status()
+            summary_data = summary_response.json().get('result', {})
+
+            for geo_id in id_list:
+                parsed_data = self._parse_study_data(summary_data.get(geo_id, {}))
+                if self._is_ad_relevant(parsed_data):
+                    results.append(parsed_data)
+
+            print(f"GEO parsed results: {results}")
+            return results[:max_results]
+
+        except httpx.HTTPStatusError as e:
+            print(f"HTTP error querying GEO API: {e} (Status: {e.response.status_code})")
+            return []
+        except httpx.HTTPError as e:
+            print(f"Error querying GEO API: {e}")
+            return []
+        except ValueError as e:
+            print(f"Error parsing GEO response: {e}")
+            return []
+
     def _parse_study_data(self, data: Dict) -> Dict:
         """
         Parse GEO API response to extract relevant study data.
@@ -0,0 +1,368 @@
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from chatbot.services import circuit_breaker, deadline, metrics, rate_limiter, replay, tracing
+
+logger = logging.getLogger(__name__)
+
+# Hosts every chat turn may talk to, warmed up when a worker boots
+KNOWN_HOSTS = [
+    "rest.ensembl.org",
+    "rest.uniprot.org",
+    "eutils.ncbi.nlm.nih.gov",
+    "clinicaltrials.gov",
+    "www.proteinatlas.org",
+    "www.ebi.ac.uk",
+]
+
+DEFAULTS = {
+    "POOL_MAXSIZE": 10,
+    "MAX_CONNECTIONS": 100,
+    "KEEPALIVE_EXPIRY": 120,
+    "WARMUP": True,
+    "TIMEOUT": 15,
+}
+
+_lock = threading.Lock()
+_stats = defaultdict(lambda: {"requests": 0, "misses": 0})
+_session = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _config(key):
+    return getattr(settings, "UPSTREAM_HTTP", {}).get(key, DEFAULTS[key])
+
+
+def _count(host, n_requests=0, n_misses=0):
+    with _lock:
+        _stats[host]["requests"] += n_requests
+        _stats[host]["misses"] += n_misses
+
+
+class _CountingPoolMixin:
+    # urlopen checks a connection out once per request and only opens one on a pool miss
+    def _get_conn(self, *args, **kwargs):
+        _count(self.host, n_requests=1)
+        return super()._get_conn(*args, **kwargs)
+
+    def _new_conn(self):
+        _count(self.host, n_misses=1)
+        return super()._new_conn()
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class _ReplayAdapter(replay.ReplayAdapterMixin, _PooledAdapter):
+    pass
+
+
+def get_session():
+    """
+    Process-wide requests.Session with one keep-alive pool per upstream host.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = requests.Session()
+                adapter_class = _ReplayAdapter if replay.enabled() else _PooledAdapter
+                adapter = adapter_class(
+                    pool_connections=len(KNOWN_HOSTS) * 2,
+                    pool_maxsize=_config("POOL_MAXSIZE"),
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_client():
+    """
+    httpx.AsyncClient for the running event loop. httpx pools can't be shared
+    between loops, so each loop (one per ASGI worker) gets its own client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(
+            max_connections=_config("MAX_CONNECTIONS"),
+            max_keepalive_connections=_config("POOL_MAXSIZE") * len(KNOWN_HOSTS),
+            keepalive_expiry=_config("KEEPALIVE_EXPIRY"),
+        )
+        if replay.enabled():
+            # The client ignores limits given alongside a transport, the wrapped one gets them
+            client = httpx.AsyncClient(timeout=None, transport=replay.ReplayTransport(httpx.AsyncHTTPTransport(limits=limits)))
+        else:
+            client = httpx.AsyncClient(timeout=None, limits=limits)
+        _async_clients[loop] = client
+    return client
+
+
+def get(url, **kwargs):
+    """requests.get through the shared session."""
+    return _request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    """requests.post through the shared session."""
+    return _request("POST", url, **kwargs)
+
+
+def _request(method, url, **kwargs):
+    # Spans cover the breaker check and the rate limit wait as well as the request itself
+    with tracing.span(f"http {method}", url=url) as span:
+        response = _send(method, url, **kwargs)
+        span.set(status=response.status_code)
+        if not kwargs.get("stream"):
+            span.set(bytes=len(response.content))
+        return response
+
+
+def _send(method, url, **kwargs):
+    host = urlparse(url).hostname
+    circuit_breaker.check(host)
+    _throttle(host)
+    clipped = _apply_deadline(kwargs)
+    if kwargs["timeout"] <= 0:
+        raise requests.exceptions.Timeout(f"Turn deadline passed before the request to {host}")
+    started = time.monotonic()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        _record_error(host, isinstance(e, requests.exceptions.Timeout))
+        # Running out of turn budget says nothing about the upstream's health
+        if not (clipped and isinstance(e, requests.exceptions.Timeout)):
+            circuit_breaker.record(host, ok=False, error=e)
+        raise
+    elapsed = time.monotonic() - started
+    circuit_breaker.record(host, ok=response.status_code < 500, elapsed=elapsed, error=f"HTTP {response.status_code}")
+    # A streamed body isn't read yet, its size is unknown here
+    _record_response(host, elapsed, None if kwargs.get("stream") else len(response.content))
+    return response
+
+
+def _record_response(host, elapsed, n_bytes):
+    metrics.observe("upstream_request_seconds", elapsed, host=host)
+    if n_bytes is not None:
+        metrics.observe("upstream_response_bytes", n_bytes, host=host)
+        metrics.count_bytes(n_bytes)
+
+
+def _record_error(host, timed_out):
+    metrics.inc("upstream_errors_total", host=host, kind="timeout" if timed_out else "error")
+
+
+def _apply_deadline(kwargs):
+    """
+    Set the request timeout to the caller's (or the default) timeout, cut down to
+    what is left of the active Deadline.
+    Returns:
+        True if the deadline, not the timeout itself, is the bound.
+    """
+    configured = kwargs.get("timeout") or _config("TIMEOUT")
+    kwargs["timeout"] = deadline.timeout(configured)
+    return kwargs["timeout"] < configured
+
+
+def _throttle(host):
+    # Queue for the host's rate limit slot; surfaces as a timeout the services already handle
+    if not rate_limiter.acquire(host, deadline.timeout(rate_limiter.max_wait())):
+        raise requests.exceptions.Timeout(f"Timed out waiting for a rate limit slot for {host}")
+
+
+async def _athrottle(host):
+    if not await rate_limiter.aacquire(host, deadline.timeout(rate_limiter.max_wait())):
+        raise httpx.PoolTimeout(f"Timed out waiting for a rate limit slot for {host}")
+
+
+async def aget(url, **kwargs):
+    """GET through the loop's shared httpx.AsyncClient."""
+    return await _arequest("GET", url, **kwargs)
+
+
+async def apost(url, **kwargs):
+    """POST through the loop's shared httpx.AsyncClient."""
+    return await _arequest("POST", url, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def astream(method, url, **kwargs):
+    """Streaming request through the loop's shared httpx.AsyncClient, body read via aiter_bytes()."""
+    with tracing.span(f"http {method}", url=url, streamed=True) as span:
+        async with _astream(method, url, **kwargs) as response:
+            span.set(status=response.status_code)
+            yield response
+            span.set(bytes=response.num_bytes_downloaded)
+
+
+@contextlib.asynccontextmanager
+async def _astream(method, url, **kwargs):
+    host = urlparse(url).hostname
+    await circuit_breaker.acheck(host)
+    await _athrottle(host)
+    clipped = _apply_deadline(kwargs)
+    if kwargs["timeout"] <= 0:
+        raise httpx.TimeoutException(f"Turn deadline passed before the request to {host}")
+    opened = _trace_connections(kwargs)
+    started = time.monotonic()
+    try:
+        async with get_async_client().stream(method, url, **kwargs) as response:
+            await circuit_breaker.arecord(host, ok=response.status_code < 500, elapsed=time.monotonic() - started, error=f"HTTP {response.status_code}")
+            yield response
+            # Latency here includes reading the body, which is what the caller waited for
+            _record_response(host, time.monotonic() - started, response.num_bytes_downloaded)
+    except httpx.HTTPError as e:
+        _record_error(host, isinstance(e, httpx.TimeoutException))
+        if not (clipped and isinstance(e, httpx.TimeoutException)):
+            await circuit_breaker.arecord(host, ok=False, error=e)
+        raise
+    finally:
+        _count(host, n_requests=1, n_misses=len(opened))
+
+
+async def _arequest(method, url, **kwargs):
+    with tracing.span(f"http {method}", url=url) as span:
+        response = await _asend(method, url, **kwargs)
+        span.set(status=response.status_code, bytes=len(response.content))
+        return response
+
+
+async def _asend(method, url, **kwargs):
+    host = urlparse(url).hostname
+    await circuit_breaker.acheck(host)
+    await _athrottle(host)
+    clipped = _apply_deadline(kwargs)
+    if kwargs["timeout"] <= 0:
+        raise httpx.TimeoutException(f"Turn deadline passed before the request to {host}")
+    opened = _trace_connections(kwargs)
+    started = time.monotonic()
+    try:
+        response = await get_async_client().request(method, url, **kwargs)
+    except httpx.HTTPError as e:
+        _record_error(host, isinstance(e, httpx.TimeoutException))
+        if not (clipped and isinstance(e, httpx.TimeoutException)):
+            await circuit_breaker.arecord(host, ok=False, error=e)
+        raise
+    finally:
+        _count(host, n_requests=1, n_misses=len(opened))
+    elapsed = time.monotonic() - started
+    await circuit_breaker.arecord(host, ok=response.status_code < 500, elapsed=elapsed, error=f"HTTP {response.status_code}")
+    _record_response(host, elapsed, len(response.content))
+    return response
+
+
+def _trace_connections(kwargs):
+    # httpx reports connection setup through the "trace" extension; a new TCP connect is a pool miss
+    opened = []
+
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.started":
+            opened.append(event_name)
+
+    extensions = dict(kwargs.pop("extensions", None) or {})
+    extensions["trace"] = trace
+    kwargs["extensions"] = extensions
+    return opened
+
+
+def pool_stats():
+    """
+    Connection reuse per host since the worker started.
+    Returns:
+        Dict of {host: {"requests", "hits", "misses"}}, a miss being a request that had to open a new connection.
+    """
+    with _lock:
+        return {
+            host: {"requests": s["requests"], "hits": s["requests"] - s["misses"], "misses": s["misses"]}
+            for host, s in _stats.items()
+        }
+
+
+def warm_up():
+    """Open a connection to every known host in the background (sync session)."""
+    if not _config("WARMUP") or replay.enabled():
+        return
+
+    def run():
+        session = get_session()
+        for host in KNOWN_HOSTS:
+            try:
+                session.head(f"https://{host}/", timeout=5)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Connection warm-up failed for {host}: {str(e)}")
+
+    threading.Thread(target=run, name="http-warmup", daemon=True).start()
+
+
+async def awarm_up():
+    """Open a connection to every known host from the running loop's async client."""
+    if not _config("WARMUP") or replay.enabled():
+        return
+
+    async def head(host):
+        try:
+            await get_async_client().head(f"https://{host}/", timeout=5)
+        except httpx.HTTPError as e:
+            logger.warning(f"Connection warm-up failed for {host}: {str(e)}")
+
+    await asyncio.gather(*(head(host) for host in KNOWN_HOSTS))
+
+
+async def aclose():
+    """Close the running loop's async client, e.g. on worker shutdown."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _reset_after_fork():
+    # Sockets inherited from a preloading parent must not be shared between workers
+    global _session, _lock
+    _session = None
+    _lock = threading.Lock()
+    _async_clients.clear()
+    _stats.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _reset_on_setting_change(setting, **kwargs):
+    # Tests switch record/replay on with override_settings; clients are built for the mode at hand
+    global _session
+    if setting in ("UPSTREAM_HTTP", "UPSTREAM_REPLAY"):
+        _session = None
+        _async_clients.clear()
+
+
+setting_changed.connect(_reset_on_setting_change, dispatch_uid="chatbot.http_client.reset_clients")
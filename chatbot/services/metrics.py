@@ -0,0 +1,353 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    "PATH": None,
+    "FLUSH_INTERVAL": 5,
+    "TOKEN": None,
+}
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+DB_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+BYTES_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100)
+
+# {name: (type, help, histogram buckets)}
+METRICS = {
+    "chat_stage_seconds": ("histogram", "Time spent in each stage of a chat turn (routing, sources, assembly, first_token, generation, turn)", LATENCY_BUCKETS),
+    "chat_source_seconds": ("histogram", "Run time of each source task", LATENCY_BUCKETS),
+    "chat_source_bytes": ("histogram", "Upstream response bytes downloaded by each source task", BYTES_BUCKETS),
+    "chat_source_results": ("histogram", "Results (prompt entries, records) returned by each source task", COUNT_BUCKETS),
+    "chat_source_outcomes_total": ("counter", "Source tasks by outcome: finished, failed or timed_out", None),
+    "upstream_request_seconds": ("histogram", "Upstream HTTP request latency per host", LATENCY_BUCKETS),
+    "upstream_response_bytes": ("histogram", "Upstream HTTP response size per host", BYTES_BUCKETS),
+    "upstream_errors_total": ("counter", "Upstream HTTP requests that raised, by host and kind (timeout or error)", None),
+    "openai_tokens_total": ("counter", "OpenAI tokens used, by model, purpose and kind (prompt or completion)", None),
+    "chat_view_seconds": ("histogram", "Chat view latency, up to the response (streams keep running after)", LATENCY_BUCKETS),
+    "chat_db_query_seconds": ("histogram", "Database query time in the chat views, by view and statement", DB_BUCKETS),
+    "chat_admission_wait_seconds": ("histogram", "Time chat turns spent waiting for admission, by outcome", LATENCY_BUCKETS),
+    "chat_admission_rejections_total": ("counter", "Chat turns answered 429, by reason", None),
+}
+
+# Bytes downloaded by the running source task, see source_bytes()
+_source_bytes = contextvars.ContextVar("metrics_source_bytes", default=None)
+# Chat view whose DB queries are being timed
+_db_view = contextvars.ContextVar("metrics_db_view", default=None)
+
+_lock = threading.Lock()
+_pending = {}
+_flusher = None
+
+
+def _config(key):
+    return getattr(settings, "METRICS", {}).get(key, DEFAULTS[key])
+
+
+def enabled():
+    return _config("ENABLED")
+
+
+def _path():
+    return str(_config("PATH") or os.path.join(settings.BASE_DIR, "cache", "metrics.sqlite3"))
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Add amount to a counter."""
+    if not enabled() or not amount:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _pending[key] = _pending.get(key, 0) + amount
+    _ensure_flusher()
+
+
+def observe(name, value, **labels):
+    """Record one histogram observation."""
+    if not enabled():
+        return
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        series = _pending.get(key)
+        if series is None:
+            # Per-bucket (not yet cumulative) counts, the last one being +Inf, then sum and count
+            series = _pending[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+    _ensure_flusher()
+
+
+class timer:
+    """Observe the seconds spent in a with block: `with metrics.timer("chat_stage_seconds", stage="routing"):`."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def record_openai_usage(model, purpose, usage):
+    """Count the prompt and completion tokens of an OpenAI response's usage, when it has one."""
+    if usage is None:
+        return
+    inc("openai_tokens_total", usage.prompt_tokens or 0, model=model, purpose=purpose, kind="prompt")
+    inc("openai_tokens_total", usage.completion_tokens or 0, model=model, purpose=purpose, kind="completion")
+
+
+def source_bytes():
+    """
+    Start counting downloaded bytes for the current task (a source lookup).
+    Returns:
+        A one item list holding the count, updated by count_bytes in this task and the ones it starts.
+    """
+    cell = [0]
+    _source_bytes.set(cell)
+    return cell
+
+
+def count_bytes(n):
+    cell = _source_bytes.get()
+    if cell is not None:
+        cell[0] += n
+
+
+def instrument_view(name):
+    """
+    Decorator for chat views (sync or async): times the view and every DB query
+    it makes, labelled with name.
+    """
+    def decorator(view_func):
+        if inspect.iscoroutinefunction(view_func):
+            @functools.wraps(view_func)
+            async def _wrapper_view(request, *args, **kwargs):
+                token = _db_view.set(name)
+                try:
+                    with timer("chat_view_seconds", view=name):
+                        return await view_func(request, *args, **kwargs)
+                finally:
+                    _db_view.reset(token)
+        else:
+            @functools.wraps(view_func)
+            def _wrapper_view(request, *args, **kwargs):
+                # Reset afterwards, a WSGI thread's context carries over to its next request
+                token = _db_view.set(name)
+                try:
+                    with timer("chat_view_seconds", view=name):
+                        return view_func(request, *args, **kwargs)
+                finally:
+                    _db_view.reset(token)
+        return _wrapper_view
+    return decorator
+
+
+def _time_query(execute, sql, params, many, context):
+    view = _db_view.get()
+    if view is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql else "OTHER"
+        observe("chat_db_query_seconds", time.perf_counter() - started, view=view, statement=statement)
+
+
+def _install_query_timer(sender, connection, **kwargs):
+    # execute_wrappers outlives reconnects, only add the wrapper once per connection object
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(_install_query_timer, dispatch_uid="chatbot.metrics.query_timer")
+
+
+# Aggregation across worker processes: each one adds what it recorded since its
+# last flush to a SQLite file on the host, which /metrics reads.
+
+class MetricsStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                "name TEXT NOT NULL, labels TEXT NOT NULL, suffix TEXT NOT NULL, value REAL NOT NULL, "
+                "PRIMARY KEY (name, labels, suffix))"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, rows):
+        """Add (name, labels json, suffix, value) rows to the stored totals in one transaction."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO samples (name, labels, suffix, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name, labels, suffix) DO UPDATE SET value = value + excluded.value",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def rows(self):
+        return self._connect().execute("SELECT name, labels, suffix, value FROM samples ORDER BY name, labels").fetchall()
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = MetricsStore(_path())
+    return _store
+
+
+def flush():
+    """Move this process's pending samples into the shared store."""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return
+    rows = []
+    for (name, labels), value in pending.items():
+        labels_json = json.dumps(labels)
+        if isinstance(value, list):
+            buckets = METRICS[name][2]
+            for bound, count in zip(list(buckets) + ["+Inf"], value[0]):
+                if count:
+                    rows.append((name, labels_json, f"bucket:{bound}", count))
+            rows.append((name, labels_json, "sum", value[1]))
+            rows.append((name, labels_json, "count", value[2]))
+        else:
+            rows.append((name, labels_json, "", value))
+    try:
+        get_store().add(rows)
+    except sqlite3.Error as e:
+        # Dropping a few seconds of samples beats blocking the workers on a broken file
+        logger.warning(f"Could not flush metrics: {str(e)}")
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(_config("FLUSH_INTERVAL"))
+                flush()
+
+        _flusher = threading.Thread(target=run, name="metrics-flush", daemon=True)
+        _flusher.start()
+
+
+atexit.register(flush)
+
+
+def _reset_after_fork():
+    # The flusher thread doesn't survive a fork and the parent's samples are its own to flush
+    global _lock, _pending, _flusher, _store
+    _lock = threading.Lock()
+    _pending = {}
+    _flusher = None
+    _store = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    # Whole numbers as integers and the rest at full precision, :g would round a
+    # counter past 999999 to 6 digits and flatten it between scrapes
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render(gauges=()):
+    """
+    All workers' metrics in the Prometheus text exposition format.
+    Args:
+        gauges: (name, help, [(labels dict, value)]) tuples read at scrape time.
+    """
+    flush()
+    series = {}
+    for name, labels_json, suffix, value in get_store().rows():
+        series.setdefault(name, {}).setdefault(tuple(tuple(pair) for pair in json.loads(labels_json)), {})[suffix] = value
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        if name not in series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, samples in series[name].items():
+            if kind == "counter":
+                lines.append(f"{name}{_labels_text(labels)} {_number(samples.get('', 0))}")
+                continue
+            cumulative = 0
+            for bound in list(buckets) + ["+Inf"]:
+                cumulative += samples.get(f"bucket:{bound}", 0)
+                lines.append(f"{name}_bucket{_labels_text(labels, [('le', bound)])} {_number(cumulative)}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {_number(samples.get('sum', 0))}")
+            lines.append(f"{name}_count{_labels_text(labels)} {_number(samples.get('count', 0))}")
+
+    for name, help_text, values in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values:
+            lines.append(f"{name}{_labels_text(sorted(labels.items()))} {_number(value)}")
+    return "\n".join(lines) + "\n"
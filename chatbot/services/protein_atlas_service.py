@@ -1,13 +1,16 @@
+import httpx
 import requests
 from typing import List, Dict
 from urllib.parse import quote
+from chatbot.services import http_client
+from chatbot.services.source_cache import cached
 
 class ProteinAtlasService:
     def __init__(self):
         self.base_url = "https://www.proteinatlas.org"
         self.search_api_endpoint = "/api/search_download.php"
-        self.timeout = 10
 
+    @cached("protein_atlas")
     def search_protein_atlas(self, query: str, max_results: int = 3, ensembl_id: str = None) -> List[Dict]:
         """
         Search the Human Protein Atlas for protein data by query or Ensembl ID.
@@ -19,30 +22,10 @@ class ProteinAtlasService:
             List of dictionaries with protein data (name, gene, expression, pathology).
         """
         try:
-            results = []
-            if ensembl_id:
-                # Query individual entry by Ensembl ID (e.g., https://www.proteinatlas.org/ENSG00000142192.json)
-                url = f"{self.base_url}/{ensembl_id}.json"
-                response = requests.get(url, timeout=self.timeout)
-                response.raise_for_status()
-                data = response.json()
-                parsed_data = self._parse_protein_data(data)
-                if self._is_ad_relevant(parsed_data):
-                    results.append(parsed_data)
-            else:
-                # Query by protein name/keyword using search_download.php
-                encoded_query = quote(query)
-                columns = "g,gs,eg,t_RNA_cerebral_cortex,di,up,scl"  # Relevant columns for AD
-                url = f"{self.base_url}{self.search_api_endpoint}?search={encoded_query}&format=json&columns={columns}&compress=no"
-                response = requests.get(url, timeout=self.timeout)
-                response.raise_for_status()
-                data = response.json()
-                for item in data[:max_results]:
-                    parsed_data = self._parse_protein_data(item)
-                    if self._is_ad_relevant(parsed_data):
-                        results.append(parsed_data)
-
-            return results[:max_results]
+            url = self._search_url(query, ensembl_id)
+            response = http_client.get(url)
+            response.raise_for_status()
+            return self._parse_response(response.json(), max_results, ensembl_id)
 
         except requests.exceptions.HTTPError as e:
             if e.response.status_code == 400:
@@ -59,6 +42,51 @@ class ProteinAtlasService:
             print(f"Error parsing Protein Atlas response: {e}")
             return []
 
+    @cached("protein_atlas")
+    async def asearch_protein_atlas(self, query: str, max_results: int = 3, ensembl_id: str = None) -> List[Dict]:
+        """
+        Async variant of search_protein_atlas.
+        """
+        try:
+            url = self._search_url(query, ensembl_id)
+            response = await http_client.aget(url)
+            response.raise_for_status()
+            return self._parse_response(response.json(), max_results, ensembl_id)
+
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 400:
+                print(f"Bad request to Protein Atlas API: {e}")
+            elif e.response.status_code == 500:
+                print(f"Server error from Protein Atlas API: {e}")
+            else:
+                print(f"HTTP error querying Protein Atlas API: {e}")
+            return []
+        except httpx.HTTPError as e:
+            print(f"Error querying Protein Atlas API: {e}")
+            return []
+        except ValueError as e:
+            print(f"Error parsing Protein Atlas response: {e}")
+            return []
+
+    def _search_url(self, query: str, ensembl_id: str = None) -> str:
+        if ensembl_id:
+            # Query individual entry by Ensembl ID (e.g., https://www.proteinatlas.org/ENSG00000142192.json)
+            return f"{self.base_url}/{ensembl_id}.json"
+        # Query by protein name/keyword using search_download.php
+        encoded_query = quote(query)
+        columns = "g,gs,eg,t_RNA_cerebral_cortex,di,up,scl"  # Relevant columns for AD
+        return f"{self.base_url}{self.search_api_endpoint}?search={encoded_query}&format=json&columns={columns}&compress=no"
+
+    def _parse_response(self, data, max_results: int, ensembl_id: str = None) -> List[Dict]:
+        # A direct Ensembl ID lookup returns a single entry, a search returns a list
+        items = [data] if ensembl_id else data[:max_results]
+        results = []
+        for item in items:
+            parsed_data = self._parse_protein_data(item)
+            if self._is_ad_relevant(parsed_data):
+                results.append(parsed_data)
+        return results[:max_results]
+
     def _parse_protein_data(self, data: Dict) -> Dict:
         """
         Parse HPA API response to extract relevant protein data.
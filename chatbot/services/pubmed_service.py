@@ -1,6 +1,11 @@
-import requests
 from xml.etree import ElementTree
+from chatbot.services import http_client
+from chatbot.services.source_cache import cached
 
+BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+CHUNK_SIZE = 64 * 1024
+
+@cached("pubmed", ignore=("api_key",))
 def search_pubmed(query, api_key, max_results=10):
     """
     Search PubMed using the E-utilities API and return results.
@@ -13,54 +18,135 @@ def search_pubmed(query, api_key, max_results=10):
     Returns:
         list: A list of dictionaries with PubMed IDs, titles, and abstracts.
     """
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    
-    # Step 1: Search for articles using `esearch`
-    search_url = f"{base_url}esearch.fcgi"
-    search_params = {
+    return list(iter_pubmed(query, api_key, max_results=max_results))
+
+@cached("pubmed", ignore=("api_key",))
+async def asearch_pubmed(query, api_key, max_results=10):
+    """
+    Async variant of search_pubmed.
+    """
+    return [article async for article in aiter_pubmed(query, api_key, max_results=max_results)]
+
+def iter_pubmed(query, api_key, max_results=10, batch_size=100):
+    """
+    Yield PubMed articles one at a time with bounded memory.
+
+    The search is stored on the NCBI history server (usehistory=y) and efetch
+    pages through it batch_size records at a time, so hundreds of candidates
+    can be pulled for reranking. Each page is parsed as it streams in.
+
+    Parameters:
+        query (str): The search query.
+        api_key (str): NCBI API key, raises the rate limit from 3 to 10 requests/second.
+        max_results (int): Maximum number of articles to yield.
+        batch_size (int): Records per efetch request.
+
+    Yields:
+        dict: PubMed ID, title and abstract (structured sections joined).
+    """
+    search_response = http_client.get(f"{BASE_URL}esearch.fcgi", params=_search_params(query, api_key))
+    search_response.raise_for_status()
+    history = _history(search_response.json(), max_results)
+    if history is None:
+        return
+
+    for fetch_params in _fetch_pages(history, api_key, batch_size):
+        with http_client.get(f"{BASE_URL}efetch.fcgi", params=fetch_params, stream=True) as fetch_response:
+            fetch_response.raise_for_status()
+            stream = _ArticleStream()
+            for chunk in fetch_response.iter_content(chunk_size=CHUNK_SIZE):
+                yield from stream.feed(chunk)
+
+async def aiter_pubmed(query, api_key, max_results=10, batch_size=100):
+    """
+    Async variant of iter_pubmed.
+    """
+    search_response = await http_client.aget(f"{BASE_URL}esearch.fcgi", params=_search_params(query, api_key))
+    search_response.raise_for_status()
+    history = _history(search_response.json(), max_results)
+    if history is None:
+        return
+
+    for fetch_params in _fetch_pages(history, api_key, batch_size):
+        async with http_client.astream("GET", f"{BASE_URL}efetch.fcgi", params=fetch_params) as fetch_response:
+            fetch_response.raise_for_status()
+            stream = _ArticleStream()
+            async for chunk in fetch_response.aiter_bytes(CHUNK_SIZE):
+                for article in stream.feed(chunk):
+                    yield article
+
+def _search_params(query, api_key):
+    params = {
         "db": "pubmed",
         "term": query,
-        "retmax": max_results,
-        # "api_key": api_key,
+        "retmax": 0,
+        "usehistory": "y",
         "retmode": "json"
     }
-    search_response = requests.get(search_url, params=search_params)
-    search_response.raise_for_status()
-    search_data = search_response.json()
-    
-    # Extract PubMed IDs (PMIDs)
-    pmids = search_data.get("esearchresult", {}).get("idlist", [])
-    
-    if not pmids:
-        return []
-    
-    # Step 2: Fetch details for the articles using `efetch`
-    fetch_url = f"{base_url}efetch.fcgi"
-    fetch_params = {
-        "db": "pubmed",
-        "id": ",".join(pmids),
-        "retmode": "xml",
-        # "api_key": api_key
+    if api_key:
+        params["api_key"] = api_key
+    return params
+
+def _history(search_data, max_results):
+    result = search_data.get("esearchresult", {})
+    total = min(int(result.get("count", 0)), max_results)
+    if not total or not result.get("webenv"):
+        return None
+    return {"WebEnv": result["webenv"], "query_key": result["querykey"], "total": total}
+
+def _fetch_pages(history, api_key, batch_size):
+    for retstart in range(0, history["total"], batch_size):
+        params = {
+            "db": "pubmed",
+            "WebEnv": history["WebEnv"],
+            "query_key": history["query_key"],
+            "retstart": retstart,
+            "retmax": min(batch_size, history["total"] - retstart),
+            "retmode": "xml"
+        }
+        if api_key:
+            params["api_key"] = api_key
+        yield params
+
+class _ArticleStream:
+    """Incremental efetch XML parser that frees each article once it has been read."""
+
+    def __init__(self):
+        self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self._root = None
+
+    def feed(self, chunk):
+        self._parser.feed(chunk)
+        for event, elem in self._parser.read_events():
+            if event == "start":
+                if self._root is None:
+                    self._root = elem
+                continue
+            if elem.tag == "PubmedArticle":
+                yield _parse_article(elem)
+            if self._root is not None and elem in self._root:
+                # Top-level record done, drop it from the tree
+                self._root.remove(elem)
+
+def _parse_article(article):
+    title_node = article.find(".//ArticleTitle")
+    title = "".join(title_node.itertext()).strip() if title_node is not None else "Untitled"
+
+    # Structured abstracts come as several labelled AbstractText sections
+    sections = []
+    for node in article.findall(".//Abstract/AbstractText"):
+        text = "".join(node.itertext()).strip()
+        if not text:
+            continue
+        label = node.get("Label")
+        sections.append(f"{label}: {text}" if label else text)
+    abstract_text = "\n".join(sections) if sections else "No abstract available."
+
+    return {
+        "pmid": article.findtext(".//PMID"),
+        "title": title,
+        "abstract": abstract_text
     }
-    fetch_response = requests.get(fetch_url, params=fetch_params)
-    fetch_response.raise_for_status()
-    
-    # Parse XML response
-    root = ElementTree.fromstring(fetch_response.content)
-    articles = []
-    
-    for article in root.findall(".//PubmedArticle"):
-        title = article.find(".//ArticleTitle").text
-        abstract = article.find(".//Abstract/AbstractText")
-        abstract_text = abstract.text if abstract is not None else "No abstract available."
-        pmid = article.find(".//PMID").text
-        
-        articles.append({
-            "pmid": pmid,
-            "title": title,
-            "abstract": abstract_text
-        })
-    return articles
 
 # # Example Usage
 # api_key = "your_ncbi_api_key_here"  # Replace with your NCBI API key
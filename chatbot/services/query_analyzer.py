@@ -0,0 +1,303 @@
+import logging
+import re
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Canonical disease names keyed by the lowercase phrases that mention them
+DISEASES = {
+    "alzheimer disease": ["alzheimer's disease", "alzheimer’s disease", "alzheimers disease", "alzheimer disease", "alzheimer's", "alzheimer’s", "alzheimers", "alzheimer"],
+    "parkinson disease": ["parkinson's disease", "parkinson’s disease", "parkinsons disease", "parkinson disease", "parkinson's", "parkinson’s", "parkinsons", "parkinson"],
+    "huntington disease": ["huntington's disease", "huntington’s disease", "huntingtons disease", "huntington disease"],
+    "amyotrophic lateral sclerosis": ["amyotrophic lateral sclerosis", "als", "lou gehrig's disease"],
+    "multiple sclerosis": ["multiple sclerosis"],
+    "dementia": ["dementia"],
+    "epilepsy": ["epilepsy", "seizure disorder"],
+    "migraine": ["migraine", "migraines"],
+    "stroke": ["stroke", "ischemic stroke"],
+    "breast cancer": ["breast cancer", "mammary carcinoma", "breast neoplasm", "triple-negative breast cancer", "tnbc"],
+    "lung cancer": ["lung cancer", "non-small cell lung cancer", "nsclc", "small cell lung cancer"],
+    "prostate cancer": ["prostate cancer"],
+    "colorectal cancer": ["colorectal cancer", "colon cancer", "rectal cancer"],
+    "pancreatic cancer": ["pancreatic cancer", "pancreatic adenocarcinoma"],
+    "ovarian cancer": ["ovarian cancer"],
+    "melanoma": ["melanoma"],
+    "leukemia": ["leukemia", "leukaemia", "aml", "acute myeloid leukemia", "cll", "chronic lymphocytic leukemia"],
+    "lymphoma": ["lymphoma", "hodgkin lymphoma", "non-hodgkin lymphoma"],
+    "glioblastoma": ["glioblastoma", "gbm"],
+    "diabetes": ["diabetes", "diabetes mellitus", "diabetic"],
+    "type 1 diabetes": ["type 1 diabetes", "t1d"],
+    "type 2 diabetes": ["type 2 diabetes", "t2d"],
+    "obesity": ["obesity", "obese"],
+    "hypertension": ["hypertension", "high blood pressure"],
+    "heart failure": ["heart failure", "congestive heart failure"],
+    "coronary artery disease": ["coronary artery disease", "coronary heart disease"],
+    "atrial fibrillation": ["atrial fibrillation", "afib"],
+    "asthma": ["asthma"],
+    "chronic obstructive pulmonary disease": ["chronic obstructive pulmonary disease", "copd"],
+    "cystic fibrosis": ["cystic fibrosis"],
+    "rheumatoid arthritis": ["rheumatoid arthritis"],
+    "osteoarthritis": ["osteoarthritis"],
+    "lupus": ["lupus", "systemic lupus erythematosus", "sle"],
+    "psoriasis": ["psoriasis"],
+    "crohn disease": ["crohn's disease", "crohn’s disease", "crohns disease", "crohn disease"],
+    "ulcerative colitis": ["ulcerative colitis"],
+    "chronic kidney disease": ["chronic kidney disease", "ckd"],
+    "hiv": ["hiv", "hiv/aids", "aids"],
+    "hepatitis b": ["hepatitis b", "hbv"],
+    "hepatitis c": ["hepatitis c", "hcv"],
+    "tuberculosis": ["tuberculosis"],
+    "covid-19": ["covid-19", "covid", "sars-cov-2"],
+    "depression": ["depression", "major depressive disorder"],
+    "schizophrenia": ["schizophrenia"],
+    "bipolar disorder": ["bipolar disorder"],
+    "autism": ["autism", "autism spectrum disorder"],
+    "sickle cell disease": ["sickle cell disease", "sickle cell anemia"],
+}
+
+TREATMENTS = {
+    "metformin": ["metformin", "glucophage"],
+    "insulin": ["insulin therapy", "insulin"],
+    "semaglutide": ["semaglutide", "ozempic", "wegovy"],
+    "tirzepatide": ["tirzepatide", "mounjaro"],
+    "lecanemab": ["lecanemab", "leqembi"],
+    "donanemab": ["donanemab"],
+    "aducanumab": ["aducanumab", "aduhelm"],
+    "anti-amyloid": ["anti-amyloid", "anti-amyloid antibodies", "anti-amyloid therapy"],
+    "donepezil": ["donepezil", "aricept"],
+    "memantine": ["memantine"],
+    "levodopa": ["levodopa", "l-dopa", "carbidopa-levodopa"],
+    "deep brain stimulation": ["deep brain stimulation", "dbs"],
+    "chemotherapy": ["chemotherapy"],
+    "immunotherapy": ["immunotherapy", "checkpoint inhibitors", "checkpoint inhibitor"],
+    "radiotherapy": ["radiotherapy", "radiation therapy"],
+    "pembrolizumab": ["pembrolizumab", "keytruda"],
+    "nivolumab": ["nivolumab", "opdivo"],
+    "trastuzumab": ["trastuzumab", "herceptin"],
+    "tamoxifen": ["tamoxifen"],
+    "olaparib": ["olaparib", "parp inhibitor", "parp inhibitors"],
+    "paclitaxel": ["paclitaxel", "taxol"],
+    "car-t": ["car-t", "car t-cell therapy", "car t cell therapy"],
+    "statins": ["statin", "statins", "atorvastatin", "rosuvastatin", "simvastatin"],
+    "aspirin": ["aspirin"],
+    "ace inhibitors": ["ace inhibitor", "ace inhibitors", "lisinopril"],
+    "adalimumab": ["adalimumab", "humira"],
+    "methotrexate": ["methotrexate"],
+    "gene therapy": ["gene therapy"],
+    "crispr": ["crispr", "gene editing"],
+    "stem cell therapy": ["stem cell therapy", "stem cell transplant"],
+    "vaccine": ["vaccine", "vaccines", "vaccination"],
+    "lithium": ["lithium"],
+    "ssri": ["ssri", "ssris", "sertraline", "fluoxetine"],
+    "exercise": ["exercise", "physical activity"],
+}
+
+PROTEINS = {
+    "amyloid-beta": ["amyloid-beta", "amyloid beta", "beta-amyloid", "abeta", "amyloid"],
+    "tau": ["tau", "tau protein", "phosphorylated tau", "p-tau"],
+    "alpha-synuclein": ["alpha-synuclein", "α-synuclein", "alpha synuclein"],
+    "huntingtin": ["huntingtin"],
+    "insulin": ["insulin receptor"],
+    "hemoglobin": ["hemoglobin", "haemoglobin"],
+    "p53": ["p53"],
+    "her2": ["her2"],
+    "pd-l1": ["pd-l1"],
+    "pd-1": ["pd-1"],
+    "egfr": ["egfr protein"],
+    "ace2": ["ace2 receptor"],
+    "spike protein": ["spike protein"],
+}
+
+PHENOTYPES = {
+    "cognitive decline": ["cognitive decline", "cognitive impairment", "memory loss"],
+    "motor dysfunction": ["motor dysfunction", "motor symptoms"],
+    "tremor": ["tremor", "tremors"],
+    "neuroinflammation": ["neuroinflammation"],
+    "neurodegeneration": ["neurodegeneration"],
+    "insulin resistance": ["insulin resistance"],
+    "inflammation": ["inflammation"],
+    "fatigue": ["fatigue"],
+    "seizures": ["seizures"],
+}
+
+# HGNC symbols we recognize; anything else that looks like a symbol is left to the model
+GENES = {
+    "APOE", "APP", "PSEN1", "PSEN2", "MAPT", "TREM2", "CLU", "BIN1", "SORL1", "ABCA7",
+    "SNCA", "LRRK2", "PARK7", "PINK1", "PRKN", "GBA", "GBA1",
+    "HTT", "SOD1", "C9ORF72", "TARDBP", "FUS",
+    "BRCA1", "BRCA2", "TP53", "PTEN", "PIK3CA", "ERBB2", "ESR1", "PALB2", "ATM", "CHEK2",
+    "EGFR", "KRAS", "NRAS", "BRAF", "ALK", "ROS1", "MET", "RET", "MYC", "IDH1", "IDH2",
+    "APC", "MLH1", "MSH2", "CDKN2A", "RB1", "VHL", "NF1", "JAK2", "FLT3", "NPM1", "BCR", "ABL1",
+    "CFTR", "HBB", "DMD", "FMR1", "SMN1", "MECP2",
+    "INS", "INSR", "TCF7L2", "PPARG", "KCNJ11", "GCK", "HNF1A", "FTO", "MC4R", "LEP",
+    "LDLR", "PCSK9", "APOB", "ACE", "ACE2", "AGT", "NOS3",
+    "IL6", "TNF", "IL1B", "HLA-DRB1", "HLA-B27", "CTLA4", "PDCD1", "CD274",
+    "MTHFR", "COMT", "BDNF", "SLC6A4", "DRD2", "CYP2D6", "CYP2C19", "VKORC1",
+}
+
+GENE_ALIASES = {"APOE2": "APOE", "APOE3": "APOE", "APOE4": "APOE", "HER2": "ERBB2"}
+
+# Abbreviations whose meaning depends on context (AD, MS, PD...) need the model
+AMBIGUOUS = {"AD", "MS", "PD", "RA", "MI", "CF", "CD", "HD"}
+
+# Uppercase words that are not gene symbols
+NOT_GENES = {
+    "I", "A", "DNA", "RNA", "MRNA", "CDNA", "MRI", "CT", "PET", "EEG", "ECG", "FDA", "EMA", "NIH", "WHO", "CDC",
+    "USA", "UK", "EU", "US", "OK", "FAQ", "BMI", "GWAS", "SNP", "SNPS", "CRISPR", "PCR", "NGS", "RCT", "RCTS",
+    "QOL", "ICU", "ER", "IV", "OR", "AND", "NOT", "VS", "ETC", "AI", "ML",
+} | {alias.upper() for aliases in DISEASES.values() for alias in aliases} \
+  | {alias.upper() for aliases in TREATMENTS.values() for alias in aliases} \
+  | {alias.upper() for aliases in PROTEINS.values() for alias in aliases}
+
+SPECIES = {
+    "human": "homo_sapiens", "humans": "homo_sapiens",
+    "mouse": "mus_musculus", "mice": "mus_musculus", "murine": "mus_musculus",
+    "rat": "rattus_norvegicus", "rats": "rattus_norvegicus",
+    "zebrafish": "danio_rerio", "drosophila": "drosophila_melanogaster", "yeast": "saccharomyces_cerevisiae",
+}
+
+RSID = re.compile(r"\brs\d{3,}\b", re.IGNORECASE)
+GENE_LIKE = re.compile(r"\b[A-Z][A-Z0-9]{1,7}(?:-[A-Z0-9]{1,4})?\b")
+SEQUENCE = re.compile(r"\b[ACGTU]{12,}\b")
+
+TRIALS_INTENT = re.compile(r"\b(clinical trials?|trials?|recruiting|enroll(?:ing|ment)?|phase [1-4i]+)\b", re.IGNORECASE)
+TREATMENT_INTENT = re.compile(r"\b(treatments?|therap(?:y|ies)|drugs?|medications?|interventions?)\b", re.IGNORECASE)
+PROTEIN_INTENT = re.compile(r"\b(proteins?|enzymes?|receptors?|biomarkers?)\b", re.IGNORECASE)
+EXPRESSION_INTENT = re.compile(r"\b(expression|expressed|tissues?|localization|atlas)\b", re.IGNORECASE)
+STUDIES_INTENT = re.compile(r"\b(datasets?|studies|biomarkers?|transcriptom\w*|microarray|rna-seq|gene expression)\b", re.IGNORECASE)
+SEQUENCE_INTENT = re.compile(r"\b(sequences?|sequencing|mrna|transcripts?|genbank)\b", re.IGNORECASE)
+FOLLOW_UP = re.compile(
+    r"^\s*(and|also|but|so|what about|how about|what else|tell me more|more|why|explain|same)\b"
+    r"|\b(it|its|this|that|these|those|they|them|their|above|previous|earlier|mentioned)\b",
+    re.IGNORECASE,
+)
+
+
+def _phrase_pattern(dictionary):
+    aliases = sorted({alias for aliases in dictionary.values() for alias in aliases}, key=len, reverse=True)
+    return re.compile(r"(?<![\w-])(" + "|".join(re.escape(a) for a in aliases) + r")(?![\w-])", re.IGNORECASE)
+
+
+def _lookup(dictionary):
+    return {alias.lower(): canonical for canonical, aliases in dictionary.items() for alias in aliases}
+
+
+_MATCHERS = [
+    (name, _phrase_pattern(dictionary), _lookup(dictionary))
+    for name, dictionary in (("disease", DISEASES), ("treatment", TREATMENTS), ("protein", PROTEINS), ("phenotype", PHENOTYPES))
+]
+
+_lock = threading.Lock()
+_paths = Counter()
+
+
+def _find(text):
+    found = {name: [] for name, _, _ in _MATCHERS}
+    for name, pattern, lookup in _MATCHERS:
+        for match in pattern.finditer(text):
+            canonical = lookup[match.group(1).lower()]
+            if canonical not in found[name]:
+                found[name].append(canonical)
+    return found
+
+
+def analyze(user_query, chat_history=None):
+    """
+    Pull keywords and API flags out of the query with patterns and dictionaries,
+    in the argument shape of the routing model's tools.
+    Returns:
+        Tuple (tool_name, args), or (None, None) when the query is ambiguous, a
+        follow-up, or mentions nothing we recognize; the model decides those.
+    """
+    if chat_history and FOLLOW_UP.search(user_query):
+        return None, None
+    return _extract(user_query, strict=True)
+
+
+def speculate(user_query):
+    """
+    Best guess at the routing model's answer, made while it is still thinking:
+    the entities we recognize, with anything unclear simply left out.
+    Returns:
+        Tuple (tool_name, args) like analyze(), or (None, None) when nothing is recognized.
+    """
+    return _extract(user_query, strict=False)
+
+
+def _extract(user_query, strict):
+    found = _find(user_query)
+    variant_ids = list(dict.fromkeys(m.lower() for m in RSID.findall(user_query)))
+    sequences = list(dict.fromkeys(SEQUENCE.findall(user_query)))
+
+    gene_symbols = []
+    for token in GENE_LIKE.findall(user_query):
+        symbol = GENE_ALIASES.get(token, token)
+        if token in AMBIGUOUS:
+            if strict:
+                return None, None
+        elif symbol in GENES or token in GENE_ALIASES:
+            if symbol not in gene_symbols:
+                gene_symbols.append(symbol)
+        elif strict and token not in NOT_GENES and not SEQUENCE.fullmatch(token) and not RSID.fullmatch(token):
+            # Looks like a symbol we don't know: could be a gene, an acronym or a typo
+            return None, None
+
+    if not (found["disease"] or gene_symbols or variant_ids or sequences or found["protein"]):
+        return None, None
+
+    wants_trials = bool(TRIALS_INTENT.search(user_query))
+    if wants_trials and found["disease"] and not (gene_symbols or variant_ids or sequences or found["protein"]):
+        return "get_clinical_trials", {
+            "disease_keywords": found["disease"],
+            "treatment_keywords": found["treatment"],
+            "need_trials": True,
+        }
+
+    species = "homo_sapiens"
+    for word in re.findall(r"[a-z]+", user_query.lower()):
+        if word in SPECIES:
+            species = SPECIES[word]
+            break
+
+    genes_or_proteins = bool(gene_symbols or found["protein"])
+    sequence_keywords = sequences + (gene_symbols if SEQUENCE_INTENT.search(user_query) else [])
+    protein_keywords = found["protein"] + (gene_symbols if PROTEIN_INTENT.search(user_query) else [])
+    args = {
+        "disease_keywords": found["disease"],
+        "treatment_keywords": found["treatment"],
+        "gene_symbols": gene_symbols,
+        "variant_ids": variant_ids,
+        "phenotype_terms": found["phenotype"],
+        "protein_keywords": protein_keywords,
+        "sequence_keywords": sequence_keywords,
+        "species": species,
+        "need_trials": bool(found["disease"]) and (wants_trials or bool(found["treatment"]) or bool(TREATMENT_INTENT.search(user_query))),
+        "need_pubmed": True,
+        "need_ensembl": bool(gene_symbols or variant_ids),
+        "need_uniprot": bool(protein_keywords),
+        "need_genbank": bool(sequence_keywords),
+        "need_protein_atlas": genes_or_proteins and bool(EXPRESSION_INTENT.search(user_query)),
+        "need_array_express": genes_or_proteins and bool(STUDIES_INTENT.search(user_query)),
+        "need_geo": genes_or_proteins and bool(STUDIES_INTENT.search(user_query)),
+    }
+    return "get_research_and_trials", args
+
+
+def record_path(path):
+    """Count a routing decision ('local' or 'llm') for this worker."""
+    with _lock:
+        _paths[path] += 1
+        local, llm = _paths["local"], _paths["llm"]
+    logger.info(f"Query routed by {path} analyzer ({local} local / {llm} llm in this worker)")
+
+
+def path_stats():
+    """
+    Returns:
+        Dict {"local", "llm", "local_share"} counted since the worker started.
+    """
+    with _lock:
+        local, llm = _paths["local"], _paths["llm"]
+    total = local + llm
+    return {"local": local, "llm": llm, "local_share": round(local / total, 3) if total else None}
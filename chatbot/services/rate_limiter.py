@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+NCBI_HOST = "eutils.ncbi.nlm.nih.gov"
+
+
+class RateLimiter:
+    def __init__(self, path, rates):
+        """
+        Token bucket per upstream host, kept in SQLite so every thread and
+        worker process on the host draws from the same buckets.
+        Args:
+            path: SQLite file location.
+            rates: Dict of {host: requests per second}. Hosts not listed are not limited.
+        """
+        self.path = str(path)
+        self.rates = rates
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "host TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def try_acquire(self, host):
+        """
+        Take a token for host if one is available.
+        Returns:
+            0 when a token was taken, otherwise the seconds until the next one is due.
+        """
+        rate = self.rates.get(host)
+        if not rate:
+            return 0
+        capacity = max(rate, 1)
+        conn = self._connect()
+        # BEGIN IMMEDIATE takes the write lock up front, serializing refill + take across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE host = ?", (host,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (host, tokens, updated_at) VALUES (?, ?, ?)",
+                (host, tokens, now),
+            )
+            conn.execute("COMMIT")
+            return wait
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def acquire(self, host, timeout=None):
+        """
+        Block until a token for host is available.
+        Returns:
+            False if none became available within timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(host)
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def aacquire(self, host, timeout=None):
+        """
+        Async variant of acquire.
+        """
+        if not self.rates.get(host):
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, host)
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+
+def _config():
+    return getattr(settings, "UPSTREAM_RATE_LIMITS", {})
+
+
+def default_rates():
+    # NCBI allows 3 requests/second per IP, or 10 per key when one is sent
+    return {NCBI_HOST: 10 if os.getenv("PUBMED_API_KEY") else 3}
+
+
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        config = _config()
+        rates = config.get("RATES")
+        _limiter = RateLimiter(
+            config.get("PATH", os.path.join(settings.BASE_DIR, "cache", "rate_limits.sqlite3")),
+            default_rates() if rates is None else rates,
+        )
+    return _limiter
+
+
+def max_wait():
+    """Seconds a request may queue for a slot before giving up."""
+    return _config().get("MAX_WAIT", 30)
+
+
+def acquire(host, timeout=None):
+    try:
+        return get_limiter().acquire(host, max_wait() if timeout is None else timeout)
+    except sqlite3.Error as e:
+        # Rather over-call than block every lookup if the state file is unusable
+        logger.warning(f"Rate limiter unavailable for {host}: {str(e)}")
+        return True
+
+
+async def aacquire(host, timeout=None):
+    try:
+        return await get_limiter().aacquire(host, max_wait() if timeout is None else timeout)
+    except sqlite3.Error as e:
+        logger.warning(f"Rate limiter unavailable for {host}: {str(e)}")
+        return True
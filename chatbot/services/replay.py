@@ -0,0 +1,275 @@
+import asyncio
+import atexit
+import base64
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+logger = logging.getLogger(__name__)
+
+OFF, RECORD, REPLAY = "off", "record", "replay"
+
+DEFAULTS = {
+    "MODE": OFF,
+    "PATH": None,
+    "CASSETTE": "default",
+    "LATENCY": False,
+    "LATENCY_SCALE": 1.0,
+}
+
+# Query parameters left out of fixture keys and files: credentials and contact details
+REDACTED_PARAMS = {"api_key", "key", "token", "email", "tool"}
+# The only response headers the services and the OpenAI client look at
+KEPT_HEADERS = ("content-type", "content-encoding")
+
+_lock = threading.Lock()
+_cassettes = {}
+_active = None
+
+
+def _config(key):
+    return getattr(settings, "UPSTREAM_REPLAY", {}).get(key, DEFAULTS[key])
+
+
+def mode():
+    return _config("MODE")
+
+
+def enabled():
+    """True when upstream and OpenAI requests go through the record/replay transports."""
+    return mode() in (RECORD, REPLAY)
+
+
+def _path(name):
+    directory = _config("PATH") or os.path.join(settings.BASE_DIR, "chatbot", "fixtures", "upstream")
+    return os.path.join(str(directory), f"{name}.json.gz")
+
+
+def request_key(method, url, body=None):
+    """
+    Fixture key of a request: method, URL with sorted and redacted query, and a
+    hash of the body (JSON bodies compared regardless of key order).
+    """
+    parts = urlsplit(str(url))
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in REDACTED_PARAMS)
+    key = f"{method.upper()} {urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))}"
+    if body:
+        if isinstance(body, str):
+            body = body.encode()
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode()
+        except ValueError:
+            pass
+        key += f" {hashlib.sha1(body).hexdigest()[:16]}"
+    return key
+
+
+class Cassette:
+    def __init__(self, path):
+        """
+        Recorded exchanges of one fixture file, {key: [response, ...]} in the order
+        they were made. A request replays the next response recorded for its key,
+        the last one once they run out.
+        """
+        self.path = path
+        self.interactions = {}
+        self.misses = []
+        self.dirty = False
+        self._cursors = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                self.interactions = json.load(f)["interactions"]
+
+    def find(self, key):
+        with self._lock:
+            entries = self.interactions.get(key)
+            if not entries:
+                self.misses.append(key)
+                return None
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = index + 1
+            return entries[min(index, len(entries) - 1)]
+
+    def add(self, key, status, headers, content, elapsed):
+        entry = {
+            "status": status,
+            "headers": {k: v for k, v in headers.items() if k.lower() in KEPT_HEADERS},
+            "elapsed": round(elapsed, 4),
+        }
+        try:
+            entry["body"] = content.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["body64"] = base64.b64encode(content).decode()
+        with self._lock:
+            self.interactions.setdefault(key, []).append(entry)
+            self.dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # mtime=0 keeps the file byte for byte the same when nothing was re-recorded
+            with open(self.path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+                f.write(json.dumps({"version": 1, "interactions": self.interactions}, sort_keys=True, separators=(",", ":")).encode())
+            self.dirty = False
+        print(f"[REPLAY] Saved {sum(len(v) for v in self.interactions.values())} exchanges to {self.path}")
+
+
+def _body(entry):
+    if "body64" in entry:
+        return base64.b64decode(entry["body64"])
+    return entry["body"].encode("utf-8")
+
+
+def current_cassette():
+    """The cassette requests are recorded to or replayed from (use_cassette's or UPSTREAM_REPLAY['CASSETTE'])."""
+    name = _active or _config("CASSETTE")
+    with _lock:
+        cassette = _cassettes.get(name)
+        if cassette is None:
+            cassette = _cassettes[name] = Cassette(_path(name))
+        return cassette
+
+
+@contextlib.contextmanager
+def use_cassette(name):
+    """
+    Record to or replay from the named fixture file inside the with block, e.g. one
+    per test or benchmark. The file is (re)loaded on entry and saved on exit when recording.
+    """
+    global _active
+    with _lock:
+        _cassettes.pop(name, None)
+    previous, _active = _active, name
+    try:
+        yield current_cassette()
+    finally:
+        _active = previous
+        if mode() == RECORD:
+            save()
+
+
+def save():
+    """Write the cassettes recorded to since the last save."""
+    with _lock:
+        cassettes = list(_cassettes.values())
+    for cassette in cassettes:
+        try:
+            cassette.save()
+        except OSError as e:
+            logger.error(f"Could not save fixtures to {cassette.path}: {str(e)}")
+
+
+atexit.register(save)
+
+
+def _replay_delay(entry):
+    if not _config("LATENCY"):
+        return 0
+    return entry.get("elapsed", 0) * _config("LATENCY_SCALE")
+
+
+def _miss(key):
+    message = f"No recorded response for {key}"
+    print(f"[REPLAY] {message}")
+    return message
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport):
+        """
+        httpx transport that records the exchanges of the wrapped (network)
+        transport, or answers from the fixtures without it.
+        """
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        cassette = current_cassette()
+        key = request_key(request.method, request.url, await request.aread())
+        if mode() == REPLAY:
+            entry = cassette.find(key)
+            if entry is None:
+                raise httpx.ConnectError(_miss(key), request=request)
+            delay = _replay_delay(entry)
+            if delay:
+                await asyncio.sleep(delay)
+            return httpx.Response(entry["status"], headers=entry["headers"], content=_body(entry), request=request)
+
+        # Plain bodies keep the fixtures readable and the client has nothing to decode on replay
+        request.headers["Accept-Encoding"] = "identity"
+        started = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        try:
+            content = await response.aread()
+        finally:
+            await response.aclose()
+        cassette.add(key, response.status_code, response.headers, content, time.monotonic() - started)
+        return httpx.Response(response.status_code, headers=response.headers, content=content,
+                              extensions=response.extensions, request=request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayAdapterMixin:
+    """requests adapter counterpart of ReplayTransport, mixed into the shared session's adapter."""
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        cassette = current_cassette()
+        key = request_key(request.method, request.url, request.body)
+        if mode() == REPLAY:
+            entry = cassette.find(key)
+            if entry is None:
+                raise requests.exceptions.ConnectionError(_miss(key), request=request)
+            delay = _replay_delay(entry)
+            if delay:
+                time.sleep(delay)
+            return _requests_response(request, entry["status"], entry["headers"], _body(entry))
+
+        request.headers["Accept-Encoding"] = "identity"
+        started = time.monotonic()
+        response = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        # Reads a streamed body too; iter_content then serves it from memory
+        content = response.content
+        cassette.add(key, response.status_code, response.headers, content, time.monotonic() - started)
+        return response
+
+
+def _requests_response(request, status, headers, content):
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = content
+    response._content_consumed = True
+    response.url = request.url
+    response.request = request
+    return response
+
+
+def openai_http_client():
+    """httpx client for AsyncOpenAI going through the record/replay transport."""
+    return httpx.AsyncClient(transport=ReplayTransport(httpx.AsyncHTTPTransport()), timeout=httpx.Timeout(600, connect=5))
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,300 @@
+import asyncio
+import atexit
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+# A hit refreshes last_access only once it lags by this share of the entry's remaining
+# lifetime; eviction just needs a rough LRU order, and most hits then stay read-only
+TOUCH_FRACTION = 0.1
+# Hit/miss counts are kept in memory and written at most this often
+STATS_FLUSH_SECONDS = 5
+# Inserts between checks of the entry count against max_entries
+EVICT_CHECK_EVERY = 100
+
+
+class SourceCache:
+    def __init__(self, path, max_entries=50000):
+        """
+        TTL + LRU cache for upstream source results, stored in SQLite so every
+        gunicorn worker on the host shares it.
+        Args:
+            path: SQLite file location.
+            max_entries: Entry count above which the least recently used entries are evicted.
+        """
+        self.path = str(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending_stats = {}
+        self._stats_flushed_at = time.monotonic()
+        # Check on the first insert, the file may already be full
+        self._inserts = EVICT_CHECK_EVERY
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, source TEXT NOT NULL, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "source TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, source, key):
+        """
+        Returns:
+            Tuple (hit, value). Expired entries count as misses and are dropped.
+        """
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[1] > now:
+            if now - row[2] > TOUCH_FRACTION * (row[1] - row[2]):
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self._record(source, hit=True)
+            return True, json.loads(row[0])
+        if row is not None:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._record(source, hit=False)
+        return False, None
+
+    def set(self, source, key, value, ttl):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, source, value, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, source, json.dumps(value), now + ttl, now),
+        )
+        with self._lock:
+            self._inserts += 1
+            check = self._inserts >= EVICT_CHECK_EVERY
+            if check:
+                self._inserts = 0
+        if check:
+            self._evict(conn)
+
+    def _evict(self, conn):
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Trim a little below the limit so we don't evict on every check
+        excess = count - int(self.max_entries * 0.9)
+        conn.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_access LIMIT ?)",
+            (excess,),
+        )
+
+    def _record(self, source, hit):
+        with self._lock:
+            counts = self._pending_stats.setdefault(source, [0, 0])
+            counts[0 if hit else 1] += 1
+            due = time.monotonic() - self._stats_flushed_at >= STATS_FLUSH_SECONDS
+        if due:
+            try:
+                self.flush_stats()
+            except sqlite3.Error as e:
+                # Losing a few counts is fine, failing the lookup that triggered the flush isn't
+                logger.warning(f"Could not flush source cache stats: {str(e)}")
+
+    def flush_stats(self):
+        """Add this process's hit/miss counts to the shared totals, in one write."""
+        with self._lock:
+            pending, self._pending_stats = self._pending_stats, {}
+            self._stats_flushed_at = time.monotonic()
+        if not pending:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO stats (source, hits, misses) VALUES (?, ?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+                [(source, hits, misses) for source, (hits, misses) in pending.items()],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        """
+        Returns:
+            Dict of {source: {"hits", "misses", "entries"}} aggregated across all workers,
+            up to their last flush.
+        """
+        self.flush_stats()
+        conn = self._connect()
+        result = {}
+        for source, hits, misses in conn.execute("SELECT source, hits, misses FROM stats"):
+            result[source] = {"hits": hits, "misses": misses, "entries": 0}
+        for source, entries in conn.execute("SELECT source, COUNT(*) FROM entries GROUP BY source"):
+            result.setdefault(source, {"hits": 0, "misses": 0})["entries"] = entries
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._pending_stats = {}
+        conn = self._connect()
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM stats")
+
+
+def _config():
+    return getattr(settings, "SOURCE_CACHE", {})
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        config = _config()
+        _cache = SourceCache(
+            config.get("PATH", os.path.join(settings.BASE_DIR, "cache", "sources.sqlite3")),
+            max_entries=config.get("MAX_ENTRIES", 50000),
+        )
+    return _cache
+
+
+def _flush_at_exit():
+    if _cache is not None:
+        try:
+            _cache.flush_stats()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not flush source cache stats: {str(e)}")
+
+
+atexit.register(_flush_at_exit)
+
+
+def _reset_after_fork():
+    # The parent's unflushed counts are its own to write
+    if _cache is not None:
+        _cache._lock = threading.Lock()
+        _cache._pending_stats = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return " ".join(value.lower().split())
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    return value
+
+
+def make_key(source, operation, arguments):
+    payload = json.dumps([source, operation, _normalize(arguments)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Partial(list):
+    """
+    A result that is missing pieces because part of the lookup failed (e.g. one
+    chunk of a batch request). Callers use it as the list it is; cached() never
+    stores it, so the next turn retries instead of missing those pieces for a TTL.
+    """
+
+
+def cached(source, ignore=()):
+    """
+    Cache a service method's result under its normalized arguments.
+
+    Async variants (a-prefixed) share entries with their sync method. Empty
+    results aren't cached because the services return [] or None on errors too,
+    nor are Partial ones.
+    Args:
+        source: Source name, also the key into SOURCE_CACHE['TTL'].
+        ignore: Argument names that don't affect the result (e.g., 'api_key').
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        is_async = inspect.iscoroutinefunction(fn)
+        operation = fn.__qualname__
+        if is_async:
+            head, _, name = operation.rpartition(".")
+            operation = f"{head}.{name[1:]}" if head else name[1:]
+        skip = set(ignore)
+        if "." in fn.__qualname__:
+            skip.add(next(iter(signature.parameters)))  # self
+
+        def key_for(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {k: v for k, v in bound.arguments.items() if k not in skip}
+            return make_key(source, operation, arguments)
+
+        def lookup(key):
+            try:
+                return get_cache().get(source, key)
+            except sqlite3.Error as e:
+                logger.warning(f"Source cache read failed for {source}: {str(e)}")
+                return False, None
+
+        def store(key, value):
+            if not value or isinstance(value, Partial):
+                return
+            ttl = _config().get("TTL", {}).get(source, DEFAULT_TTL)
+            try:
+                get_cache().set(source, key, value, ttl)
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.warning(f"Source cache write failed for {source}: {str(e)}")
+
+        if is_async:
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not _config().get("ENABLED", True):
+                    return await fn(*args, **kwargs)
+                key = key_for(args, kwargs)
+                # SQLite calls block, keep them off the event loop
+                hit, value = await asyncio.to_thread(lookup, key)
+                if hit:
+                    return value
+                value = await fn(*args, **kwargs)
+                await asyncio.to_thread(store, key, value)
+                return value
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _config().get("ENABLED", True):
+                return fn(*args, **kwargs)
+            key = key_for(args, kwargs)
+            hit, value = lookup(key)
+            if hit:
+                return value
+            value = fn(*args, **kwargs)
+            store(key, value)
+            return value
+        return wrapper
+
+    return decorator
@@ -0,0 +1,128 @@
+import asyncio
+import inspect
+import logging
+import time
+from collections.abc import Sized
+
+from chatbot.services import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+
+class SourceTask:
+    def __init__(self, name, fn, depends_on=()):
+        """
+        A single upstream lookup run by SourceScheduler.
+        Args:
+            name: Unique task name (e.g., 'pubmed', 'ensembl_genes').
+            fn: Callable taking a dict of {dependency name: result}, returning the result or an awaitable.
+            depends_on: Names of tasks that must finish before this one starts.
+        """
+        self.name = name
+        self.fn = fn
+        self.depends_on = tuple(depends_on)
+
+
+def _record(name, status, seconds, n_bytes, result):
+    metrics.inc("chat_source_outcomes_total", source=name, outcome=status)
+    if seconds is not None:
+        metrics.observe("chat_source_seconds", seconds, source=name, outcome=status)
+    if status == "finished":
+        metrics.observe("chat_source_bytes", n_bytes, source=name)
+        # Sections count their prompt entries, raw lookups their records
+        result = getattr(result, "entries", result)
+        if isinstance(result, Sized):
+            metrics.observe("chat_source_results", len(result), source=name)
+
+
+class SourceScheduler:
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, fn, depends_on=()):
+        """Register a task. Tasks without dependencies start as soon as run() is called."""
+        if name in self.tasks:
+            raise ValueError(f"Duplicate source task: {name}")
+        self.tasks[name] = SourceTask(name, fn, depends_on)
+
+    async def run(self, timeout=None, on_progress=None):
+        """
+        Run every registered task on the event loop, starting each one once its dependencies have finished.
+        Args:
+            timeout: Seconds to wait; tasks still running then are cancelled and reported as errors.
+            on_progress: Called as on_progress(name, status) when a task is "started",
+                "finished", "failed" or "timed_out".
+        Returns:
+            Tuple (results, errors): dicts keyed by task name. A task whose dependency
+            failed still runs, the failed dependency is simply missing from its input.
+        """
+        self._check_graph()
+        if not self.tasks:
+            return {}, {}
+
+        results = {}
+        errors = {}
+        finished = {name: asyncio.Event() for name in self.tasks}
+
+        started = {}
+        downloaded = {}
+
+        def notify(name, status):
+            if status != "started":
+                # A task whose dependencies used up the time never started, it only counts as timed out
+                seconds = time.perf_counter() - started[name] if name in started else None
+                _record(name, status, seconds, downloaded.get(name, [0])[0], results.get(name))
+            if on_progress is not None:
+                on_progress(name, status)
+
+        async def run_task(task):
+            try:
+                for dependency in task.depends_on:
+                    await finished[dependency].wait()
+                deps = {d: results[d] for d in task.depends_on if d in results}
+                started[task.name] = time.perf_counter()
+                downloaded[task.name] = metrics.source_bytes()
+                notify(task.name, "started")
+                with tracing.span(f"source {task.name}") as span:
+                    result = task.fn(deps)
+                    if inspect.isawaitable(result):
+                        result = await result
+                    span.set(bytes=downloaded[task.name][0])
+                results[task.name] = result
+                notify(task.name, "finished")
+            except Exception as e:
+                logger.error(f"Source task {task.name} failed: {str(e)}")
+                errors[task.name] = e
+                notify(task.name, "failed")
+            finally:
+                finished[task.name].set()
+
+        running = {asyncio.ensure_future(run_task(task)): task.name for task in self.tasks.values()}
+        _, pending = await asyncio.wait(running, timeout=timeout)
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            late = sorted(running[future] for future in pending)
+            logger.warning(f"Source tasks cancelled at the deadline: {', '.join(late)}")
+            for name in late:
+                errors[name] = asyncio.TimeoutError(f"{name} did not finish within {timeout:.1f}s")
+                notify(name, "timed_out")
+        return results, errors
+
+    def _check_graph(self):
+        for task in self.tasks.values():
+            missing = [d for d in task.depends_on if d not in self.tasks]
+            if missing:
+                raise ValueError(f"Task {task.name} depends on unknown tasks: {missing}")
+
+        # Kahn's algorithm, a cycle would otherwise leave tasks waiting forever
+        remaining = {name: set(task.depends_on) for name, task in self.tasks.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Unschedulable source tasks: {list(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
@@ -0,0 +1,205 @@
+import contextvars
+import itertools
+import json
+import logging
+import random
+import time
+import uuid
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 0.05,
+    "SLOW_SECONDS": 20,
+    "MAX_SPANS": 500,
+    "RETENTION_DAYS": 14,
+}
+
+# Positions in a stored span, kept as a list rather than a dict so traces stay small
+SPAN_ID, SPAN_PARENT, SPAN_NAME, SPAN_START, SPAN_DURATION, SPAN_ATTRS = range(6)
+
+# (Trace, id of the innermost open span) for the running request
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def _config(key):
+    return getattr(settings, "TRACING", {}).get(key, DEFAULTS[key])
+
+
+class Trace:
+    def __init__(self, name):
+        """
+        Span tree of one chat turn, recorded in memory for every turn and saved
+        only when sampled or slow (see afinish).
+        """
+        self.trace_id = uuid.uuid4()
+        self.name = name
+        self.started_at = timezone.now()
+        self._origin = time.perf_counter()
+        self._ids = itertools.count(1)
+        # Spans get appended from tasks and sync_to_async threads; list.append is atomic
+        self.spans = []
+        self.dropped = 0
+        self.root = Span(self, name, None)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._origin) * 1000
+
+
+class Span:
+    def __init__(self, trace, name, parent, **attrs):
+        self.trace = trace
+        self.id = next(trace._ids)
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.start_ms = trace.elapsed_ms()
+        self._token = None
+
+    def set(self, **attrs):
+        """Attach sizes, counts, statuses... to the span."""
+        self.attrs.update(attrs)
+
+    def end(self, force=False):
+        trace = self.trace
+        if len(trace.spans) >= _config("MAX_SPANS") and not force:
+            trace.dropped += 1
+            return
+        trace.spans.append([self.id, self.parent, self.name, round(self.start_ms, 1), round(trace.elapsed_ms() - self.start_ms, 1), self.attrs])
+
+    def __enter__(self):
+        self._token = _current.set((self.trace, self.id))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.end()
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # An async generator closed from another context, e.g. a client that went away
+            pass
+        return False
+
+
+class _NoSpan:
+    def set(self, **attrs):
+        pass
+
+    def end(self, force=False):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def start(name):
+    """
+    Start tracing a turn in the current context.
+    Returns:
+        The Trace, or None when tracing is off.
+    """
+    if not _config("ENABLED"):
+        return None
+    trace = Trace(name)
+    _current.set((trace, trace.root.id))
+    return trace
+
+
+def activate(trace):
+    """Make trace current in another context, e.g. the generator of a streamed response."""
+    if trace is not None:
+        _current.set((trace, trace.root.id))
+
+
+def span(name, **attrs):
+    """
+    `with tracing.span("name", size=...) as s:` records a child of the innermost open
+    span. Without an active trace it does nothing.
+    """
+    current = _current.get()
+    if current is None:
+        return _NO_SPAN
+    trace, parent = current
+    return Span(trace, name, parent, **attrs)
+
+
+def _trace_query(execute, sql, params, many, context):
+    if _current.get() is None:
+        return execute(sql, params, many, context)
+    with span(f"db {sql.lstrip().split(None, 1)[0].upper() if sql else 'OTHER'}", sql=sql[:200]) as s:
+        result = execute(sql, params, many, context)
+        if context["cursor"].rowcount >= 0:
+            s.set(rows=context["cursor"].rowcount)
+        return result
+
+
+def _install_query_tracer(sender, connection, **kwargs):
+    if _trace_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_trace_query)
+
+
+connection_created.connect(_install_query_tracer, dispatch_uid="chatbot.tracing.query_tracer")
+
+
+def encode_spans(spans):
+    return zlib.compress(json.dumps(spans, separators=(",", ":")).encode())
+
+
+def decode_spans(data):
+    return json.loads(zlib.decompress(bytes(data)).decode())
+
+
+async def afinish(trace, chat_message=None):
+    """
+    Close the turn's root span and save the trace if it was sampled or slow.
+    Args:
+        chat_message: The ChatMessage the turn produced, the trace's key in the admin.
+    """
+    if trace is None:
+        return
+    from chatbot.models import ChatTrace
+
+    # Saving the trace isn't part of it
+    _current.set(None)
+    # The root always makes it in, the waterfall is drawn against it
+    trace.root.end(force=True)
+    duration_ms = trace.elapsed_ms()
+    if duration_ms >= _config("SLOW_SECONDS") * 1000:
+        reason = ChatTrace.SLOW
+    elif random.random() < _config("SAMPLE_RATE"):
+        reason = ChatTrace.SAMPLED
+    else:
+        return
+    try:
+        await ChatTrace.objects.acreate(
+            trace_id=trace.trace_id,
+            chat_message=chat_message,
+            name=trace.name,
+            reason=reason,
+            started_at=trace.started_at,
+            duration_ms=round(duration_ms, 1),
+            span_count=len(trace.spans),
+            dropped_spans=trace.dropped,
+            spans=encode_spans(trace.spans)
+        )
+        # Pruning now and then keeps the table bounded without a scheduled job
+        if random.random() < 0.01:
+            cutoff = timezone.now() - timedelta(days=_config("RETENTION_DAYS"))
+            await ChatTrace.objects.filter(started_at__lt=cutoff).adelete()
+    except Exception as e:
+        logger.error(f"Could not save trace {trace.trace_id}: {str(e)}")
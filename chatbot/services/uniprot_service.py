@@ -1,9 +1,12 @@
 import requests
+from chatbot.services import http_client
+from chatbot.services.source_cache import cached
 
 class UniProtService:
     def __init__(self):
         self.base_url = "https://rest.uniprot.org/uniprotkb/search"
 
+    @cached("uniprot")
     def search_uniprot(self, query, max_results=10):
         """
         Search UniProtKB using the UniProt API and return results.
@@ -21,10 +24,26 @@ class UniProtService:
             "format": "json"
         }
         
-        response = requests.get(self.base_url, params=params)
+        response = http_client.get(self.base_url, params=params)
         response.raise_for_status()
-        data = response.json()
-        
+        return self._parse_results(response.json())
+
+    @cached("uniprot")
+    async def asearch_uniprot(self, query, max_results=10):
+        """
+        Async variant of search_uniprot.
+        """
+        params = {
+            "query": query,
+            "size": max_results,
+            "format": "json"
+        }
+
+        response = await http_client.aget(self.base_url, params=params)
+        response.raise_for_status()
+        return self._parse_results(response.json())
+
+    def _parse_results(self, data):
         results = data.get("results", [])
         if not results:
             return []
@@ -41,4 +60,4 @@ class UniProtService:
                 "organism": organism
             })
         
-        return entries
\ No newline at end of file
+        return entries
@@ -1,3 +1,822 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from asgiref.sync import async_to_sync
+
+from chatbot.models import ChatJob, ChatMessage, ChatSession
+from chatbot.services import admission, chat_jobs, conversation_summary, http_client, metrics, replay, source_cache
+from chatbot.services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreakers, CircuitOpenError
+from chatbot.services.clinical_trials_service import asearch_clinical_trials
+from chatbot.services.ensembl_service import EnsemblService
+from chatbot.services.rate_limiter import RateLimiter
+from chatbot.services.source_scheduler import SourceScheduler
+from chatbot.services.chatgpt_service import ChatGPTService
+
+BRCA1 = {
+    "id": "ENSG00000012048",
+    "display_name": "BRCA1",
+    "description": "BRCA1 DNA repair associated",
+    "biotype": "protein_coding",
+    "seq_region_name": "17",
+    "start": 43044292,
+    "end": 43170245,
+    "strand": -1,
+}
+
+ANSWER = ["BRCA1 is a tumour suppressor ", "involved in DNA repair."]
+
+
+def _openai(request):
+    body = json.loads(request.content)
+    usage = {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110}
+    if not body.get("stream"):
+        return httpx.Response(200, json={
+            "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "Summary"}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+    chunks = [
+        {"choices": [{"index": 0, "delta": {"role": "assistant", "content": text}, "finish_reason": None}]}
+        for text in ANSWER
+    ]
+    chunks.append({"choices": [], "usage": usage})
+    events = "".join(
+        f"data: {json.dumps({'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0, 'model': body['model'], **chunk})}\n\n"
+        for chunk in chunks
+    )
+    return httpx.Response(200, content=(events + "data: [DONE]\n\n").encode(), headers={"content-type": "text/event-stream"})
+
+
+def fake_upstream(request):
+    """Stands in for the network while a test records its fixtures."""
+    if request.url.host == "api.openai.com":
+        return _openai(request)
+    if request.url.host == "rest.ensembl.org":
+        if request.url.path.startswith("/lookup/symbol/"):
+            return httpx.Response(200, json=BRCA1 if request.method == "GET" else {"BRCA1": BRCA1})
+        return httpx.Response(200, json=[])
+    return httpx.Response(404, text="Not found")
+
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        self.fixtures = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fixtures, ignore_errors=True)
+        self.network_calls = []
+        # Keep the host-wide SQLite state (caches, breakers, metrics...) out of the tests
+        self.enterContext(self.settings(
+            SOURCE_CACHE={"ENABLED": False},
+            CIRCUIT_BREAKER={"ENABLED": False},
+            METRICS={"ENABLED": False},
+            TRACING={"ENABLED": False},
+            CHAT_ADMISSION={"ENABLED": False},
+            CONVERSATION_SUMMARY={"ENABLED": False},
+        ))
+
+    def offline(self, request):
+        self.network_calls.append(str(request.url))
+        raise httpx.ConnectError("No network in replay tests", request=request)
+
+    @contextlib.contextmanager
+    def upstream(self, mode, network=None, **options):
+        """Record to (network = fake_upstream by default) or replay from this test's cassette."""
+        if network is None:
+            network = fake_upstream if mode == replay.RECORD else self.offline
+        with self.settings(UPSTREAM_REPLAY={"MODE": mode, "PATH": self.fixtures, **options}), \
+                mock.patch("httpx.AsyncHTTPTransport", lambda **kwargs: httpx.MockTransport(network)), \
+                replay.use_cassette(self._testMethodName) as cassette:
+            yield cassette
+
+    def fixture_text(self):
+        with gzip.open(os.path.join(self.fixtures, f"{self._testMethodName}.json.gz"), "rt") as f:
+            return f.read()
+
+
+class ReplayTransportTests(ReplayTestCase):
+    async def test_replays_recorded_exchange_offline(self):
+        url = "https://rest.ensembl.org/lookup/symbol/homo_sapiens/BRCA1"
+        with self.upstream(replay.RECORD):
+            recorded = await http_client.aget(url, params={"expand": 1, "api_key": "secret"})
+        with self.upstream(replay.REPLAY) as cassette:
+            replayed = await http_client.aget(url, params={"api_key": "other", "expand": 1})
+
+        self.assertEqual(replayed.status_code, recorded.status_code)
+        self.assertEqual(replayed.json(), BRCA1)
+        self.assertEqual(cassette.misses, [])
+        self.assertEqual(self.network_calls, [])
+        self.assertNotIn("secret", self.fixture_text())
+
+    async def test_sync_session_replays_async_recording(self):
+        url = "https://rest.ensembl.org/lookup/symbol/homo_sapiens"
+        with self.upstream(replay.RECORD):
+            await http_client.apost(url, json={"symbols": ["BRCA1"]})
+        with self.upstream(replay.REPLAY):
+            response = http_client.post(url, json={"symbols": ["BRCA1"]})
+
+        self.assertEqual(response.json(), {"BRCA1": BRCA1})
+        self.assertEqual(response.headers["content-type"], "application/json")
+
+    async def test_missing_exchange_fails_like_the_network(self):
+        with self.upstream(replay.REPLAY) as cassette:
+            with self.assertRaises(httpx.ConnectError):
+                await http_client.aget("https://rest.ensembl.org/lookup/symbol/homo_sapiens/TP53")
+        self.assertEqual(cassette.misses, ["GET https://rest.ensembl.org/lookup/symbol/homo_sapiens/TP53"])
+        self.assertEqual(self.network_calls, [])
+
+    async def test_repeated_requests_replay_in_recorded_order(self):
+        counter = iter(range(1, 10))
+        url = "https://www.ebi.ac.uk/counter"
+        with self.upstream(replay.RECORD, network=lambda request: httpx.Response(200, json=next(counter))):
+            for _ in range(2):
+                await http_client.aget(url)
+        with self.upstream(replay.REPLAY):
+            replayed = [(await http_client.aget(url)).json() for _ in range(3)]
+        self.assertEqual(replayed, [1, 2, 2])
+
+    async def test_replays_recorded_latency(self):
+        with self.upstream(replay.RECORD) as cassette:
+            cassette.add(replay.request_key("GET", "https://www.ebi.ac.uk/slow"), 200, {}, b"ok", 0.2)
+        with self.upstream(replay.REPLAY, LATENCY=True):
+            started = time.monotonic()
+            await http_client.aget("https://www.ebi.ac.uk/slow")
+            self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        with self.upstream(replay.REPLAY, LATENCY=True, LATENCY_SCALE=0):
+            started = time.monotonic()
+            await http_client.aget("https://www.ebi.ac.uk/slow")
+            self.assertLess(time.monotonic() - started, 0.2)
+
+    def test_request_key_ignores_parameter_and_json_key_order(self):
+        self.assertEqual(
+            replay.request_key("get", "https://host/path?b=2&a=1&email=me@example.org"),
+            replay.request_key("GET", "https://host/path?a=1&b=2"),
+        )
+        self.assertEqual(
+            replay.request_key("POST", "https://host/path", b'{"a": 1, "b": [1, 2]}'),
+            replay.request_key("POST", "https://host/path", '{"b":[1,2],"a":1}'),
+        )
+        self.assertNotEqual(
+            replay.request_key("POST", "https://host/path", b'{"a": 1}'),
+            replay.request_key("POST", "https://host/path", b'{"a": 2}'),
+        )
+
+
+class OfflineChatTests(ReplayTestCase):
+    QUERY = "BRCA1 gene in breast cancer"
+
+    def test_analyze_query_replays_offline(self):
+        with self.upstream(replay.RECORD):
+            recorded = ChatGPTService().analyze_query(self.QUERY)
+        with self.upstream(replay.REPLAY) as cassette:
+            replayed = ChatGPTService().analyze_query(self.QUERY)
+
+        self.assertEqual(replayed, recorded)
+        self.assertIn("".join(ANSWER), replayed)
+        self.assertIn("ENSG00000012048", replayed)
+        self.assertEqual(cassette.misses, [])
+        self.assertEqual(self.network_calls, [])
+
+    def test_chat_response_view_replays_offline(self):
+        user = User.objects.create_user("replay", password="replay")
+        self.client.force_login(user)
+
+        def ask():
+            response = self.client.post("/chat-response/", json.dumps({"message": self.QUERY}), content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            return response.json()["response"]
+
+        with self.upstream(replay.RECORD):
+            recorded = ask()
+        with self.upstream(replay.REPLAY) as cassette:
+            replayed = ask()
+
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(cassette.misses, [])
+        self.assertEqual(self.network_calls, [])
+        self.assertEqual(ChatMessage.objects.filter(user=user).count(), 2)
+
+
+class ConversationSummaryTests(ReplayTestCase):
+    def test_summary_survives_trimming_of_long_answers(self):
+        user = User.objects.create_user("summary", password="summary")
+        session = ChatSession.objects.create(user=user, summary="The user asked about APOE4 and Alzheimer's risk.")
+        for i in range(4):
+            ChatMessage.objects.create(user=user, session=session, message=f"Question {i}", response="word " * 1400)
+        history = async_to_sync(conversation_summary.aload_history)(session)
+
+        sent = []
+
+        def network(request):
+            if request.url.host == "api.openai.com":
+                sent.append(json.loads(request.content)["messages"])
+            return fake_upstream(request)
+
+        with self.upstream(replay.RECORD, network=network):
+            # A follow-up, so both the routing model and the answer model see the history
+            ChatGPTService().analyze_query("tell me more about that", history)
+
+        self.assertEqual(len(sent), 2)
+        for messages in sent:
+            self.assertIn("APOE4", messages[1]["content"])
+            self.assertEqual(messages[1]["role"], "system")
+            # The newest exchange is still there, the older long answers made way for the summary
+            self.assertIn("Question 3", [m["content"] for m in messages])
+
+    def test_update_summarizes_a_long_session_in_bounded_batches(self):
+        user = User.objects.create_user("backlog", password="backlog")
+        session = ChatSession.objects.create(user=user)
+        for i in range(20):
+            ChatMessage.objects.create(user=user, session=session, message=f"Question {i}", response=f"Answer {i}")
+        calls = []
+
+        class Summarizer:
+            async def asummarize_history(self, summary, chat_history, model, max_tokens):
+                calls.append([m["content"] for m in chat_history if m["role"] == "user"])
+                return f"{summary} {len(calls)}".strip()
+
+        with self.settings(CONVERSATION_SUMMARY={"VERBATIM_TURNS": 3, "BATCH_TURNS": 5}):
+            async_to_sync(conversation_summary.aupdate)(session.pk, Summarizer())
+
+        self.assertEqual([len(batch) for batch in calls], [5, 5, 5, 2])
+        self.assertEqual(calls[0][0], "Question 0")
+        self.assertEqual(calls[-1][-1], "Question 16")
+        session.refresh_from_db()
+        self.assertEqual(session.summary, "1 2 3 4")
+        self.assertEqual(session.summary_through, session.messages.get(message="Question 16").created_at)
+
+
+class SourceCacheTests(ReplayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(self.settings(SOURCE_CACHE={"ENABLED": True}))
+        self.enterContext(mock.patch.object(source_cache, "_cache", source_cache.SourceCache(os.path.join(self.fixtures, "sources.sqlite3"))))
+
+    async def test_batch_with_a_failed_chunk_is_not_cached(self):
+        requests_made = []
+
+        def network(request):
+            symbols = json.loads(request.content)["symbols"]
+            requests_made.append(symbols)
+            if symbols == ["TP53"] and len(requests_made) == 2:
+                return httpx.Response(503, text="Busy")
+            return httpx.Response(200, json={symbol: {**BRCA1, "display_name": symbol} for symbol in symbols})
+
+        service = EnsemblService()
+        with mock.patch.object(EnsemblService, "LOOKUP_BATCH_SIZE", 1), self.upstream(replay.RECORD, network=network):
+            first = await service.asearch_genes_by_symbols("homo_sapiens", ["BRCA1", "TP53"])
+            second = await service.asearch_genes_by_symbols("homo_sapiens", ["BRCA1", "TP53"])
+            third = await service.asearch_genes_by_symbols("homo_sapiens", ["BRCA1", "TP53"])
+
+        self.assertIsInstance(first, source_cache.Partial)
+        self.assertEqual([gene["symbol"] for gene in first], ["BRCA1"])
+        # Retried rather than served from the cache, then cached once complete
+        self.assertEqual([gene["symbol"] for gene in second], ["BRCA1", "TP53"])
+        self.assertEqual(third, second)
+        self.assertEqual(len(requests_made), 4)
+
+    def test_hits_do_not_write_to_the_shared_file(self):
+        cache = source_cache.get_cache()
+        cache.set("ensembl", "key", [1], ttl=3600)
+        cache.flush_stats()
+        observer = sqlite3.connect(cache.path)
+        version = observer.execute("PRAGMA data_version").fetchone()[0]
+        for _ in range(50):
+            self.assertEqual(cache.get("ensembl", "key"), (True, [1]))
+        self.assertEqual(observer.execute("PRAGMA data_version").fetchone()[0], version)
+        self.assertEqual(cache.get("ensembl", "other"), (False, None))
+        # Counts reach the shared totals once flushed, here by stats()
+        self.assertEqual(cache.stats()["ensembl"], {"hits": 50, "misses": 1, "entries": 1})
+
+    def test_eviction_keeps_the_table_bounded(self):
+        cache = source_cache.SourceCache(os.path.join(self.fixtures, "small.sqlite3"), max_entries=10)
+        for i in range(3 * source_cache.EVICT_CHECK_EVERY):
+            cache.set("ensembl", f"key{i}", [i], ttl=3600)
+        entries = cache.stats()["ensembl"]["entries"]
+        self.assertLessEqual(entries, 10 + source_cache.EVICT_CHECK_EVERY)
+        # The most recent entries are the ones kept
+        self.assertEqual(cache.get("ensembl", f"key{3 * source_cache.EVICT_CHECK_EVERY - 1}")[0], True)
+        self.assertEqual(cache.get("ensembl", "key0")[0], False)
+
+
+class TurnDeadlineTests(ReplayTestCase):
+    def test_slow_answer_is_cut_short_at_the_deadline(self):
+        async def slow_events(model):
+            for i in range(30):
+                chunk = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 0, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": f"part{i} "}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+                await asyncio.sleep(0.1)
+            yield b"data: [DONE]\n\n"
+
+        async def network(request):
+            body = json.loads(request.content)
+            if body.get("stream"):
+                return httpx.Response(200, content=slow_events(body["model"]), headers={"content-type": "text/event-stream"})
+            return fake_upstream(request)
+
+        # Straight to the fake network, recording would read the whole stream before handing it on
+        with self.settings(CHAT_TURN_BUDGET={"TOTAL": 45, "GENERATION_RESERVE": 0, "GENERATION_GRACE": 0.5}), \
+                self.upstream(replay.RECORD), \
+                mock.patch.object(replay, "openai_http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(network))):
+            started = time.monotonic()
+            answer = ChatGPTService().analyze_query("tell me more", budget=0.5)
+            elapsed = time.monotonic() - started
+
+        self.assertLess(elapsed, 2)
+        self.assertIn("part0", answer)
+        self.assertNotIn("part29", answer)
+        self.assertIn("cut short", answer)
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.controller = admission.AdmissionController(os.path.join(directory, "admission.sqlite3"), max_in_flight=1, slot_ttl=0.3)
+        self.enterContext(mock.patch.object(admission, "_controller", self.controller))
+        self.enterContext(self.settings(CHAT_ADMISSION={"SLOT_TTL": 0.3}))
+
+    async def test_heartbeat_keeps_a_long_turn_in_its_slot(self):
+        slot = await self.controller.aacquire("1", 1)
+        async with admission.aheartbeat(slot):
+            await asyncio.sleep(1)
+            # Still held, so the next turn has to queue
+            self.assertEqual(self.controller.try_enter("2", 1)[0], "queued")
+        self.assertEqual(self.controller.stats()["in_flight"], 1)
+
+    async def test_slot_without_heartbeat_expires(self):
+        await self.controller.aacquire("1", 1)
+        await asyncio.sleep(0.5)
+        self.assertEqual(self.controller.try_enter("2", 1)[0], "slot")
+
+
+class ChatJobTests(ReplayTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("jobs", password="jobs")
+        self.session = ChatSession.objects.create(user=self.user)
+
+    def job(self, session=None, **fields):
+        fields.setdefault("message", "BRCA1 gene in breast cancer")
+        return ChatJob.objects.create(user=self.user, session=session or self.session, **fields)
+
+    def test_job_is_answered_and_saved(self):
+        job = self.job()
+        with self.upstream(replay.RECORD):
+            claimed = async_to_sync(chat_jobs.aclaim)("worker-1")
+            async_to_sync(chat_jobs.arun_job)(claimed, "worker-1", ChatGPTService())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.DONE)
+        self.assertIn("".join(ANSWER), job.response)
+        self.assertEqual(job.chat_message.response, job.response)
+
+    def test_failed_turn_fails_the_job(self):
+        job = self.job(message="tell me more")
+        # Nothing recorded, so the routing call fails
+        with self.upstream(replay.REPLAY):
+            claimed = async_to_sync(chat_jobs.aclaim)("worker-1")
+            async_to_sync(chat_jobs.arun_job)(claimed, "worker-1", ChatGPTService())
+        job.refresh_from_db()
+        self.assertEqual(job.status, ChatJob.FAILED)
+        self.assertIn("Connection error", job.error)
+        self.assertIsNone(job.chat_message)
+        self.assertFalse(ChatMessage.objects.filter(session=self.session).exists())
+
+        self.client.force_login(self.user)
+        response = self.client.get(f"/chat-jobs/{job.job_id}/")
+        self.assertEqual(response.json()["state"], ChatJob.FAILED)
+
+    def test_jobs_of_a_session_run_one_at_a_time(self):
+        first = self.job()
+        second = self.job()
+        other = self.job(session=ChatSession.objects.create(user=self.user))
+
+        claim = async_to_sync(chat_jobs.aclaim)
+        self.assertEqual(claim("worker-1").pk, first.pk)
+        # second waits for first, the other session's job goes ahead of it
+        self.assertEqual(claim("worker-2").pk, other.pk)
+        self.assertIsNone(claim("worker-3"))
+        ChatJob.objects.filter(pk=first.pk).update(status=ChatJob.DONE)
+        self.assertEqual(claim("worker-3").pk, second.pk)
+
+    def test_claim_is_exclusive(self):
+        job = self.job()
+
+        async def race():
+            return await asyncio.gather(*(chat_jobs.aclaim(f"worker-{i}") for i in range(4)))
+
+        claimed = [c for c in async_to_sync(race)() if c is not None]
+        self.assertEqual(len(claimed), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.attempts), (ChatJob.RUNNING, claimed[0].worker, 1))
+
+    def test_expired_jobs_are_requeued_then_failed(self):
+        job = self.job()
+        claim = async_to_sync(chat_jobs.aclaim)
+
+        def expire():
+            ChatJob.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        with self.settings(CHAT_JOBS={"MAX_ATTEMPTS": 2}):
+            claim("worker-1")
+            expire()
+            async_to_sync(chat_jobs.arequeue_expired)()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.worker), (ChatJob.QUEUED, ""))
+
+            self.assertEqual(claim("worker-2").pk, job.pk)
+            expire()
+            async_to_sync(chat_jobs.arequeue_expired)()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (ChatJob.FAILED, 2))
+            self.assertTrue(job.error)
+            self.assertIsNone(claim("worker-3"))
+
+    def test_answer_of_a_worker_that_lost_its_lease_is_dropped(self):
+        job = self.job()
+        claimed = async_to_sync(chat_jobs.aclaim)("worker-1")
+        ChatJob.objects.filter(pk=job.pk).update(worker="worker-2")
+        self.assertIsNone(chat_jobs._finish(claimed, "worker-1", "late answer"))
+        self.assertFalse(ChatMessage.objects.filter(session=self.session).exists())
+
+
+@override_settings(METRICS={"ENABLED": False}, TRACING={"ENABLED": False})
+class SourceSchedulerTests(SimpleTestCase):
+    async def test_dependencies_run_first_and_others_concurrently(self):
+        log = []
+
+        async def lookup(name, result, seconds=0.1):
+            log.append(f"start {name}")
+            await asyncio.sleep(seconds)
+            log.append(f"end {name}")
+            return result
+
+        scheduler = SourceScheduler()
+        scheduler.add("genes", lambda deps: lookup("genes", ["BRCA1"]))
+        scheduler.add("variants", lambda deps: lookup("variants", deps["genes"] + ["rs1"]), depends_on=["genes"])
+        scheduler.add("trials", lambda deps: lookup("trials", ["NCT1"]))
+        progress = []
+        started = time.monotonic()
+        results, errors = await scheduler.run(on_progress=lambda name, status: progress.append((name, status)))
+
+        self.assertEqual(errors, {})
+        self.assertEqual(results, {"genes": ["BRCA1"], "variants": ["BRCA1", "rs1"], "trials": ["NCT1"]})
+        self.assertLess(log.index("end genes"), log.index("start variants"))
+        # trials didn't wait for anything
+        self.assertLess(log.index("start trials"), log.index("end genes"))
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual([s for n, s in progress if n == "variants"], ["started", "finished"])
+
+    async def test_dependent_runs_without_a_failed_dependency(self):
+        def fail(deps):
+            raise RuntimeError("upstream down")
+
+        scheduler = SourceScheduler()
+        scheduler.add("genes", fail)
+        scheduler.add("variants", lambda deps: sorted(deps), depends_on=["genes"])
+        results, errors = await scheduler.run()
+        self.assertEqual(results, {"variants": []})
+        self.assertIsInstance(errors["genes"], RuntimeError)
+
+    async def test_tasks_still_running_at_the_timeout_are_cancelled(self):
+        cancelled = []
+
+        async def slow(deps):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append("slow")
+                raise
+
+        scheduler = SourceScheduler()
+        scheduler.add("fast", lambda deps: "fast result")
+        scheduler.add("slow", slow)
+        scheduler.add("after_slow", lambda deps: "never", depends_on=["slow"])
+        progress = []
+        started = time.monotonic()
+        results, errors = await scheduler.run(timeout=0.2, on_progress=lambda name, status: progress.append((name, status)))
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(results, {"fast": "fast result"})
+        self.assertEqual(cancelled, ["slow"])
+        self.assertEqual(set(errors), {"slow", "after_slow"})
+        self.assertIsInstance(errors["slow"], asyncio.TimeoutError)
+        self.assertIn(("slow", "timed_out"), progress)
+        self.assertIn(("after_slow", "timed_out"), progress)
+        self.assertNotIn(("after_slow", "started"), progress)
+
+    def test_cycles_and_unknown_dependencies_are_rejected(self):
+        scheduler = SourceScheduler()
+        scheduler.add("a", lambda deps: 1, depends_on=["b"])
+        scheduler.add("b", lambda deps: 2, depends_on=["a"])
+        with self.assertRaises(ValueError):
+            async_to_sync(scheduler.run)()
+
+        scheduler = SourceScheduler()
+        scheduler.add("a", lambda deps: 1, depends_on=["missing"])
+        with self.assertRaises(ValueError):
+            async_to_sync(scheduler.run)()
+
+
+def _study(nct_id, status):
+    return {"protocolSection": {
+        "identificationModule": {"nctId": nct_id, "briefTitle": nct_id},
+        "statusModule": {"overallStatus": status},
+    }}
+
+
+class ClinicalTrialsTests(ReplayTestCase):
+    async def test_one_request_with_ongoing_trials_first(self):
+        requests_made = []
+
+        def network(request):
+            requests_made.append(request.url.params)
+            return httpx.Response(200, json={"studies": [
+                _study("NCT1", "COMPLETED"), _study("NCT2", "RECRUITING"),
+                _study("NCT3", "ACTIVE_NOT_RECRUITING"), _study("NCT4", "ENROLLING_BY_INVITATION"),
+            ]})
+
+        with self.upstream(replay.RECORD, network=network):
+            trials = await asearch_clinical_trials("diabetes", max_results=4)
+
+        self.assertEqual([trial["nct_id"] for trial in trials], ["NCT2", "NCT4", "NCT1", "NCT3"])
+        self.assertEqual(len(requests_made), 1)
+        self.assertEqual(requests_made[0]["pageSize"], "4")
+        self.assertEqual(requests_made[0]["filter.overallStatus"], "RECRUITING,ENROLLING_BY_INVITATION,ACTIVE_NOT_RECRUITING,COMPLETED")
+
+
+class PartialEvidenceTests(ReplayTestCase):
+    def test_answer_uses_the_sources_that_arrived_in_time(self):
+        sent = []
+
+        async def network(request):
+            if request.url.host == "eutils.ncbi.nlm.nih.gov":
+                # PubMed hangs past the sources' share of the budget
+                await asyncio.sleep(5)
+            if request.url.host == "api.openai.com":
+                sent.append(json.loads(request.content)["messages"])
+            return fake_upstream(request)
+
+        async def turn():
+            return [event async for event in ChatGPTService().astream_query("BRCA1 gene in breast cancer", budget=2)]
+
+        with self.settings(CHAT_TURN_BUDGET={"TOTAL": 45, "GENERATION_RESERVE": 1, "GENERATION_GRACE": 1}), \
+                self.upstream(replay.RECORD, network=network):
+            started = time.monotonic()
+            events = async_to_sync(turn)()
+            elapsed = time.monotonic() - started
+
+        self.assertLess(elapsed, 3)
+        statuses = {data["source"]: data["status"] for event, data in events if event == "source" and data["status"] != "started"}
+        self.assertEqual(statuses["pubmed"], "timed_out")
+        self.assertEqual(statuses["ensembl"], "finished")
+        answer = "".join(data["text"] for event, data in events if event == "token")
+        self.assertIn("".join(ANSWER), answer)
+        # The Ensembl evidence made it into the prompt
+        self.assertIn("ENSG00000012048", json.dumps(sent[-1]))
+
+
+class RateLimiterTests(SimpleTestCase):
+    HOST = "eutils.ncbi.nlm.nih.gov"
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, "rate_limits.sqlite3")
+
+    def test_bucket_empties_then_refills(self):
+        limiter = RateLimiter(self.path, {self.HOST: 5})
+        # A full bucket holds one second's worth of requests
+        self.assertEqual([limiter.try_acquire(self.HOST) for _ in range(5)], [0] * 5)
+        wait = limiter.try_acquire(self.HOST)
+        self.assertAlmostEqual(wait, 0.2, delta=0.05)
+        time.sleep(wait + 0.02)
+        self.assertEqual(limiter.try_acquire(self.HOST), 0)
+
+    def test_acquire_waits_for_a_token_or_gives_up(self):
+        limiter = RateLimiter(self.path, {self.HOST: 4})
+        for _ in range(4):
+            limiter.try_acquire(self.HOST)
+        started = time.monotonic()
+        self.assertTrue(limiter.acquire(self.HOST, timeout=1))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        # The next token is 0.25s away, more than the caller is willing to wait
+        self.assertFalse(limiter.acquire(self.HOST, timeout=0.1))
+        self.assertTrue(async_to_sync(limiter.aacquire)(self.HOST, timeout=1))
+
+    def test_workers_share_the_bucket(self):
+        # Two limiters on the same file stand for two worker processes
+        first = RateLimiter(self.path, {self.HOST: 3})
+        second = RateLimiter(self.path, {self.HOST: 3})
+        taken = [limiter.try_acquire(self.HOST) == 0 for limiter in (first, second, first, second)]
+        self.assertEqual(taken, [True, True, True, False])
+
+    def test_unlisted_hosts_are_not_limited(self):
+        limiter = RateLimiter(self.path, {self.HOST: 1})
+        self.assertTrue(all(limiter.try_acquire("rest.ensembl.org") == 0 for _ in range(20)))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    HOST = "rest.uniprot.org"
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, "circuit_breakers.sqlite3")
+        self.breakers = CircuitBreakers(self.path, failure_threshold=3, slow_seconds=1, open_seconds=0.2)
+
+    def state(self):
+        return self.breakers.states()[self.HOST]["state"]
+
+    def open_breaker(self):
+        for _ in range(3):
+            self.breakers.record(self.HOST, ok=False, error="HTTP 503")
+
+    def test_opens_after_consecutive_failures(self):
+        self.breakers.record(self.HOST, ok=False, error="HTTP 503")
+        self.breakers.record(self.HOST, ok=False, elapsed=2)  # slow counts as a failure
+        self.breakers.check(self.HOST)
+        self.assertEqual(self.state(), CLOSED)
+
+        # A success in between starts the count over
+        self.breakers.record(self.HOST, ok=True, elapsed=0.1)
+        self.breakers.record(self.HOST, ok=False, error="HTTP 503")
+        self.breakers.record(self.HOST, ok=True, elapsed=5)
+        self.assertEqual(self.state(), CLOSED)
+
+        self.open_breaker()
+        self.assertEqual(self.state(), OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breakers.check(self.HOST)
+        self.assertEqual(self.breakers.states()[self.HOST]["rejected"], 1)
+
+    def test_single_probe_after_the_cool_down(self):
+        self.open_breaker()
+        time.sleep(0.25)
+        self.breakers.check(self.HOST)
+        self.assertEqual(self.state(), HALF_OPEN)
+        # Another worker must wait for the probe's outcome
+        other_worker = CircuitBreakers(self.path, failure_threshold=3, open_seconds=0.2)
+        with self.assertRaises(CircuitOpenError):
+            other_worker.check(self.HOST)
+
+        # A failed probe opens the breaker again straight away
+        self.breakers.record(self.HOST, ok=False, error="HTTP 503")
+        self.assertEqual(self.state(), OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breakers.check(self.HOST)
+
+    def test_successful_probe_closes_the_breaker(self):
+        self.open_breaker()
+        time.sleep(0.25)
+        self.breakers.check(self.HOST)
+        self.breakers.record(self.HOST, ok=True, elapsed=0.1)
+        self.assertEqual(self.state(), CLOSED)
+        self.assertEqual(self.breakers.states()[self.HOST]["failures"], 0)
+        for _ in range(3):
+            self.breakers.check(self.HOST)
+
+
+async def _read(response):
+    return b"".join([chunk async for chunk in response.streaming_content])
+
+
+class SessionMessagesViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("pages", password="pages")
+        self.client.force_login(self.user)
+        self.session = ChatSession.objects.create(user=self.user, title="Paging")
+        base = timezone.now() - timedelta(hours=1)
+        # Turns 2-4 share a timestamp, the id breaks the tie; a page boundary falls among them
+        for i, minutes in enumerate([0, 1, 3, 3, 3, 5, 6]):
+            message = ChatMessage.objects.create(user=self.user, session=self.session, message=f"question {i}", response=f"answer {i}")
+            ChatMessage.objects.filter(pk=message.pk).update(created_at=base + timedelta(minutes=minutes))
+
+    def page(self, **params):
+        response = self.client.get(f"/get_session_messages/{self.session.session_id}/", params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(async_to_sync(_read)(response))
+
+    def test_pages_cover_every_turn_once_in_order(self):
+        pages = []
+        cursor = None
+        while True:
+            page = self.page(limit=3, **({"before": cursor} if cursor else {}))
+            pages.append([m["content"] for m in page["messages"]])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+            self.assertLess(len(pages), 5)
+
+        self.assertEqual([len(p) for p in pages], [6, 6, 2])
+        # Newest page first, oldest turn first within a page: read back to front it is the whole session
+        contents = [content for page in reversed(pages) for content in page]
+        expected = [text for i in range(7) for text in (f"question {i}", f"answer {i}")]
+        self.assertEqual(contents, expected)
+
+    def test_last_page_has_no_cursor(self):
+        self.assertIsNone(self.page(limit=7)["next_cursor"])
+        self.assertIsNotNone(self.page(limit=6)["next_cursor"])
+
+    def test_invalid_cursor_and_other_users_sessions(self):
+        response = self.client.get(f"/get_session_messages/{self.session.session_id}/", {"before": "not a cursor"})
+        self.assertEqual(response.status_code, 400)
+        other = User.objects.create_user("other", password="other")
+        self.client.force_login(other)
+        response = self.client.get(f"/get_session_messages/{self.session.session_id}/")
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "session-list-tests"}})
+class SessionListViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("sessions", password="sessions")
+        self.client.force_login(self.user)
+        self.addCleanup(cache.clear)
+        base = timezone.now() - timedelta(days=1)
+        for i in range(35):
+            session = ChatSession.objects.create(user=self.user, title=f"Session {i}")
+            ChatSession.objects.filter(pk=session.pk).update(created_at=base + timedelta(minutes=i // 2))
+
+    def sessions(self, **headers):
+        return self.client.get("/get_chat_sessions/", **headers)
+
+    def test_keyset_pages_cover_every_session_once(self):
+        first = self.sessions().json()
+        second = self.client.get("/get_chat_sessions/", {"before": first["next_cursor"]}).json()
+        titles = [s["title"] for s in first["sessions"] + second["sessions"]]
+        self.assertEqual((len(first["sessions"]), len(second["sessions"])), (30, 5))
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(sorted(titles), sorted(f"Session {i}" for i in range(35)))
+        created = [s["created_at"] for s in first["sessions"] + second["sessions"]]
+        self.assertEqual(created, sorted(created, reverse=True))
+
+    def test_unchanged_list_answers_304(self):
+        response = self.sessions()
+        etag = response["ETag"]
+        self.assertEqual(self.sessions(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_creating_a_session_invalidates_the_cached_page(self):
+        etag = self.sessions()["ETag"]
+        response = self.client.post("/create_chat_session/", json.dumps({"title": "Brand new"}), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.sessions(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["sessions"][0]["title"], "Brand new")
+
+    def test_deleting_a_session_invalidates_the_cached_page(self):
+        page = self.sessions()
+        etag = page["ETag"]
+        newest = page.json()["sessions"][0]
+        response = self.client.delete(f"/delete_chat_session/{newest['session_id']}/")
+        self.assertEqual(response.status_code, 200)
+
+        response = self.sessions(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(newest["session_id"], [s["session_id"] for s in response.json()["sessions"]])
+
+    def test_cached_page_is_per_user(self):
+        self.sessions()
+        other = User.objects.create_user("other", password="other")
+        self.client.force_login(other)
+        self.assertEqual(self.sessions().json()["sessions"], [])
+
+
+class MetricsRenderTests(SimpleTestCase):
+    def setUp(self):
+        fixtures = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fixtures, ignore_errors=True)
+        self.enterContext(self.settings(METRICS={"ENABLED": True}))
+        self.enterContext(mock.patch.object(metrics, "_store", metrics.MetricsStore(os.path.join(fixtures, "metrics.sqlite3"))))
+        self.enterContext(mock.patch.object(metrics, "_pending", {}))
+        # No background flusher, render() flushes
+        self.enterContext(mock.patch.object(metrics, "_flusher", object()))
+
+    def test_large_values_keep_every_digit(self):
+        metrics.inc("openai_tokens_total", 1234567, model="gpt-4", purpose="answer", kind="prompt")
+        for _ in range(3):
+            metrics.observe("chat_stage_seconds", 0.123456789, stage="turn")
+        text = metrics.render(gauges=[("chat_sessions", "Sessions", [({}, 2_000_001.5)])])
+
+        self.assertIn('openai_tokens_total{kind="prompt",model="gpt-4",purpose="answer"} 1234567\n', text)
+        self.assertIn('chat_stage_seconds_bucket{stage="turn",le="0.25"} 3\n', text)
+        self.assertIn(f'chat_stage_seconds_sum{{stage="turn"}} {0.123456789 * 3!r}\n', text)
+        self.assertIn('chat_stage_seconds_count{stage="turn"} 3\n', text)
+        self.assertIn("chat_sessions 2000001.5\n", text)
+        self.assertNotIn("e+", text)
@@ -12,8 +12,13 @@ urlpatterns=[
     path('chatbot/', views.chatbot_view, name='chatbot'),
     path('', views.home_view, name='home'),
     path('chat-response/', views.chat_response, name='chat_response'),
+    path('chat-response/stream/', views.chat_response_stream, name='chat_response_stream'),
+    path('chat-jobs/', views.submit_chat_job, name='submit_chat_job'),
+    path('chat-jobs/<uuid:job_id>/', views.get_chat_job, name='get_chat_job'),
     path('get_chat_sessions/', views.get_chat_sessions, name='get_chat_sessions'),
     path('get_session_messages/<uuid:session_id>/', views.get_session_messages, name='get_session_messages'),
     path('create_chat_session/', views.create_chat_session, name='create_chat_session'),
     path('delete_chat_session/<uuid:session_id>/', views.delete_chat_session, name='delete_chat_session'),
+    path('internal/status/', views.upstream_status, name='upstream_status'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
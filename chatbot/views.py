@@ -1,19 +1,38 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, authenticate, logout
 from django.contrib import messages
-from django.http import JsonResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import condition
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
+from .decorators import async_login_required, async_csrf_exempt
 from .forms import RegisterForm, LoginForm
-from .models import ChatSession, ChatMessage
+from .models import ChatSession, ChatMessage, ChatJob, SESSION_LIST_CACHE_KEY
 from .services.chatgpt_service import ChatGPTService
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
+from .services import admission, circuit_breaker, conversation_summary, http_client, metrics, query_analyzer, tracing
+from .services.source_cache import get_cache
+from datetime import datetime
+import base64
+import binascii
+import contextlib
+import hashlib
 import json
+import sqlite3
 import uuid
 
 chatgpt_service = ChatGPTService()
-executor = ThreadPoolExecutor(max_workers=4)
+
+# Turns per get_session_messages page
+MESSAGES_PAGE_SIZE = 20
+MAX_MESSAGES_PAGE_SIZE = 100
+# Sessions per get_chat_sessions page; the first one is cached per user
+SESSIONS_PAGE_SIZE = 30
+SESSIONS_CACHE_TTL = 24 * 60 * 60
 
 def register_view(request):
     if request.method == 'POST':
@@ -55,6 +74,7 @@ def chatbot_view(request):
 def home_view(request):
     return redirect('chatbot:chatbot')
 
+@metrics.instrument_view('create_chat_session')
 @login_required
 @csrf_exempt
 def create_chat_session(request):
@@ -82,47 +102,77 @@ def create_chat_session(request):
         'message': 'Only POST method is allowed'
     }, status=405)
 
-@login_required
-@csrf_exempt
-def chat_response(request):
+async def _open_session(request, data):
+    """
+    Get or create the chat session a turn belongs to, titling it after its first message.
+    Returns:
+        Tuple (session, user_query).
+    """
+    user_query = data.get('message', '')
+    session_id = data.get('session_id', str(uuid.uuid4()))  # Use provided session_id or create new
+    # Get or create chat session
+    session, created = await ChatSession.objects.aget_or_create(
+        user=request.user,
+        session_id=session_id,
+        defaults={'title': 'New Chat'}  # Default title, will update below if first message
+    )
+    # Check if this is the first message in the session
+    if created or session.message_count == 0:
+        # Update session title to first 50 characters of the query (or entire query if shorter)
+        session.title = user_query[:50] + "..." if len(user_query) > 50 else user_query
+        # Only the title, a background summary update may be saving the session too
+        await session.asave(update_fields=['title'])
+    return session, user_query
+
+async def _start_turn(request, data):
+    """
+    Get or create the chat session for a turn and load the history the model sees.
+    Returns:
+        Tuple (session, user_query, chat_history).
+    """
+    session, user_query = await _open_session(request, data)
+    # Rolling summary of older turns plus the latest ones verbatim
+    chat_history = await conversation_summary.aload_history(session)
+
+    print(f"Chat history for session {session.session_id}: {chat_history}")
+
+    return session, user_query, chat_history
+
+def _too_busy(rejected):
+    response = JsonResponse({
+        'status': 'error',
+        'message': 'Too many chat requests right now, please retry shortly',
+        'reason': rejected.reason
+    }, status=429)
+    response['Retry-After'] = str(rejected.retry_after)
+    return response
+
+@metrics.instrument_view('chat_response')
+@async_login_required
+@async_csrf_exempt
+async def chat_response(request):
     if request.method == 'POST':
+        try:
+            slot = await admission.aacquire(request.user)
+        except admission.AdmissionRejected as e:
+            return _too_busy(e)
+        trace = tracing.start('chat_response')
         try:
             data = json.loads(request.body)
-            user_query = data.get('message', '')
-            session_id = data.get('session_id', str(uuid.uuid4()))  # Use provided session_id or create new
-            # Get or create chat session
-            session, created = ChatSession.objects.get_or_create(
-                user=request.user,
-                session_id=session_id,
-                defaults={'title': 'New Chat'}  # Default title, will update below if first message
-            )
-            # Check if this is the first message in the session
-            if created or session.messages.count() == 0:
-                # Update session title to first 50 characters of the query (or entire query if shorter)
-                session.title = user_query[:50] + "..." if len(user_query) > 50 else user_query
-                session.save()
-            # Retrieve session chat history (properly interleaved)
-            chat_history = []
-            messages = session.messages.all().order_by('created_at')
-            for msg in messages:
-                chat_history.append({"role": "user", "content": msg.message})
-                chat_history.append({"role": "assistant", "content": msg.response})
-            
-            print(f"Chat history for session {session.session_id}: {chat_history}")
-            
-            # Limit to last 4 exchanges (8 messages) to avoid token limits
-            chat_history = chat_history[-8:]
+            with tracing.span('start_turn'):
+                session, user_query, chat_history = await _start_turn(request, data)
             # Get response from ChatGPTService
-            response_text = executor.submit(
-                partial(chatgpt_service.analyze_query, user_query, chat_history)
-            ).result()
+            response_text = await chatgpt_service.aanalyze_query(user_query, chat_history, budget=settings.CHAT_TURN_BUDGET['TOTAL'])
             # Save message to database
-            ChatMessage.objects.create(
-                user=request.user,
-                session=session,
-                message=user_query,
-                response=response_text
-            )
+            with tracing.span('save_message'):
+                chat_message = await ChatMessage.objects.acreate(
+                    user=request.user,
+                    session=session,
+                    message=user_query,
+                    response=response_text
+                )
+            conversation_summary.schedule_update(session, chatgpt_service)
+            await tracing.afinish(trace, chat_message)
             return JsonResponse({
                 'status': 'success',
                 'response': response_text,
@@ -135,69 +185,225 @@ def chat_response(request):
                 'status': 'error',
                 'message': str(e)
             }, status=500)
+        finally:
+            await admission.arelease(slot)
     return JsonResponse({
         'status': 'error',
         'message': 'Only POST method is allowed'
     }, status=405)
 
-@login_required
-def get_chat_sessions(request):
-    if request.method == 'GET':
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@metrics.instrument_view('chat_response_stream')
+@async_login_required
+@async_csrf_exempt
+async def chat_response_stream(request):
+    """
+    Same turn as chat_response, sent as Server-Sent Events: "stage" and "source"
+    progress events, "token" events carrying the answer as it is written, then
+    "done" once the ChatMessage is saved (or "error").
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Only POST method is allowed'
+        }, status=405)
+    try:
+        slot = await admission.aacquire(request.user)
+    except admission.AdmissionRejected as e:
+        return _too_busy(e)
+    trace = tracing.start('chat_response_stream')
+    try:
+        data = json.loads(request.body)
+        with tracing.span('start_turn'):
+            session, user_query, chat_history = await _start_turn(request, data)
+    except Exception as e:
+        print(e)
+        await admission.arelease(slot)
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+    user = request.user
+
+    async def events():
+        parts = []
+        # The body is iterated outside the view's context, the turn's trace carries on here
+        tracing.activate(trace)
         try:
-            sessions = ChatSession.objects.filter(user=request.user).order_by('-created_at')
-            sessions_data = [
-                {
+            # A slow reader can keep the stream open past SLOT_TTL, the slot must not lapse meanwhile
+            async with admission.aheartbeat(slot):
+                turn = chatgpt_service.astream_query(user_query, chat_history, budget=settings.CHAT_TURN_BUDGET['TOTAL'])
+                async with contextlib.aclosing(turn):
+                    async for event, payload in turn:
+                        if event == 'token':
+                            parts.append(payload['text'])
+                        elif event == 'error':
+                            # Sent as the stream's error event below, without saving a half answer
+                            raise Exception(payload['message'])
+                        yield _sse(event, payload)
+                with tracing.span('save_message'):
+                    chat_message = await ChatMessage.objects.acreate(
+                        user=user,
+                        session=session,
+                        message=user_query,
+                        response="".join(parts)
+                    )
+                conversation_summary.schedule_update(session, chatgpt_service)
+                await tracing.afinish(trace, chat_message)
+                yield _sse('done', {
                     'session_id': str(session.session_id),
-                    'title': session.title,
-                    'created_at': session.created_at.isoformat()
-                }
-                for session in sessions
-            ]
-            return JsonResponse({
-                'status': 'success',
-                'sessions': sessions_data
-            })
+                    'title': session.title
+                })
         except Exception as e:
-            return JsonResponse({
-                'status': 'error',
-                'message': str(e)
-            }, status=500)
-    return JsonResponse({
-        'status': 'error',
-        'message': 'Only GET method is allowed'
-    }, status=405)
+            print(e)
+            yield _sse('error', {'message': str(e)})
+        finally:
+            # The slot is held until the stream ends or the client goes away
+            await admission.arelease(slot)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Keep nginx from buffering the stream
+    return response
 
+@metrics.instrument_view('submit_chat_job')
+@async_login_required
+@async_csrf_exempt
+async def submit_chat_job(request):
+    """
+    Queue a chat turn for the run_chat_workers processes and return at once (202).
+    Poll get_chat_job with the returned job_id; the answer is saved to the session
+    even if the client goes away in the meantime.
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Only POST method is allowed'
+        }, status=405)
+    try:
+        data = json.loads(request.body)
+        session, user_query = await _open_session(request, data)
+        job = await ChatJob.objects.acreate(
+            user=request.user,
+            session=session,
+            message=user_query
+        )
+        return JsonResponse({
+            'status': 'success',
+            'job_id': str(job.job_id),
+            'session_id': str(session.session_id),
+            'title': session.title
+        }, status=202)
+    except Exception as e:
+        print(e)
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+
+@metrics.instrument_view('get_chat_job')
+@async_login_required
+async def get_chat_job(request, job_id):
+    """State of a submitted turn: queued, running (with its stage), done (with the response) or failed."""
+    if request.method != 'GET':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Only GET method is allowed'
+        }, status=405)
+    try:
+        job = await ChatJob.objects.select_related('session').aget(user=request.user, job_id=job_id)
+    except ChatJob.DoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Job not found'
+        }, status=404)
+    payload = {
+        'status': 'success',
+        'job_id': str(job.job_id),
+        'session_id': str(job.session.session_id),
+        'state': job.status,
+    }
+    if job.status == ChatJob.RUNNING:
+        payload['stage'] = job.stage
+    elif job.status == ChatJob.DONE:
+        payload['response'] = job.response
+    elif job.status == ChatJob.FAILED:
+        payload['error'] = job.error
+    response = JsonResponse(payload)
+    response['Cache-Control'] = 'no-store'
+    return response
+
+def _sessions_page(user, before=None, limit=SESSIONS_PAGE_SIZE):
+    # Keyset pagination on (created_at, id), served by the (user, created_at) index
+    sessions = ChatSession.objects.filter(user=user).order_by('-created_at', '-id').only('session_id', 'title', 'created_at')
+    if before:
+        created_at, pk = before
+        sessions = sessions.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    page = list(sessions[:limit + 1])
+    return {
+        'sessions': [
+            {
+                'session_id': str(session.session_id),
+                'title': session.title,
+                'created_at': session.created_at.isoformat()
+            }
+            for session in page[:limit]
+        ],
+        'next_cursor': _encode_cursor(page[limit - 1]) if len(page) > limit else None
+    }
+
+def _first_sessions_page(user):
+    """The user's newest sessions, cached until one of their sessions is saved or deleted."""
+    key = SESSION_LIST_CACHE_KEY.format(user_id=user.pk)
+    page = cache.get(key)
+    if page is None:
+        page = _sessions_page(user)
+        page['etag'] = hashlib.md5(json.dumps(page, sort_keys=True).encode()).hexdigest()
+        page['last_modified'] = timezone.now()
+        cache.set(key, page, SESSIONS_CACHE_TTL)
+    return page
+
+def _sessions_etag(request):
+    if request.GET.get('before') or not request.user.is_authenticated:
+        return None
+    return _first_sessions_page(request.user)['etag']
+
+def _sessions_last_modified(request):
+    if request.GET.get('before') or not request.user.is_authenticated:
+        return None
+    return _first_sessions_page(request.user)['last_modified']
+
+@metrics.instrument_view('get_chat_sessions')
 @login_required
-def get_session_messages(request, session_id):
+@condition(etag_func=_sessions_etag, last_modified_func=_sessions_last_modified)
+def get_chat_sessions(request):
+    """
+    The user's sessions, newest first, SESSIONS_PAGE_SIZE at a time. Pass the returned
+    next_cursor as ?before= for the next page. The first page is served from the cache
+    and answers conditional requests with 304 while nothing changed.
+    """
     if request.method == 'GET':
         try:
-            session = ChatSession.objects.get(user=request.user, session_id=session_id)
-            messages = session.messages.all()
-            messages_data = [
-                {
-                    'role': 'user',
-                    'content': msg.message,
-                    'created_at': msg.created_at.isoformat()
-                } for msg in messages
-            ] + [
-                {
-                    'role': 'assistant',
-                    'content': msg.response,
-                    'created_at': msg.created_at.isoformat()
-                } for msg in messages
-            ]
-            messages_data.sort(key=lambda x: x['created_at'])
-            return JsonResponse({
+            if request.GET.get('before'):
+                try:
+                    page = _sessions_page(request.user, before=_decode_cursor(request.GET['before']))
+                except (ValueError, UnicodeDecodeError, binascii.Error):
+                    return JsonResponse({
+                        'status': 'error',
+                        'message': 'Invalid page parameters'
+                    }, status=400)
+            else:
+                page = _first_sessions_page(request.user)
+            response = JsonResponse({
                 'status': 'success',
-                'messages': messages_data,
-                'session_id': str(session.session_id),
-                'title': session.title
+                'sessions': page['sessions'],
+                'next_cursor': page['next_cursor']
             })
-        except ChatSession.DoesNotExist:
-            return JsonResponse({
-                'status': 'error',
-                'message': 'Session not found'
-            }, status=404)
+            # Let the browser keep the list but revalidate it on every load
+            response['Cache-Control'] = 'private, no-cache'
+            return response
         except Exception as e:
             return JsonResponse({
                 'status': 'error',
@@ -208,7 +414,80 @@ def get_session_messages(request, session_id):
         'message': 'Only GET method is allowed'
     }, status=405)
 
+def _encode_cursor(row):
+    return base64.urlsafe_b64encode(f"{row.created_at.isoformat()}|{row.pk}".encode()).decode()
+
+def _decode_cursor(cursor):
+    created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(pk)
+
+@metrics.instrument_view('get_session_messages')
+@async_login_required
+async def get_session_messages(request, session_id):
+    """
+    One page of a session's turns, newest page first and oldest turn first within
+    the page. Pass the returned next_cursor as ?before= to get the page before it
+    (null once the start of the session is reached); ?limit= sets the page size in turns.
+    """
+    if request.method != 'GET':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Only GET method is allowed'
+        }, status=405)
+    try:
+        limit = max(1, min(int(request.GET.get('limit', MESSAGES_PAGE_SIZE)), MAX_MESSAGES_PAGE_SIZE))
+        before = _decode_cursor(request.GET['before']) if request.GET.get('before') else None
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Invalid page parameters'
+        }, status=400)
+    try:
+        session = await ChatSession.objects.aget(user=request.user, session_id=session_id)
+        # Keyset pagination on (created_at, id), served by the (session, created_at) index
+        turns = session.messages.order_by('-created_at', '-id').only('message', 'response', 'created_at')
+        if before:
+            created_at, pk = before
+            turns = turns.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+        page = [msg async for msg in turns[:limit + 1]]
+    except ChatSession.DoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Session not found'
+        }, status=404)
+    except Exception as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=500)
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    header = {
+        'status': 'success',
+        'session_id': str(session.session_id),
+        'title': session.title,
+        'next_cursor': _encode_cursor(page[0]) if has_more else None,
+    }
+
+    async def body():
+        # One message at a time, long answers never sit in memory as one big JSON string
+        yield json.dumps(header)[:-1] + ', "messages": ['
+        separator = ''
+        for msg in page:
+            for role, content in (('user', msg.message), ('assistant', msg.response)):
+                yield separator + json.dumps({
+                    'role': role,
+                    'content': content,
+                    'created_at': msg.created_at.isoformat()
+                })
+                separator = ', '
+        yield ']}'
 
+    return StreamingHttpResponse(body(), content_type='application/json')
+
+
+@metrics.instrument_view('delete_chat_session')
 @login_required
 @csrf_exempt
 def delete_chat_session(request, session_id):
@@ -235,6 +514,60 @@ def delete_chat_session(request, session_id):
         'message': 'Only DELETE method is allowed'
     }, status=405)
 
+@staff_member_required
+def upstream_status(request):
+    """Internal health view: chat admission queue, breaker state per upstream host, this worker's connection reuse, local vs LLM query routing and the source cache."""
+    try:
+        cache_stats = get_cache().stats()
+    except sqlite3.Error as e:
+        cache_stats = {'error': str(e)}
+    try:
+        admission_stats = admission.get_controller().stats()
+    except sqlite3.Error as e:
+        admission_stats = {'error': str(e)}
+    return JsonResponse({
+        'status': 'success',
+        'admission': admission_stats,
+        'circuit_breakers': circuit_breaker.get_breakers().states(),
+        'connection_pools': http_client.pool_stats(),
+        'query_router': query_analyzer.path_stats(),
+        'source_cache': cache_stats
+    })
+
+def _metrics_allowed(request):
+    token = settings.METRICS.get('TOKEN')
+    if token:
+        return request.headers.get('Authorization') == f"Bearer {token}"
+    # Without a token only scrapers on the host itself get in
+    return request.META.get('REMOTE_ADDR') in ('127.0.0.1', '::1')
+
+def _live_gauges():
+    """Gauges read at scrape time from the shared admission, job and breaker state."""
+    gauges = []
+    try:
+        state = admission.get_controller().stats()
+        gauges.append(('chat_admission_in_flight', 'Chat turns holding an admission slot', [({}, state['in_flight'])]))
+        gauges.append(('chat_admission_queue_depth', 'Chat turns waiting for admission, by tier', [({'tier': tier}, n) for tier, n in state['queued'].items()]))
+        gauges.append(('chat_admission_oldest_wait_seconds', 'How long the oldest queued chat turn has waited', [({}, state['oldest_wait_seconds'])]))
+    except sqlite3.Error as e:
+        print(e)
+    try:
+        breakers = circuit_breaker.get_breakers().states()
+        gauges.append(('upstream_circuit_open', 'Upstream hosts whose circuit breaker is not closed', [
+            ({'host': host, 'state': b['state']}, 0 if b['state'] == 'closed' else 1) for host, b in breakers.items()
+        ]))
+    except sqlite3.Error as e:
+        print(e)
+    jobs = dict(ChatJob.objects.filter(status__in=[ChatJob.QUEUED, ChatJob.RUNNING]).values_list('status').annotate(n=Count('id')))
+    gauges.append(('chat_jobs', 'Chat jobs queued or running', [({'status': status}, jobs.get(status, 0)) for status in (ChatJob.QUEUED, ChatJob.RUNNING)]))
+    return gauges
+
+def metrics_view(request):
+    """Prometheus text format scrape of every worker's metrics on this host."""
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(_live_gauges()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def generate_bot_response(message):
     message = message.lower()
     if 'hello' in message:
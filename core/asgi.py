@@ -5,12 +5,36 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+
+chat_response is an async view, so serve the project through this module to
+keep many chats in flight per worker, e.g.:
+
+    gunicorn core.asgi:application -k uvicorn.workers.UvicornWorker
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from chatbot.services import http_client  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # Django doesn't speak the lifespan protocol, handle it here to manage upstream connections
+    if scope["type"] != "lifespan":
+        return await django_application(scope, receive, send)
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            warmup = asyncio.get_running_loop().create_task(http_client.awarm_up())  # noqa: F841 (keep a reference)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await http_client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
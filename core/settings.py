@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -83,6 +84,14 @@ DATABASES = {
     }
 }
 
+# File-based so every worker on the host sees the same entries and invalidations
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'django',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -144,3 +153,136 @@ LOGIN_URL = 'chatbot:login'
 CSRF_TRUSTED_ORIGINS = [
     "http://13.234.198.68",
 ]
+
+# Shared connection pool for the upstream biomedical APIs (chatbot/services/http_client.py)
+UPSTREAM_HTTP = {
+    'POOL_MAXSIZE': 10,  # Keep-alive connections per upstream host
+    'MAX_CONNECTIONS': 100,  # Open connections per worker across all hosts (async client)
+    'KEEPALIVE_EXPIRY': 120,  # Seconds an idle connection stays open
+    'WARMUP': True,  # Connect to every known host when a worker boots
+    'TIMEOUT': 15,  # Per-request cap, cut down further to what is left of the chat turn's budget
+}
+
+# Record/replay of upstream and OpenAI exchanges (chatbot/services/replay.py), for running
+# offline: record once with network access, then replay from the fixture files
+UPSTREAM_REPLAY = {
+    'MODE': os.getenv('UPSTREAM_REPLAY', 'off'),  # 'off', 'record' or 'replay'
+    'PATH': BASE_DIR / 'chatbot' / 'fixtures' / 'upstream',
+    'CASSETTE': os.getenv('UPSTREAM_REPLAY_CASSETTE', 'default'),  # Fixture file used outside use_cassette()
+    'LATENCY': False,  # Replay sleeps for each exchange's recorded duration
+    'LATENCY_SCALE': 1.0,
+}
+
+# Seconds a chat turn may take end to end; upstream lookups get what is left after
+# routing minus GENERATION_RESERVE, sources still running then are cancelled
+CHAT_TURN_BUDGET = {
+    'TOTAL': 45,
+    'GENERATION_RESERVE': 15,
+    'GENERATION_GRACE': 5,  # Seconds the answer may run past TOTAL before it is cut short
+}
+
+# Prometheus metrics at /metrics; each worker adds its samples to a file shared by the host
+METRICS = {
+    'ENABLED': True,
+    'PATH': BASE_DIR / 'cache' / 'metrics.sqlite3',
+    'FLUSH_INTERVAL': 5,  # Seconds between a worker's writes; a scrape flushes the worker serving it
+    'TOKEN': os.getenv('METRICS_TOKEN'),  # Bearer token for scrapers; unset allows localhost only
+}
+
+# Span trees of chat turns (chatbot/services/tracing.py), kept for sampled or slow turns and
+# shown as a waterfall on the ChatTrace admin page
+TRACING = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.05,  # Share of ordinary turns saved
+    'SLOW_SECONDS': 20,  # Turns at least this slow are always saved
+    'MAX_SPANS': 500,  # Per trace, later spans are counted but dropped
+    'RETENTION_DAYS': 14,
+}
+
+# Admission control for chat turns served in the request (chat_response and its stream),
+# shared by every worker on the host; turns over the limits get a 429 with Retry-After
+CHAT_ADMISSION = {
+    'ENABLED': True,
+    'PATH': BASE_DIR / 'cache' / 'admission.sqlite3',
+    'MAX_IN_FLIGHT': 16,
+    'MAX_PER_USER': 2,  # Running or queued, so one user's tabs can't crowd everyone else out
+    'MAX_QUEUE': 32,  # Turns waiting for a slot, beyond that they are rejected at once
+    'MAX_WAIT': 10,  # Seconds a queued turn waits before it is rejected
+    'TIERS': {'staff': 0, 'user': 1},  # Queue priority, lower is served first
+    'SLOT_TTL': 120,  # Slots of workers that died are taken back after this
+    'POLL_INTERVAL': 0.1,
+}
+
+# Queued chat turns (chat-jobs/ API), answered by `manage.py run_chat_workers`
+CHAT_JOBS = {
+    'PROCESSES': 2,
+    'CONCURRENCY': 4,  # Turns per process at once, they mostly wait on upstream APIs and OpenAI
+    'POLL_INTERVAL': 0.5,  # Seconds an idle worker waits before looking for jobs again
+    'LEASE_SECONDS': 120,  # A job still running this long after its claim is taken as lost and requeued
+    'MAX_ATTEMPTS': 2,
+}
+
+# Prompt token budgets for the answer model (chatbot/services/context_assembler.py)
+CHAT_CONTEXT = {
+    'ENCODING': 'cl100k_base',
+    'VOCAB_DIR': BASE_DIR / 'cache' / 'tiktoken',  # BPE vocabulary, ship it with the app to count tokens offline
+    'CONTEXT_WINDOW': 8192,  # gpt-4
+    'RESPONSE_TOKENS': 1500,  # Kept free for the answer, also its max_tokens
+    'ROUTING_HISTORY_TOKENS': 1500,
+    'HISTORY_TOKENS': 2000,
+    'ENTRY_TOKENS': 250,  # Cap for a single trial, paper, gene...
+    'SECTIONS': {  # Evidence budgets, filled in this order; what one section leaves goes to the next
+        'pubmed': 1200,
+        'trials': 900,
+        'ensembl': 700,
+        'uniprot': 400,
+        'protein_atlas': 400,
+        'geo': 300,
+        'array_express': 300,
+        'genbank': 200,
+    },
+}
+
+# Older turns of a chat session reach the model only through a summary kept on the session
+CONVERSATION_SUMMARY = {
+    'ENABLED': True,
+    'MODEL': 'gpt-3.5-turbo',  # Runs after the response is sent, off the turn's critical path
+    'VERBATIM_TURNS': 3,  # Latest exchanges sent word for word
+    'MAX_UNSUMMARIZED_TURNS': 4,  # Exchanges read per turn, also the whole window when disabled
+    'SUMMARY_TOKENS': 400,
+    'BATCH_TURNS': 8,  # Exchanges folded in per summarizer call, a long session catches up over several
+}
+
+# Cache of upstream source results shared by all workers on the host (chatbot/services/source_cache.py)
+SOURCE_CACHE = {
+    'ENABLED': True,
+    'PATH': BASE_DIR / 'cache' / 'sources.sqlite3',
+    'MAX_ENTRIES': 50000,  # Least recently used entries are evicted above this
+    'TTL': {  # Seconds per source
+        'ensembl': 7 * 24 * 3600,
+        'uniprot': 7 * 24 * 3600,
+        'protein_atlas': 7 * 24 * 3600,
+        'genbank': 7 * 24 * 3600,
+        'pubmed': 24 * 3600,
+        'geo': 24 * 3600,
+        'array_express': 24 * 3600,
+        'clinical_trials': 4 * 3600,  # Recruiting status changes often
+    },
+}
+
+# Token buckets shared by every worker on the host
+UPSTREAM_RATE_LIMITS = {
+    'PATH': BASE_DIR / 'cache' / 'rate_limits.sqlite3',
+    'MAX_WAIT': 30,  # Seconds a request queues for a slot before failing
+    # {host: requests per second}; None = NCBI E-utilities at 3/s, or 10/s when PUBMED_API_KEY is set
+    'RATES': None,
+}
+
+# Per-host breakers shared by every worker; open hosts are skipped with the section's fallback text
+CIRCUIT_BREAKER = {
+    'ENABLED': True,
+    'PATH': BASE_DIR / 'cache' / 'circuit_breakers.sqlite3',
+    'FAILURE_THRESHOLD': 5,  # Consecutive errors, 5xx or slow responses
+    'SLOW_SECONDS': 8,
+    'OPEN_SECONDS': 30,  # Before a single probe request is let through
+}
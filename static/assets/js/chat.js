@@ -10,6 +10,10 @@ document.addEventListener('DOMContentLoaded', function () {
     const mainContent = document.getElementById('mainContent');
     let currentSessionId = null;
     let isTyping = false; // Track typing state
+    let olderMessagesCursor = null; // Cursor for the page before the oldest loaded message
+    let isLoadingOlder = false;
+    let sessionsCursor = null; // Cursor for the next page of sessions in the sidebar
+    let isLoadingSessions = false;
 
     // Debug: Verify elements exist
     console.log('chatContainer:', chatContainer);
@@ -28,8 +32,8 @@ document.addEventListener('DOMContentLoaded', function () {
         return '';
     }
 
-    // Function to add a message to the chat container
-    function addMessage(text, isBot) {
+    // Function to build a message element
+    function createMessage(text, isBot) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `flex ${isBot ? 'justify-start' : 'justify-end'} mb-4 message-animation`;
         const messageContent = document.createElement('div');
@@ -37,9 +41,92 @@ document.addEventListener('DOMContentLoaded', function () {
         // Parse markdown using marked library
         messageContent.innerHTML = marked.parse(text);
         messageDiv.appendChild(messageContent);
+        return messageDiv;
+    }
+
+    // Function to add a message to the chat container
+    function addMessage(text, isBot) {
+        const messageDiv = createMessage(text, isBot);
         chatContainer.appendChild(messageDiv);
         // Scroll to bottom
         chatContainer.scrollTop = chatContainer.scrollHeight;
+        return messageDiv.firstChild;
+    }
+
+    // Function to insert older messages above the loaded ones without moving the view
+    function prependMessages(messages) {
+        const fragment = document.createDocumentFragment();
+        messages.forEach(message => fragment.appendChild(createMessage(message.content, message.role === 'assistant')));
+        const distanceFromBottom = chatContainer.scrollHeight - chatContainer.scrollTop;
+        chatContainer.insertBefore(fragment, chatContainer.firstChild);
+        chatContainer.scrollTop = chatContainer.scrollHeight - distanceFromBottom;
+    }
+
+    // Function to fetch one page of a session's messages, before the given cursor if any
+    async function fetchMessagesPage(sessionId, cursor) {
+        const url = cursor
+            ? `/get_session_messages/${sessionId}/?before=${encodeURIComponent(cursor)}`
+            : `/get_session_messages/${sessionId}/`;
+        const response = await fetch(url, {
+            method: 'GET',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCSRFToken()
+            }
+        });
+        return response.json();
+    }
+
+    // Function to load the page before the oldest loaded message
+    async function loadOlderMessages() {
+        if (!olderMessagesCursor || isLoadingOlder || !currentSessionId) return;
+        const sessionId = currentSessionId;
+        isLoadingOlder = true;
+        try {
+            const data = await fetchMessagesPage(sessionId, olderMessagesCursor);
+            // Ignore the page if the user switched sessions meanwhile
+            if (sessionId !== currentSessionId) return;
+            if (data.status === 'success') {
+                olderMessagesCursor = data.next_cursor;
+                prependMessages(data.messages);
+            } else {
+                console.error('Error loading older messages:', data.message);
+            }
+        } catch (error) {
+            console.error('Error fetching older messages:', error);
+        } finally {
+            isLoadingOlder = false;
+        }
+    }
+
+    // Function to update the typing indicator with what the bot is doing
+    function updateTypingIndicator(text) {
+        const label = document.querySelector('.typing-container .typing-indicator');
+        if (label) label.textContent = text;
+    }
+
+    // Function to read Server-Sent Events from a fetch response (EventSource can't POST)
+    async function readEvents(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                let event = 'message';
+                let data = '';
+                frame.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                if (data) await onEvent(event, JSON.parse(data));
+            }
+        }
     }
 
     // Function to show typing indicator and disable input
@@ -224,20 +311,28 @@ document.addEventListener('DOMContentLoaded', function () {
         sessionList.appendChild(sessionDiv);
     }
 
+    // Function to fetch one page of chat sessions, after the given cursor if any
+    async function fetchSessionsPage(cursor) {
+        const url = cursor ? `/get_chat_sessions/?before=${encodeURIComponent(cursor)}` : '/get_chat_sessions/';
+        // The first page carries an ETag, the browser revalidates it and reuses its copy on a 304
+        const response = await fetch(url, {
+            method: 'GET',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCSRFToken()
+            }
+        });
+        return response.json();
+    }
+
     // Function to fetch and display chat sessions
     async function loadChatSessions() {
         try {
             console.log("Fetching /get_chat_sessions/"); // Debug
-            const response = await fetch('/get_chat_sessions/', {
-                method: 'GET',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'X-CSRFToken': getCSRFToken()
-                }
-            });
-            const data = await response.json();
+            const data = await fetchSessionsPage(null);
             if (data.status === 'success') {
                 sessionList.innerHTML = ''; // Clear existing sessions
+                sessionsCursor = data.next_cursor;
                 data.sessions.forEach(session => addSessionToSidebar(session));
                 return data.sessions;
             } else {
@@ -250,23 +345,41 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     }
 
+    // Function to append the next page of sessions to the sidebar
+    async function loadMoreSessions() {
+        if (!sessionsCursor || isLoadingSessions) return;
+        isLoadingSessions = true;
+        try {
+            const data = await fetchSessionsPage(sessionsCursor);
+            if (data.status === 'success') {
+                sessionsCursor = data.next_cursor;
+                data.sessions.forEach(session => addSessionToSidebar(session));
+            } else {
+                console.error('Error loading more chat sessions:', data.message);
+            }
+        } catch (error) {
+            console.error('Error fetching more chat sessions:', error);
+        } finally {
+            isLoadingSessions = false;
+        }
+    }
+
     // Function to load messages for a specific session
     async function loadSessionMessages(sessionId, title) {
         currentSessionId = sessionId;
         localStorage.setItem('currentSessionId', currentSessionId); // Save to localStorage
         sessionTitle.textContent = title || 'Medical Assistant';
         chatContainer.innerHTML = ''; // Clear chat container
+        olderMessagesCursor = null;
         try {
-            const response = await fetch(`/get_session_messages/${sessionId}/`, {
-                method: 'GET',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'X-CSRFToken': getCSRFToken()
-                }
-            });
-            const data = await response.json();
+            // Latest page only, older ones load as the user scrolls up
+            const data = await fetchMessagesPage(sessionId, null);
             if (data.status === 'success') {
+                if (!title) sessionTitle.textContent = data.title || 'Medical Assistant';
+                olderMessagesCursor = data.next_cursor;
                 data.messages.forEach(message => addMessage(message.content, message.role === 'assistant'));
+                // Nothing to scroll yet, so fetch the previous page straight away
+                if (chatContainer.scrollHeight <= chatContainer.clientHeight) loadOlderMessages();
                 // Highlight active session
                 document.querySelectorAll('#sessionList > div').forEach(div => {
                     div.classList.remove('bg-blue-100');
@@ -337,8 +450,25 @@ document.addEventListener('DOMContentLoaded', function () {
         messageInput.value = '';
         showTypingIndicator();
 
+        let answer = '';
+        let answerContent = null;
+        let renderPending = false;
+        let finished = false;
+        const runningSources = new Set();
+
+        // Re-render the markdown at most once per frame while tokens arrive
+        function renderAnswer() {
+            if (renderPending) return;
+            renderPending = true;
+            requestAnimationFrame(() => {
+                renderPending = false;
+                answerContent.innerHTML = marked.parse(answer);
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            });
+        }
+
         try {
-            const response = await fetch('/chat-response/', {
+            const response = await fetch('/chat-response/stream/', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -346,17 +476,47 @@ document.addEventListener('DOMContentLoaded', function () {
                 },
                 body: JSON.stringify({ message, session_id: currentSessionId })
             });
-            const data = await response.json();
-            removeTypingIndicator();
-            if (data.status === 'success') {
-                addMessage(data.response, true);
-                // Refresh session list if title updated
-                await loadChatSessions();
-                if (data.title && data.title !== sessionTitle.textContent) {
-                    sessionTitle.textContent = data.title;
+            if (response.status === 429) {
+                // Admission control: too many turns in flight, the server says when to come back
+                const retryAfter = response.headers.get('Retry-After') || 'a few';
+                removeTypingIndicator();
+                addMessage(`The assistant is busy right now. Please try again in ${retryAfter} seconds.`, true);
+                return;
+            }
+            if (!response.ok || !response.body) {
+                throw new Error(`Stream request failed: ${response.status}`);
+            }
+            await readEvents(response, async (event, data) => {
+                if (event === 'stage') {
+                    if (data.stage === 'analyzing') updateTypingIndicator('Analyzing your question');
+                    if (data.stage === 'writing') updateTypingIndicator('Writing the answer');
+                } else if (event === 'source') {
+                    if (data.status === 'started') runningSources.add(data.label);
+                    else runningSources.delete(data.label);
+                    if (runningSources.size) updateTypingIndicator(`Searching ${[...runningSources].join(', ')}`);
+                } else if (event === 'token') {
+                    if (!answerContent) {
+                        // First token: swap the indicator for the answer, input stays disabled until done
+                        const indicator = document.querySelector('.typing-container');
+                        if (indicator) indicator.remove();
+                        answerContent = addMessage('', true);
+                    }
+                    answer += data.text;
+                    renderAnswer();
+                } else if (event === 'done') {
+                    finished = true;
+                    removeTypingIndicator();
+                    // Refresh session list if title updated
+                    await loadChatSessions();
+                    if (data.title && data.title !== sessionTitle.textContent) {
+                        sessionTitle.textContent = data.title;
+                    }
+                } else if (event === 'error') {
+                    console.error('Server error:', data.message);
                 }
-            } else {
-                console.error('Server error:', data.message);
+            });
+            if (!finished) {
+                removeTypingIndicator();
                 addMessage('I apologize, but I encountered an error. Please try again or rephrase your question.', true);
             }
         } catch (error) {
@@ -369,6 +529,7 @@ document.addEventListener('DOMContentLoaded', function () {
     // Function to start a new chat session
     async function startNewChat() {
         currentSessionId = null;
+        olderMessagesCursor = null;
         localStorage.removeItem('currentSessionId'); // Clear saved session
         chatContainer.innerHTML = '';
         sessionTitle.textContent = 'Medical Assistant';
@@ -426,18 +587,11 @@ document.addEventListener('DOMContentLoaded', function () {
         initializeSidebar();
         const savedSessionId = localStorage.getItem('currentSessionId');
         if (savedSessionId) {
-            // Fetch sessions to verify if saved session exists
+            // Fetch sessions for the sidebar, and the saved session's title if it is on the first page
             const sessions = await loadChatSessions();
             const session = sessions.find(s => s.session_id === savedSessionId);
-            if (session) {
-                // Load saved session
-                loadSessionMessages(savedSessionId, session.title);
-            } else {
-                // Saved session is invalid, start new chat
-                localStorage.removeItem('currentSessionId');
-                startNewChat();
-                await loadChatSessions();
-            }
+            // The saved session may be older than the first page; an invalid one falls back to a new chat
+            loadSessionMessages(savedSessionId, session ? session.title : null);
         } else {
             // No saved session, start new chat
             startNewChat();
@@ -463,6 +617,16 @@ document.addEventListener('DOMContentLoaded', function () {
     } else {
         console.error('newChatBtn not found');
     }
+    if (sessionList) {
+        sessionList.addEventListener('scroll', () => {
+            if (sessionList.scrollTop + sessionList.clientHeight > sessionList.scrollHeight - 100) loadMoreSessions();
+        });
+    }
+    if (chatContainer) {
+        chatContainer.addEventListener('scroll', () => {
+            if (chatContainer.scrollTop < 100) loadOlderMessages();
+        });
+    }
     if (toggleSidebarBtn) {
         toggleSidebarBtn.addEventListener('click', toggleSidebar);
         console.log('Toggle sidebar button event listener attached');